@@ -7,6 +7,8 @@ data from NCI to AWS S3 bucket. It:
  * Lists scenes to be uploaded to the S3 bucket, based on what is indexed in the NCI Database.
  * Uploads the `C3 to S3 rolling` script to a temporary NCI work folder.
  * Executes the previously uploaded script, which performs the upload to S3 process.
+   With more than one shard, the list is split into contiguous shards, which are
+   uploaded by a PBS array job on `copyq` and their error reports merged into one.
  * Cleans up the working folder on the `NCI`.
 
 This DAG takes following input parameters from the `nci_c3_upload_s3_config` variable:
@@ -18,6 +20,8 @@ This DAG takes following input parameters from the `nci_c3_upload_s3_config` var
  * `snstopic`: ARN of the SNS topic. `"arn:aws:sns:ap-southeast-2:538673716275:dea-public-data-landsat-3"`
  * `doupdate`: If this flag is set then do a fresh sync of data and
     replace the metadata. `"--force-update"`
+ * `shards`: Optional number of PBS array subjobs to split the upload across,
+    each on its own data mover node. `1` by default, which runs the upload over SSH.
 
 """
 from datetime import datetime, timedelta
@@ -27,9 +31,13 @@ from textwrap import dedent
 import pendulum
 from airflow import DAG
 from airflow.configuration import conf
+from airflow.operators.python_operator import BranchPythonOperator
 from airflow.providers.amazon.aws.hooks.base_aws import AwsBaseHook as AwsHook
 from airflow.providers.sftp.operators.sftp import SFTPOperator, SFTPOperation
 from airflow.providers.ssh.operators.ssh import SSHOperator
+from airflow.utils.trigger_rule import TriggerRule
+
+from sensors.pbs_job_complete_sensor import PBSJobSensor
 
 local_tz = pendulum.timezone("Australia/Canberra")
 
@@ -109,10 +117,122 @@ RUN_UPLOAD_SCRIPT = dedent(
             --s3baseurl '{{ var.json.nci_c3_upload_s3_config.s3baseurl }}' \
             --explorerbaseurl '{{ var.json.nci_c3_upload_s3_config.explorerbaseurl }}' \
             --snstopic '{{ var.json.nci_c3_upload_s3_config.snstopic }}' \
+            --journal '{{ work_dir }}/{{ params.product }}.journal.sqlite' \
             {{ var.json.nci_c3_upload_s3_config.doupdate }}
 """
 )
 
+# language="Shell Script"
+SUBMIT_SHARDS_COMMAND = dedent(
+    """
+    {% set aws_creds = params.aws_hook.get_credentials() -%}
+    {% set shards = var.json.nci_c3_upload_s3_config.get('shards', 1) | int -%}
+    cd {{ work_dir }}
+
+    # exit on fail, the job id printed by qsub is the only output
+    set -eu
+
+    # Split by lines into contiguous shards, so the granules of a day stay
+    # together and are checked in S3 with the same listings
+    split -n l/{{ shards }} -d -a 3 --additional-suffix=.csv \\
+        '{{ params.product }}.csv' '{{ params.product }}.shard.'
+    mkdir -p logs
+
+    # Keep the AWS Access key/secret from Airflow connection module in a file only
+    # we can read, passing them with qsub -v would show them in qstat and XCom
+    (umask 077; cat > aws_credentials.env <<EOF
+    export AWS_ACCESS_KEY_ID={{aws_creds.access_key}}
+    export AWS_SECRET_ACCESS_KEY={{aws_creds.secret_key}}
+    EOF
+    )
+
+    cat > upload_shard.sh <<'EOF'
+    set -eu
+    source '{{ work_dir }}/aws_credentials.env'
+    module use /g/data/v10/public/modules/modulefiles
+    module load dea
+    set -x
+
+    shard=$(printf '%03d' "${PBS_ARRAY_INDEX}")
+    # Each shard has its own journal, SQLite locking can't be shared between nodes
+    # The error report is written even when there are errors, the merge fails on them
+    python3 '{{ work_dir }}/c3_to_s3_rolling.py' \\
+            --filepath "{{ work_dir }}/{{ params.product }}.shard.${shard}.csv" \\
+            --ncidir '{{ params.nci_dir }}' \\
+            --s3path '{{ var.json.nci_c3_upload_s3_config.s3path }}' \\
+            --s3bucket '{{ var.json.nci_c3_upload_s3_config.s3bucket }}' \\
+            --s3baseurl '{{ var.json.nci_c3_upload_s3_config.s3baseurl }}' \\
+            --explorerbaseurl '{{ var.json.nci_c3_upload_s3_config.explorerbaseurl }}' \\
+            --snstopic '{{ var.json.nci_c3_upload_s3_config.snstopic }}' \\
+            --journal "{{ work_dir }}/{{ params.product }}.shard.${shard}.journal.sqlite" \\
+            --error-report "{{ work_dir }}/{{ params.product }}.shard.${shard}.errors.json" \\
+            {{ var.json.nci_c3_upload_s3_config.doupdate }} || true
+    EOF
+
+    qsub -N c3_upload \\
+         -J 0-{{ shards - 1 }} \\
+         -q copyq \\
+         -W umask=33 \\
+         -l wd,walltime=10:00:00,mem=4GB,ncpus=1 \\
+         -l storage=gdata/v10+gdata/xu18 \\
+         -P v10 -o {{ work_dir }}/logs/ -e {{ work_dir }}/logs/ \\
+         -- /bin/bash -l '{{ work_dir }}/upload_shard.sh'
+"""
+)
+
+# language="Shell Script"
+MERGE_SHARD_REPORTS_COMMAND = dedent(
+    """
+    {% set shards = var.json.nci_c3_upload_s3_config.get('shards', 1) | int -%}
+    cd {{ work_dir }}
+
+    # echo on and exit on fail
+    set -eux
+
+    # The shards are done with the credentials
+    rm -f aws_credentials.env
+
+    module use /g/data/v10/public/modules/modulefiles
+    module load dea
+
+    python3 - <<'EOF'
+    import json
+    import os
+    import sys
+
+    granules = 0
+    errors = []
+    for shard in range({{ shards }}):
+        path = "{{ params.product }}.shard.%03d.errors.json" % shard
+        if not os.path.exists(path):
+            # The subjob died before finishing its shard
+            errors.append("shard %d wrote no error report, see its log" % shard)
+            continue
+        with open(path) as report_file:
+            report = json.load(report_file)
+        granules += report["granules"]
+        errors.extend(report["errors"])
+
+    with open("{{ params.product }}.errors.json", "w") as report_file:
+        json.dump({"granules": granules, "errors": errors}, report_file)
+    print("Processed %d granules in {{ shards }} shards" % granules)
+    if errors:
+        print("\\n".join(errors))
+        sys.exit(1)
+    EOF
+"""
+)
+
+
+def choose_upload_mode(shards, product):
+    """
+    Upload over SSH, or with a PBS array job when there is more than one shard
+    """
+    if int(shards) > 1:
+        return f"submit_c3_to_s3_shards_{product}"
+    return f"execute_c3_to_s3_script_{product}"
+
+
 default_args = {
     "owner": "Damien Ayers",
     "start_date": datetime(2020, 9, 25, tzinfo=local_tz),
@@ -178,6 +298,42 @@ with dag:
                 "nci_dir": "/g/data/xu18/ga/",
             },
         )
+        choose_upload = BranchPythonOperator(
+            task_id=f"choose_upload_mode_{product}",
+            python_callable=choose_upload_mode,
+            op_kwargs={
+                "shards": "{{ var.json.nci_c3_upload_s3_config.get('shards', 1) }}",
+                "product": product,
+            },
+        )
+        # Split the scenes into shards, and upload them with a PBS array job
+        submit_task_id = f"submit_c3_to_s3_shards_{product}"
+        submit_c3_to_s3_shards = SSHOperator(
+            task_id=submit_task_id,
+            command=COMMON + SUBMIT_SHARDS_COMMAND,
+            params={
+                "aws_hook": aws_hook,
+                "product": product,
+                "nci_dir": "/g/data/xu18/ga/",
+            },
+            do_xcom_push=True,
+        )
+        # Awaits the array job as a whole. The subjobs exit with 0 even when
+        # granules failed, so the sensor only fails for a subjob that died,
+        # eg. past its walltime, and the merged report catches the rest
+        wait_for_c3_to_s3_shards = PBSJobSensor(
+            task_id=f"wait_for_c3_to_s3_shards_{product}",
+            pbs_job_id="{{ ti.xcom_pull(task_ids='%s') }}" % submit_task_id,
+            timeout=60 * 60 * 24,
+        )
+        # Merge the error reports of the shards, failing if any shard had errors
+        merge_c3_to_s3_shard_reports = SSHOperator(
+            task_id=f"merge_c3_to_s3_shard_reports_{product}",
+            command=COMMON + MERGE_SHARD_REPORTS_COMMAND,
+            params={"product": product},
+            # Merge the reports of finished shards even if one of them failed
+            trigger_rule=TriggerRule.NONE_SKIPPED,
+        )
         # Deletes working folder and uploaded script file
         clean_nci_work_dir = SSHOperator(
             task_id=f"clean_nci_work_dir_{product}",
@@ -190,7 +346,12 @@ with dag:
                 """
             ),
             params={"product": product},
+            # Needed as only one of the upload modes runs
+            trigger_rule=TriggerRule.NONE_FAILED_OR_SKIPPED,
         )
-        list_scenes >> sftp_c3_to_s3_script
-        sftp_c3_to_s3_script >> execute_c3_to_s3_script
+        list_scenes >> sftp_c3_to_s3_script >> choose_upload
+        choose_upload >> execute_c3_to_s3_script
         execute_c3_to_s3_script >> clean_nci_work_dir
+        choose_upload >> submit_c3_to_s3_shards >> wait_for_c3_to_s3_shards
+        wait_for_c3_to_s3_shards >> merge_c3_to_s3_shard_reports
+        merge_c3_to_s3_shard_reports >> clean_nci_work_dir
@@ -12,6 +12,7 @@ list. It:
 
  * Download `incorrect_metadata_in_s3.csv` from remote gist path to NCI work folder
  * Uploads `C3 to S3 rolling` script to NCI work folder.
+ * Plans the upload, failing fast if moving the files would take implausibly long.
  * Executes uploaded rolling script to upload `Collection 3` data to AWS `S3` bucket.
 
 Note: the config example:
@@ -24,6 +25,8 @@ This DAG takes following input parameters from `nci_c3_upload_s3_config` variabl
  * `s3baseurl`: Base URL of the S3. `"s3://dea-public-data"`
  * `explorerbaseurl`: Base URL of the explorer. `"https://explorer.dea.ga.gov.au"`
  * `snstopic`: ARN of the SNS topic. `"arn:aws:sns:ap-southeast-2:538673716275:dea-public-data-landsat-3"`
+ * `planbandwidth`: Optional upload bandwidth in MB/s to estimate the duration with. `100`
+ * `planmaxhours`: Optional longest estimated duration to go ahead with. `72`
 
 Note: this DAG aims to fix gap between NCI and S3. So always run with `"--force-update"` to do a fresh sync.
 
@@ -69,6 +72,12 @@ RUN_UPLOAD_SCRIPT = dedent(
             --s3baseurl '{{ var.json.nci_c3_upload_s3_config.s3baseurl }}' \
             --explorerbaseurl '{{ var.json.nci_c3_upload_s3_config.explorerbaseurl }}' \
             --snstopic '{{ var.json.nci_c3_upload_s3_config.snstopic }}' \
+            --journal '{{ work_dir }}/sync_journal.sqlite' \
+            {% if params.plan -%}
+            --plan \
+            --plan-bandwidth {{ var.json.nci_c3_upload_s3_config.get('planbandwidth', 100) }} \
+            --plan-max-hours {{ var.json.nci_c3_upload_s3_config.get('planmaxhours', 72) }} \
+            {% endif -%}
             --force-update
 """
 )
@@ -133,6 +142,18 @@ with dag:
     )
     # Execute script to upload Landsat collection 3 data to s3 bucket
     aws_hook = AwsHook(aws_conn_id=dag.default_args["aws_conn_id"], client_type="s3")
+    # Print the files, bytes and requests the upload would take, and fail
+    # before uploading anything if it's absurd
+    plan_c3_to_s3_script = SSHOperator(
+        task_id="plan_c3_to_s3_script",
+        command=COMMON + RUN_UPLOAD_SCRIPT,
+        remote_host="gadi-dm.nci.org.au",
+        params={
+            "aws_hook": aws_hook,
+            "nci_dir": "/g/data/xu18/ga/",
+            "plan": True,
+        },
+    )
     execute_c3_to_s3_script = SSHOperator(
         task_id="execute_c3_to_s3_script",
         command=COMMON + RUN_UPLOAD_SCRIPT,
@@ -140,6 +161,7 @@ with dag:
         params={
             "aws_hook": aws_hook,
             "nci_dir": "/g/data/xu18/ga/",
+            "plan": False,
         },
     )
 
@@ -157,5 +179,5 @@ with dag:
     )
 
     download_missing_csv >> sftp_c3_to_s3_script
-    sftp_c3_to_s3_script >> execute_c3_to_s3_script
+    sftp_c3_to_s3_script >> plan_c3_to_s3_script >> execute_c3_to_s3_script
     execute_c3_to_s3_script >> clean_nci_work_dir
@@ -38,6 +38,11 @@ class PBSJobSensor(SSHRunMixin, BaseSensorOperator):
     Pushes the PBS job result into XCOM for access in future Tasks. Useful for
     finding the log file path, or for recording job efficiency.
 
+    An array job is awaited through its parent, with the ``NNN[].server`` id
+    printed by ``qsub -J``. ``qstat -fx`` reports the parent under that same id,
+    finished once all of its subjobs have, with an ``Exit_status`` of 0 only if
+    every subjob exited with 0. So a single failed subjob fails the sensor.
+
     :param pbs_job_id: The PBS Job Id to await completion of (templated)
     :type pbs_job_id: str
 
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Compare the speed of the pure Python and libyaml metadata loaders and dumpers
+
+    python scripts/benchmark_metadata_io.py tests/data/*.odc-metadata.yaml
+"""
+from pathlib import Path
+
+import click
+
+from c3_to_s3_rolling import MetadataLoader, benchmark_metadata_io
+
+FIXTURES = Path(__file__).parent.parent / "tests" / "data"
+
+
+@click.command()
+@click.argument("paths", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option("--repeat", type=click.IntRange(min=1), default=20)
+def main(paths, repeat):
+    """
+    Time loading and dumping each metadata file, the test fixtures by default
+    """
+    paths = paths or sorted(FIXTURES.glob("*.yaml"))
+    click.echo(f"libyaml loader: {MetadataLoader.__name__}")
+    for name, timings in benchmark_metadata_io(paths, repeat).items():
+        click.echo(name)
+        for operation, milliseconds in timings.items():
+            click.echo(f"    {operation:<20} {milliseconds:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,34 +4,918 @@ Script to sync Collection 3 data from NCI to AWS S3 bucket
 """
 import math
 
+import asyncio
+import contextvars
 import csv
+import fnmatch
+import hashlib
 import io
+import itertools
 import json
 import logging
+import mimetypes
+import os
+import posixpath
+import queue
+import random
+import socket
+import sqlite3
 import subprocess
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial, wraps
 from pathlib import Path
 from typing import Dict
 from toolz import dicttoolz
 
-from botocore.exceptions import ClientError
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import (
+    BotoCoreError,
+    ClientError,
+    ConnectionError as BotoConnectionError,
+    HTTPClientError,
+)
 import boto3
 import click
+import yaml
 
-from eodatasets3 import verify, serialise
+from eodatasets3 import serialise
 from eodatasets3.scripts.tostac import dc_to_stac, json_fallback
+from eodatasets3.stac import validate_item
+
+# The libyaml loader and dumper are ten times faster than the pure Python ones,
+# but PyYAML may be built without libyaml
+try:
+    from yaml import CSafeDumper as MetadataDumper, CSafeLoader as MetadataLoader
+except ImportError:
+    from yaml import SafeDumper as MetadataDumper, SafeLoader as MetadataLoader
+
+# Only needed by the asyncio mode
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session as get_aio_session
+except ImportError:
+    get_aio_session = None
 
 LOG = logging.getLogger("c3_to_s3_rolling")
 
+MB = 1024 * 1024
+
+# Part size of multipart uploads, files this size or larger are uploaded in parts
+MULTIPART_CHUNKSIZE = MB * 16
+
+# Requests to upload the metadata of a granule: the ODC metadata, the STAC item
+# and the checksum file
+METADATA_UPLOAD_REQUESTS = 3
+
+# Maximum number of keys accepted by a single S3 DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+# Files which are not synced with the data, the metadata files are rewritten
+# and uploaded separately
+DEFAULT_EXCLUDE = [
+    "ga_*_nbar_*.*",
+    "ga_*_nbar-*.*",
+    "*.sha1",
+    "*.stac-item.json",
+    "*.odc-metadata.yaml",
+]
+
+# Granule being processed by the current thread, or asyncio task, so log lines
+# stay attributable
+_LOG_CONTEXT = contextvars.ContextVar("granule", default="-")
+
+# Product of that granule, which its metrics are reported under
+_PRODUCT_CONTEXT = contextvars.ContextVar("product", default="unknown")
+
+
+class GranuleLogFilter(logging.Filter):
+    """
+    Logging filter to tag records with the granule processed by the current thread or task
+    """
+
+    def filter(self, record):
+        record.granule = _LOG_CONTEXT.get()
+        return True
+
+
+def granule_product(granule):
+    """
+    :param granule: Directory of the granule relative to the NCI dir
+    :return: Name of the product, the first directory of the granule
+    """
+    return Path(granule).parts[0]
+
+
+@contextmanager
+def granule_log_context(granule, product=None):
+    """
+    Tag every log line emitted by the current thread, or asyncio task, with the
+    granule name, and every metric with its product
+
+    :param granule: Name of the granule
+    :param product: Name of the product, the first directory of the granule by default
+    """
+    token = _LOG_CONTEXT.set(str(granule))
+    product_token = _PRODUCT_CONTEXT.set(product or granule_product(granule))
+    try:
+        yield
+    finally:
+        _PRODUCT_CONTEXT.reset(product_token)
+        _LOG_CONTEXT.reset(token)
+
+
+class StatsdClient:
+    """
+    Minimal StatsD client, sending counters and timers over UDP
+
+    Metrics are named ``<prefix>.<product>.<metric>``, the product being the one
+    of the granule processed by the current thread or asyncio task, and are
+    turned into Prometheus metrics by the rules in statsd_mapping.conf. Nothing
+    is sent until an address is set, and a metric that can't be sent is dropped
+    rather than failing the sync.
+    """
+
+    def __init__(self, prefix="nci_upload"):
+        """
+        :param prefix: First component of the name of every metric
+        """
+        self.prefix = prefix
+        self.address = None
+        self._socket = None
+
+    def configure(self, setting):
+        """
+        Start sending metrics
+
+        :param setting: Address of the StatsD server, as 'host:port'
+        """
+        host, _, port = setting.rpartition(":")
+        self.address = (host, int(port))
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, metric, value, metric_type, product=None):
+        if self.address is None:
+            return
+        product = product or _PRODUCT_CONTEXT.get()
+        line = f"{self.prefix}.{product}.{metric}:{value}|{metric_type}"
+        try:
+            self._socket.sendto(line.encode("utf-8"), self.address)
+        except OSError as exception:
+            LOG.debug(f"Failed sending metric {line} - {exception}")
+
+    def incr(self, metric, value=1, product=None):
+        """
+        Add to a counter
+
+        :param metric: Name of the counter
+        :param value: Amount to add
+        :param product: Product to report it under, instead of the current one
+        """
+        self._send(metric, value, "c", product)
+
+    def timing(self, metric, seconds, product=None):
+        """
+        Report a duration
+
+        :param metric: Name of the timer
+        :param seconds: Duration in seconds
+        :param product: Product to report it under, instead of the current one
+        """
+        self._send(metric, round(seconds * 1000, 3), "ms", product)
+
+    @contextmanager
+    def timer(self, metric, product=None):
+        """
+        Report the duration of the block, whether it succeeds or not
+
+        :param metric: Name of the timer
+        :param product: Product to report it under, instead of the current one
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(metric, time.perf_counter() - start, product)
+
+    def timed(self, metric):
+        """
+        Decorator reporting the duration of every call of a function
+
+        :param metric: Name of the timer
+        """
+
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(metric):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+STATSD = StatsdClient()
+
+
+class StatsdFailureHandler(logging.Handler):
+    """
+    Logging handler counting the errors logged while processing each product
+    """
+
+    def __init__(self, level=logging.ERROR):
+        super().__init__(level)
+
+    def emit(self, record):
+        STATSD.incr("failures")
+
+
+class ClientRegistry:
+    """
+    Cache of boto3 sessions, clients and resources, one instance per thread
+
+    Building a boto3 client or resource costs tens of milliseconds, so they are
+    created once per thread, keyed by service, region and credentials, and then
+    reused. boto3 sessions and resources are not thread-safe, which is why every
+    thread gets its own.
+    """
+
+    def __init__(self, max_pool_connections=10):
+        """
+        :param max_pool_connections: Size of the connection pool of each client
+        """
+        self.max_pool_connections = max_pool_connections
+        self._local = threading.local()
+
+    def _cached(self, key, factory):
+        cache = self._local.__dict__.setdefault("cache", {})
+        if key not in cache:
+            cache[key] = factory()
+        return cache[key]
+
+    def session(self, region_name=None, **credentials):
+        """
+        Get the boto3 Session of the current thread
+
+        :param region_name: AWS region, or None for the default region
+        :param credentials: Explicit credentials, such as aws_access_key_id
+        :return: boto3 Session object
+        """
+        return self._cached(
+            ("session", region_name, tuple(sorted(credentials.items()))),
+            lambda: boto3.session.Session(region_name=region_name, **credentials),
+        )
+
+    def _config(self, max_attempts):
+        if max_attempts is None:
+            return Config(max_pool_connections=self.max_pool_connections)
+        return Config(
+            max_pool_connections=self.max_pool_connections,
+            retries={"total_max_attempts": max_attempts},
+        )
+
+    def client(self, service, region_name=None, max_attempts=None, **credentials):
+        """
+        Get a boto3 client of the current thread
+
+        :param service: Name of the AWS service, eg. 's3'
+        :param region_name: AWS region, or None for the default region
+        :param max_attempts: Number of times botocore sends each request, or None
+        for its default retries
+        :param credentials: Explicit credentials, such as aws_access_key_id
+        :return: boto3 client
+        """
+        return self._cached(
+            (
+                "client",
+                service,
+                region_name,
+                max_attempts,
+                tuple(sorted(credentials.items())),
+                self.max_pool_connections,
+            ),
+            lambda: self.session(region_name, **credentials).client(
+                service, config=self._config(max_attempts)
+            ),
+        )
+
+    def resource(self, service, region_name=None, max_attempts=None, **credentials):
+        """
+        Get a boto3 resource of the current thread
+
+        :param service: Name of the AWS service, eg. 's3'
+        :param region_name: AWS region, or None for the default region
+        :param max_attempts: Number of times botocore sends each request, or None
+        for its default retries
+        :param credentials: Explicit credentials, such as aws_access_key_id
+        :return: boto3 resource
+        """
+        return self._cached(
+            (
+                "resource",
+                service,
+                region_name,
+                max_attempts,
+                tuple(sorted(credentials.items())),
+                self.max_pool_connections,
+            ),
+            lambda: self.session(region_name, **credentials).resource(
+                service, config=self._config(max_attempts)
+            ),
+        )
+
+    def clear(self):
+        """
+        Drop the cached instances of the current thread
+        """
+        self._local.__dict__.pop("cache", None)
+
+
+# Shared by every function of the upload scripts
+CLIENTS = ClientRegistry()
+
+# Error codes, and HTTP statuses, returned when requests are sent too fast
+THROTTLING_ERRORS = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "TooManyRequestsException",
+    "503",
+    "429",
+}
+
+
+# Error codes, and HTTP statuses, of failures worth sending the request again
+TRANSIENT_ERRORS = {
+    "InternalError",
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "ServiceUnavailable",
+    "500",
+    "502",
+    "504",
+}
+
+# Clients of requests sent through an AdaptiveConcurrency are made with a single
+# attempt, so only the controller retries them, and sees every throttling error
+SINGLE_ATTEMPT = 1
+
+
+def is_throttling_error(exception):
+    """
+    :param exception: botocore exception
+    :return: True if the request was rejected for being sent too fast
+    """
+    if not isinstance(exception, ClientError):
+        return False
+    response = exception.response
+    return response.get("Error", {}).get("Code") in THROTTLING_ERRORS or response.get(
+        "ResponseMetadata", {}
+    ).get("HTTPStatusCode") in (429, 503)
+
+
+def is_transient_error(exception):
+    """
+    :param exception: botocore exception
+    :return: True if the request failed for a reason unrelated to the request
+    itself, such as a dropped connection or an internal error of the service
+    """
+    if isinstance(exception, (BotoConnectionError, HTTPClientError)):
+        return True
+    if not isinstance(exception, ClientError):
+        return False
+    response = exception.response
+    return response.get("Error", {}).get("Code") in TRANSIENT_ERRORS or response.get(
+        "ResponseMetadata", {}
+    ).get("HTTPStatusCode") in (500, 502, 504)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on the number of requests in flight to a service
+
+    Every successful request raises the limit additively, by about one request
+    per limit's worth of requests, and every throttling error halves it, at most
+    once per ``decrease_interval`` so a burst of errors from the same congestion
+    only counts once. Throttled requests are retried after a jittered
+    exponential backoff, so granules don't fail while the limit settles at the
+    highest rate the bucket partition, or topic, allows. Transient errors are
+    retried the same way, without lowering the limit.
+    """
+
+    def __init__(
+        self,
+        initial=32,
+        minimum=1,
+        maximum=256,
+        max_attempts=8,
+        base_delay=0.1,
+        max_delay=20.0,
+        decrease_interval=1.0,
+        name="requests",
+    ):
+        """
+        :param initial: Number of requests allowed in flight to start with
+        :param minimum: Lowest the limit can drop to
+        :param maximum: Highest the limit can grow to
+        :param max_attempts: Attempts of a throttled, or failed, request before
+        giving up
+        :param base_delay: Backoff of the first retry, in seconds
+        :param max_delay: Longest backoff, in seconds
+        :param decrease_interval: Seconds after halving the limit during which
+        other throttling errors don't halve it again
+        :param name: Name of the service, which its retries are counted under
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.decrease_interval = decrease_interval
+        self.name = name
+        self.in_flight = 0
+        self.throttled_count = 0
+        self._last_decrease = -math.inf
+        self._condition = threading.Condition()
+
+    def try_acquire(self):
+        """
+        Take the place of a request in flight, if the limit allows another one
+
+        :return: True if the place was taken
+        """
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        """
+        Give back the place of a request which finished
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        Wait until a request is allowed in flight, and hold its place
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.release()
+
+    def on_success(self):
+        """
+        Additive increase
+        """
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        """
+        Multiplicative decrease
+        """
+        now = time.monotonic()
+        with self._condition:
+            self.throttled_count += 1
+            if now - self._last_decrease >= self.decrease_interval:
+                self._last_decrease = now
+                self.limit = max(self.minimum, self.limit / 2)
+                LOG.warning(f"Throttled, allowing {int(self.limit)} requests in flight")
+
+    def backoff(self, attempt):
+        """
+        :param attempt: Number of the retry, from zero
+        :return: Seconds to wait before retrying, with full jitter
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def on_error(self, exception, attempt):
+        """
+        Lower the limit if a request was throttled, and check if it can be retried
+
+        :param exception: botocore exception raised by the request
+        :param attempt: Number of the attempt, from zero
+        :return: True if the request should be sent again
+        """
+        if is_throttling_error(exception):
+            self.on_throttle()
+        elif not is_transient_error(exception):
+            return False
+        if attempt < self.max_attempts - 1:
+            STATSD.incr(f"retries.{self.name}")
+            return True
+        return False
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call a boto3 method within the limit, retrying it when it's throttled
+
+        The client of the method should be made with SINGLE_ATTEMPT, or botocore
+        retries each attempt itself.
+
+        :param function: Function sending the request
+        :return: Result of the function
+        """
+        for attempt in range(self.max_attempts):
+            with self.slot():
+                try:
+                    result = function(*args, **kwargs)
+                except (BotoCoreError, ClientError) as exception:
+                    if not self.on_error(exception, attempt):
+                        raise
+                else:
+                    self.on_success()
+                    return result
+            time.sleep(self.backoff(attempt))
+
+
+# Requests in flight to S3 and SNS, shared by every granule
+S3_REQUESTS = AdaptiveConcurrency(name="s3")
+SNS_REQUESTS = AdaptiveConcurrency(name="sns")
+
+# Seconds between checks of the limit by requests waiting in the asyncio mode
+SLOT_POLL_INTERVAL = 0.1
+
+
+class SyncJournal:
+    """
+    On-disk journal of the upload stages completed for each granule
+
+    Stages are recorded in a SQLite file in the work directory as they finish,
+    so a retried run skips straight to the unfinished stages of each granule,
+    even when forcing an update. Without a path the journal is only kept in
+    memory. Records are committed at most every ``commit_interval`` seconds, as
+    every commit is a sync of the file; stages lost in a crash are just redone.
+
+    The SNS stage is recorded per action, so a granule archived after it was
+    added still gets its ARCHIVED message.
+    """
+
+    SYNCED = "synced"
+    METADATA = "metadata uploaded"
+    STAC = "stac uploaded"
+    CHECKSUM = "checksum uploaded"
+    SNS_ADDED = "sns published ADDED"
+    SNS_ARCHIVED = "sns published ARCHIVED"
+    ARCHIVED = "archived"
+    # Recorded for both actions by journals of earlier versions
+    _LEGACY_SNS = "sns published"
+
+    def __init__(self, path=":memory:", commit_interval=5.0):
+        """
+        :param path: Path of the SQLite file
+        :param commit_interval: Seconds between commits of the recorded stages
+        """
+        self.path = str(path)
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._last_commit = time.monotonic()
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS granule_stage ("
+                "granule TEXT NOT NULL, "
+                "stage TEXT NOT NULL, "
+                "completed TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                "payload TEXT, "
+                "PRIMARY KEY (granule, stage))"
+            )
+            # Granules are far more often added than archived, an archived one
+            # may send its ARCHIVED message again rather than never. Only
+            # written when needed, as another run may hold the write lock.
+            legacy = self._connection.execute(
+                "SELECT 1 FROM granule_stage WHERE stage = ? LIMIT 1",
+                (self._LEGACY_SNS,),
+            ).fetchone()
+            if legacy:
+                self._connection.execute(
+                    "UPDATE OR IGNORE granule_stage SET stage = ? WHERE stage = ?",
+                    (self.SNS_ADDED, self._LEGACY_SNS),
+                )
+
+    def completed_stages(self, granule):
+        """
+        :param granule: Name of the granule
+        :return: Set of the stages completed for the granule
+        """
+        # Looked up through the primary key index, rather than kept in memory
+        with self._lock:
+            return {
+                stage
+                for stage, in self._connection.execute(
+                    "SELECT stage FROM granule_stage WHERE granule = ?",
+                    (str(granule),),
+                )
+            }
+
+    def is_done(self, granule, stage):
+        """
+        :param granule: Name of the granule
+        :param stage: Name of the stage
+        :return: True if the stage was completed for the granule
+        """
+        return stage in self.completed_stages(granule)
+
+    def mark_done(self, granule, stage, payload=None):
+        """
+        Record a completed stage
+
+        :param granule: Name of the granule
+        :param stage: Name of the stage
+        :param payload: Text needed to finish later stages, eg. a STAC document
+        """
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO granule_stage (granule, stage, payload) "
+                "VALUES (?, ?, ?)",
+                (str(granule), stage, payload),
+            )
+            if time.monotonic() - self._last_commit >= self.commit_interval:
+                self._commit()
+
+    def _commit(self):
+        self._connection.commit()
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        """
+        Commit the stages recorded since the last commit
+        """
+        with self._lock:
+            self._commit()
+
+    def get_payload(self, granule, stage):
+        """
+        :param granule: Name of the granule
+        :param stage: Name of the stage
+        :return: Text recorded with the completed stage, or None
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT payload FROM granule_stage WHERE granule = ? AND stage = ?",
+                (str(granule), stage),
+            ).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        """
+        Commit the recorded stages and close the SQLite connection
+        """
+        self.flush()
+        self._connection.close()
+
+
+# Stages needed to complete an added or an archived granule
+ADDED_STAGES = {
+    SyncJournal.SYNCED,
+    SyncJournal.METADATA,
+    SyncJournal.STAC,
+    SyncJournal.SNS_ADDED,
+    SyncJournal.CHECKSUM,
+}
+ARCHIVED_STAGES = {SyncJournal.ARCHIVED, SyncJournal.SNS_ARCHIVED}
+
 
 def find_granules(file_path):
     """
-    Load a list of metadata files in NCI
+    Lazily read the list of metadata files in NCI
 
     :param file_path: File with metadata list
-    :return: List of granules
+    :return: Iterator of granules
     """
     with open(file_path, "r") as f:
-        return [row for row in csv.reader(f)]
+        yield from csv.reader(f)
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most ``size`` items, lazily
+
+    :param iterable: Items to split
+    :param size: Maximum number of items in each list
+    :return: Iterator of lists
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bounded_map(executor, fn, iterable, window):
+    """
+    Like ``Executor.map``, but with at most ``window`` tasks submitted at a time
+
+    The iterable is consumed lazily as tasks complete, so memory use doesn't
+    depend on its length. Results are yielded in order of completion.
+
+    :param executor: Executor to submit the tasks to
+    :param fn: Function to call with each item
+    :param iterable: Items to call the function with
+    :param window: Maximum number of tasks submitted but not yet completed
+    :return: Iterator of results
+    """
+    pending = set()
+    for item in iterable:
+        if len(pending) >= window:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(executor.submit(fn, item))
+    for future in as_completed(pending):
+        yield future.result()
+
+
+def write_json_report(path, report):
+    """
+    Write a JSON report, replacing the file in one go so readers never see half of it
+
+    :param path: Path of the report file
+    :param report: JSON serialisable report
+    """
+    partial_path = f"{path}.partial"
+    with open(partial_path, "w") as report_file:
+        json.dump(report, report_file)
+    os.replace(partial_path, path)
+
+
+class StagedPipeline:
+    """
+    Run jobs through a sequence of stages, each with its own pool of worker
+    threads and a bounded queue in front of it
+
+    A stage that falls behind fills up its queue, which blocks the stage before
+    it, and in the end the producer, so jobs are never buffered without bound.
+    The queue depths show which stage is the bottleneck, they're logged and
+    written to a JSON snapshot file every ``report_interval`` seconds.
+    """
+
+    def __init__(self, stages, queue_size=None, report_interval=60.0, report_path=None):
+        """
+        :param stages: List of (name, function, workers) tuples, the function is
+        called with each job and returns True to pass it on to the next stage
+        :param queue_size: Maximum number of jobs waiting for each stage, twice
+        the number of its workers by default
+        :param report_interval: Seconds between reporting the queue depths, or 0 to
+        only report them at the end
+        :param report_path: Path of the JSON file to write the latest snapshot of
+        the queue depths to
+        """
+        self.stages = stages
+        self.queues = [
+            queue.Queue(maxsize=queue_size or workers * 2)
+            for _name, _function, workers in stages
+        ]
+        self.report_interval = report_interval
+        self.report_path = report_path
+        self.errors = []
+        self.processed = {name: 0 for name, _function, _workers in stages}
+        self.max_depths = {name: 0 for name, _function, _workers in stages}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def depths(self):
+        """
+        :return: Number of jobs waiting for each stage, by stage name
+        """
+        return {
+            name: stage_queue.qsize()
+            for (name, _function, _workers), stage_queue in zip(
+                self.stages, self.queues
+            )
+        }
+
+    def snapshot(self):
+        """
+        :return: Dict of the workers, queue depth, highest queue depth seen and
+        number of jobs processed of each stage
+        """
+        depths = self.depths()
+        with self._lock:
+            return {
+                "time": time.time(),
+                "stages": {
+                    name: {
+                        "workers": workers,
+                        "depth": depths[name],
+                        "max_depth": self.max_depths[name],
+                        "processed": self.processed[name],
+                    }
+                    for name, _function, workers in self.stages
+                },
+            }
+
+    def report(self):
+        """
+        Log a snapshot of the queue depths, and write it to the report file
+        """
+        snapshot = self.snapshot()
+        LOG.info(f"Pipeline queue depths - {json.dumps(snapshot['stages'])}")
+        if self.report_path is not None:
+            write_json_report(self.report_path, snapshot)
+
+    def _put(self, index, job):
+        # Blocks while the stage is behind
+        stage_queue = self.queues[index]
+        stage_queue.put(job)
+        name = self.stages[index][0]
+        depth = stage_queue.qsize()
+        with self._lock:
+            self.max_depths[name] = max(self.max_depths[name], depth)
+
+    def _work(self, index):
+        name, function, _workers = self.stages[index]
+        stage_queue = self.queues[index]
+        while True:
+            job = stage_queue.get()
+            if job is None:
+                return
+            try:
+                forward = function(job)
+            except Exception as exp:
+                # Keep the stage running for the other jobs
+                LOG.exception(f"Unexpected error in the {name} stage")
+                job["errors"].append(f"Unexpected error in the {name} stage - {exp}")
+                forward = False
+            with self._lock:
+                self.processed[name] += 1
+            if forward and index + 1 < len(self.queues):
+                self._put(index + 1, job)
+            else:
+                with self._lock:
+                    self.errors.extend(job["errors"])
+
+    def _report(self):
+        while not self._stopped.wait(self.report_interval):
+            self.report()
+
+    def run(self, jobs):
+        """
+        Put each job through the stages, returning once all of them are done
+
+        :param jobs: Iterable of dicts, with a list of errors under "errors"
+        :return: Number of jobs
+        """
+        workers = [
+            [
+                threading.Thread(
+                    target=self._work, args=(index,), name=f"{name}_{number}"
+                )
+                for number in range(stage_workers)
+            ]
+            for index, (name, _function, stage_workers) in enumerate(self.stages)
+        ]
+        for stage_workers in workers:
+            for worker in stage_workers:
+                worker.start()
+        reporter = None
+        if self.report_interval:
+            reporter = threading.Thread(target=self._report, daemon=True)
+            reporter.start()
+
+        jobs_count = 0
+        try:
+            for job in jobs:
+                self._put(0, job)
+                jobs_count += 1
+        finally:
+            # Stop the stages in order, so each one drains the jobs of the last
+            for stage_queue, stage_workers in zip(self.queues, workers):
+                for _worker in stage_workers:
+                    stage_queue.put(None)
+                for worker in stage_workers:
+                    worker.join()
+            self._stopped.set()
+            if reporter is not None:
+                reporter.join()
+            self.report()
+        return jobs_count
 
 
 def check_granule_exists(_s3_bucket, s3_metadata_path, session=None):
@@ -44,7 +928,7 @@ def check_granule_exists(_s3_bucket, s3_metadata_path, session=None):
     :return: True if success else False
     """
     if session is None:
-        s3_resource = boto3.resource("s3")
+        s3_resource = CLIENTS.resource("s3")
     else:
         s3_resource = session.resource("s3")
 
@@ -54,12 +938,151 @@ def check_granule_exists(_s3_bucket, s3_metadata_path, session=None):
     except ClientError as exception:
         if exception.response["Error"]["Code"] == "404":
             return False
+    except BotoCoreError as exception:
+        # Unreachable S3, or no credentials, fail the granule rather than the run
+        raise S3SyncException(
+            f"Failed checking s3://{_s3_bucket}/{s3_metadata_path} - {exception}"
+        )
     else:
         return True
 
 
+def common_prefixes(keys, group_depth=1, min_granules=2):
+    """
+    Find a minimal set of prefixes to list, which cover the directories of the
+    given keys that are worth listing
+
+    The directories of the keys are grouped by their ancestor ``group_depth``
+    levels up, or all in one group when it's None, and each group is covered by
+    the longest prefix its directories have in common. A LIST request costs
+    more than a HEAD request, so groups of fewer than ``min_granules``
+    directories are left out, for a HEAD request of each of their keys.
+
+    :param keys: S3 keys
+    :param group_depth: Number of directory levels that granules in one group
+    may differ by, None to group the whole batch under its deepest shared prefix
+    :param min_granules: Smallest number of directories of a group worth listing
+    :return: Sorted list of prefixes, ending with a '/'
+    """
+    groups = {}
+    for key in keys:
+        directory = posixpath.dirname(key)
+        if group_depth is None:
+            ancestor = ""
+        elif group_depth:
+            ancestor = directory.rsplit("/", group_depth)[0]
+        else:
+            ancestor = directory
+        groups.setdefault(ancestor, set()).add(directory)
+
+    prefixes = []
+    for directories in groups.values():
+        if len(directories) < min_granules:
+            continue
+        prefix = posixpath.commonpath(list(directories))
+        # Keys sharing no directory would list the whole bucket
+        if prefix:
+            prefixes.append(f"{prefix}/")
+    return sorted(prefixes)
+
+
+class S3ExistenceIndex:
+    """
+    In-memory index of which keys exist in an S3 bucket
+
+    Rather than one HEAD request per granule, the keys of a whole batch of
+    granules are grouped by common prefix and each prefix is listed once with
+    ListObjectsV2. Only the requested keys that were found are kept, so the
+    index stays small however many objects share the prefixes.
+
+    Keys which were not part of the batch, or whose group has too few granules
+    to be worth listing, fall back to a HEAD request, which are counted in
+    ``request_count`` too.
+    """
+
+    def __init__(self, s3_bucket, keys, group_depth=1, min_granules=2):
+        """
+        :param s3_bucket: Name of the S3 bucket
+        :param keys: S3 keys whose existence will be looked up
+        :param group_depth: Number of directory levels that granules listed
+        together may differ by, None to list the whole batch under its deepest
+        shared prefix
+        :param min_granules: Smallest number of granules worth a listing
+        """
+        self.s3_bucket = s3_bucket
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+        wanted = set(keys)
+        prefixes = common_prefixes(wanted, group_depth, min_granules)
+        self._covered_directories = {
+            posixpath.dirname(key)
+            for key in wanted
+            if any(key.startswith(prefix) for prefix in prefixes)
+        }
+        self._existing = set()
+
+        paginator = CLIENTS.client("s3").get_paginator("list_objects_v2")
+        for prefix in prefixes:
+            try:
+                for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix):
+                    self.request_count += 1
+                    self._existing.update(
+                        obj["Key"]
+                        for obj in page.get("Contents", [])
+                        if obj["Key"] in wanted
+                    )
+            except (BotoCoreError, ClientError) as exception:
+                # Leave the keys of this prefix to a HEAD request each
+                LOG.warning(f"Failed listing s3://{s3_bucket}/{prefix} - {exception}")
+                self._covered_directories.difference_update(
+                    directory
+                    for directory in list(self._covered_directories)
+                    if f"{directory}/".startswith(prefix)
+                )
+
+    def covers(self, key):
+        """
+        :param key: S3 key
+        :return: True if the key can be looked up without a HEAD request
+        """
+        return posixpath.dirname(key) in self._covered_directories
+
+    def exists(self, key):
+        """
+        Check if a key exists in the bucket
+
+        :param key: S3 key
+        :return: True if the key exists
+        """
+        if self.covers(key):
+            return key in self._existing
+        with self._lock:
+            self.request_count += 1
+        return check_granule_exists(self.s3_bucket, key)
+
+
+def granule_exists(s3_bucket, s3_metadata_path, existence_index=None):
+    """
+    Check if granule already exists in S3 bucket, using the index when available
+
+    :param s3_bucket: Name of s3 bucket to store granules
+    :param s3_metadata_path: Path of metadata file
+    :param existence_index: S3ExistenceIndex built for the batch of granules
+    :return: True if the metadata file exists
+    """
+    if existence_index is not None:
+        return existence_index.exists(s3_metadata_path)
+    return check_granule_exists(s3_bucket, s3_metadata_path)
+
+
 def upload_s3_resource(
-    s3_bucket, s3_file, obj, session=None, content_type="binary/octet-stream"
+    s3_bucket,
+    s3_file,
+    obj,
+    session=None,
+    content_type="binary/octet-stream",
+    acl=None,
 ):
     """
     Upload s3 resource object in provided s3 path
@@ -68,16 +1091,29 @@ def upload_s3_resource(
     :param s3_file: Path of metadata file
     :param obj: Resource object to upload
     :param session: boto3 Session object
+    :param content_type: Content type of the object
+    :param acl: Canned ACL of the object, eg. 'bucket-owner-full-control'
     """
+    extra_args = {"ACL": acl} if acl else {}
+
+    def put():
+        # Retries send the body again from the start
+        if hasattr(obj, "seek"):
+            obj.seek(0)
+        s3_resource.Object(key=s3_file).put(
+            Body=obj, ContentType=content_type, **extra_args
+        )
+
     try:
         if session is None:
-            s3_resource = boto3.resource("s3").Bucket(s3_bucket)
+            s3_resource = CLIENTS.resource("s3", max_attempts=SINGLE_ATTEMPT)
+            s3_resource = s3_resource.Bucket(s3_bucket)
         else:
             s3_resource = session.resource("s3").Bucket(s3_bucket)
-        s3_resource.Object(key=s3_file).put(Body=obj, ContentType=content_type)
+        S3_REQUESTS.call(put)
     except ValueError as exception:
         raise S3SyncException(str(exception))
-    except ClientError as exception:
+    except (BotoCoreError, ClientError) as exception:
         raise S3SyncException(str(exception))
 
 
@@ -90,12 +1126,12 @@ def load_s3_resource(s3_bucket, s3_file):
     :return obj: Resource object to download
     """
     try:
-        s3_resource = boto3.resource("s3").Bucket(s3_bucket)
-        obj = s3_resource.Object(key=s3_file)
-        return obj.get()["Body"]
+        s3_resource = CLIENTS.resource("s3", max_attempts=SINGLE_ATTEMPT)
+        obj = s3_resource.Bucket(s3_bucket).Object(key=s3_file)
+        return S3_REQUESTS.call(obj.get)["Body"]
     except ValueError as exception:
         raise S3SyncException(str(exception))
-    except ClientError as exception:
+    except (BotoCoreError, ClientError) as exception:
         raise S3SyncException(str(exception))
 
 
@@ -110,91 +1146,560 @@ def publish_sns(sns_topic, message, message_attributes, session=None):
     """
     try:
         if session is None:
-            sns_client = boto3.client("sns")
+            sns_client = CLIENTS.client("sns", max_attempts=SINGLE_ATTEMPT)
         else:
             sns_client = session.client("sns")
-        sns_client.publish(
-            TopicArn=sns_topic, Message=message, MessageAttributes=message_attributes
-        )
-    except ClientError as exception:
+        with STATSD.timer("duration.sns"):
+            SNS_REQUESTS.call(
+                sns_client.publish,
+                TopicArn=sns_topic,
+                Message=message,
+                MessageAttributes=message_attributes,
+            )
+    except (BotoCoreError, ClientError) as exception:
         raise S3SyncException(str(exception))
 
 
-def upload_checksum(
-    nci_metadata_file_path,
-    checksum_file_path,
-    new_checksum_list,
-    s3_bucket,
-    s3_path,
-    session=None,
-    excluded_pattern=["ga_*_nbar_*.*"],
-):
+class BatchPublisher:
     """
-    Updates and uploads checksum file
+    Buffer SNS messages and publish them to a topic with PublishBatch
 
-    :param nci_metadata_file_path: Path of metadata file
-    :param checksum_file_path: Path of checksum file
-    :param new_checksum_list: List of filename and updated checksum
-    :param s3_bucket: Name of the S3 bucket
-    :param s3_path: Path of the S3 bucket
-    :param session: boto3 Session object
-    :param excluded_pattern: a list of file patterns to exclude from the checksum
+    Messages are sent in batches of up to ten, once a batch is full, would go
+    over the SNS payload limit, or its oldest message has waited ``max_wait``
+    seconds. Only the entries which failed, or batches still throttled after
+    the retries of SNS_REQUESTS, are sent again, and those still failing are
+    collected in ``errors``, as are messages over the payload limit by themselves. With a botocore too old for PublishBatch, the
+    messages of each batch are published one at a time.
     """
 
-    # Identify list of files to be included in checksum file
-    excluded_files = []
-    excluded_pattern.extend(
-        [
-            nci_metadata_file_path.name,
-            checksum_file_path.name,
-        ]
-    )
+    MAX_BATCH_SIZE = 10
+    # SNS limits the total payload of a batch, messages and attributes
+    MAX_BATCH_BYTES = 256 * 1024
 
-    for ex_pat in excluded_pattern:
-        for path in checksum_file_path.parent.glob(ex_pat):
-            excluded_files.append(path.name)
+    def __init__(self, sns_topic, max_wait=1.0, max_attempts=3):
+        """
+        :param sns_topic: ARN of the SNS Topic
+        :param max_wait: Seconds a message may wait in the buffer, or 0 to send
+        every message as soon as it's published
+        :param max_attempts: Number of times a failed, or throttled, entry is sent
+        """
+        self.sns_topic = sns_topic
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.errors = []
 
-    # Read checksum for files to be included
-    with checksum_file_path.open("r") as f:
-        for hash_, filename in [line.strip().split("\t") for line in f.readlines()]:
-            if filename not in excluded_files:
-                new_checksum_list[filename] = hash_
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._oldest = None
+        self._ids = itertools.count()
+        self._closed = threading.Event()
+        self._flusher = None
+        if max_wait > 0:
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, name="sns-flusher", daemon=True
+            )
+            self._flusher.start()
 
-    # Write checksum to buffer
-    with io.BytesIO() as temp_checksum:
-        temp_checksum.writelines(
-            f"{str(hash_)}\t{str(filename)}\n".encode("utf-8")
-            for filename, hash_ in sorted(new_checksum_list.items())
+    @staticmethod
+    def _entry_size(message, message_attributes):
+        return len(message.encode("utf-8")) + sum(
+            len(name) + len(value["DataType"]) + len(value["StringValue"])
+            for name, value in message_attributes.items()
         )
 
-        # Write checksum sha1 object into S3
-        s3_checksum_file = f"{s3_path}/{checksum_file_path.name}"
-        upload_s3_resource(
-            s3_bucket,
-            s3_checksum_file,
-            temp_checksum.getvalue(),
-            session=session,
-            content_type="text/plain",
-        )
+    def publish(self, message, message_attributes, on_success=None):
+        """
+        Add a message to the buffer, sending the batch if it is full
 
+        :param message: SNS message
+        :param message_attributes: SNS message attributes
+        :param on_success: Function called once the message is published
+        """
+        pending = {
+            "entry": {
+                "Id": str(next(self._ids)),
+                "Message": message,
+                "MessageAttributes": message_attributes,
+            },
+            "size": self._entry_size(message, message_attributes),
+            "on_success": on_success,
+            "granule": _LOG_CONTEXT.get(),
+        }
+        if pending["size"] > self.MAX_BATCH_BYTES:
+            self._fail(
+                pending,
+                f"Message of {pending['size']} bytes is over the SNS limit of "
+                f"{self.MAX_BATCH_BYTES} bytes",
+            )
+            return
 
-def get_common_message_attributes(stac_doc: Dict) -> Dict:
-    """
-    Returns common message attributes dict
-    :param stac_doc: STAC dict
-    :return: common message attributes dict
-    """
-    msg_attributes = {}
+        batches = []
+        with self._lock:
+            if (
+                self._buffer
+                and self._buffer_bytes + pending["size"] > self.MAX_BATCH_BYTES
+            ):
+                batches.append(self._take_buffer())
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append(pending)
+            self._buffer_bytes += pending["size"]
+            if len(self._buffer) >= self.MAX_BATCH_SIZE or self._flusher is None:
+                batches.append(self._take_buffer())
+        for batch in batches:
+            self._send(batch)
 
-    product = dicttoolz.get_in(["properties", "odc:product"], stac_doc)
-    if product:
-        msg_attributes["product"] = {
-            "DataType": "String",
-            "StringValue": product,
-        }
+    def _take_buffer(self):
+        batch, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        return batch
 
-    datetime = dicttoolz.get_in(["properties", "datetime"], stac_doc)
-    if datetime:
+    def flush(self):
+        """
+        Send the buffered messages now
+        """
+        with self._lock:
+            batch = self._take_buffer()
+        if batch:
+            self._send(batch)
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.max_wait / 2):
+            with self._lock:
+                expired = (
+                    self._buffer and time.monotonic() - self._oldest >= self.max_wait
+                )
+            if expired:
+                self.flush()
+
+    def _succeed(self, pending):
+        with granule_log_context(pending["granule"]):
+            LOG.info(f"Finished publishing SNS Message to SNS Topic {self.sns_topic}")
+            if pending["on_success"] is not None:
+                pending["on_success"]()
+
+    def _send_each(self, batch):
+        for pending in batch:
+            entry = pending["entry"]
+            try:
+                publish_sns(
+                    self.sns_topic, entry["Message"], entry["MessageAttributes"]
+                )
+            except S3SyncException as exception:
+                self._fail(pending, exception)
+            else:
+                self._succeed(pending)
+
+    def _send(self, batch):
+        sns_client = CLIENTS.client("sns", max_attempts=SINGLE_ATTEMPT)
+        if not hasattr(sns_client, "publish_batch"):
+            # PublishBatch was added in botocore 1.23
+            self._send_each(batch)
+            return
+
+        remaining = {pending["entry"]["Id"]: pending for pending in batch}
+        failures = {}
+        # Flushed batches aren't sent in the context of a granule
+        product = granule_product(batch[0]["granule"])
+        for attempt in range(self.max_attempts):
+            if attempt:
+                STATSD.incr("retries.sns", product=product)
+                time.sleep(SNS_REQUESTS.backoff(attempt))
+            try:
+                with STATSD.timer("duration.sns", product=product):
+                    response = SNS_REQUESTS.call(
+                        sns_client.publish_batch,
+                        TopicArn=self.sns_topic,
+                        PublishBatchRequestEntries=[
+                            pending["entry"] for pending in remaining.values()
+                        ],
+                    )
+            except (BotoCoreError, ClientError) as exception:
+                # Connection errors too, the batch is already out of the buffer
+                failures = {entry_id: str(exception) for entry_id in remaining}
+                # SNS_REQUESTS already retried the other transient errors
+                if is_throttling_error(exception):
+                    continue
+                break
+
+            for success in response.get("Successful", []):
+                self._succeed(remaining.pop(success["Id"]))
+
+            failures = {
+                entry_id: "Missing from the PublishBatch response"
+                for entry_id in remaining
+            }
+            for failure in response.get("Failed", []):
+                failures[
+                    failure["Id"]
+                ] = f"{failure['Code']} {failure.get('Message', '')}".strip()
+                if failure["Code"] in THROTTLING_ERRORS:
+                    SNS_REQUESTS.on_throttle()
+                # Don't retry requests which can never succeed
+                if failure.get("SenderFault"):
+                    self._fail(remaining.pop(failure["Id"]), failures[failure["Id"]])
+            if not remaining:
+                return
+
+        for entry_id, pending in remaining.items():
+            self._fail(pending, failures[entry_id])
+
+    def _fail(self, pending, reason):
+        with granule_log_context(pending["granule"]):
+            message = (
+                f"Failed publishing SNS Message for {pending['granule']} "
+                f"to SNS Topic {self.sns_topic} - {reason}"
+            )
+            LOG.error(message)
+        with self._lock:
+            self.errors.append(message)
+
+    def close(self):
+        """
+        Stop the periodic flush and send the remaining messages
+        """
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+
+def load_metadata(metadata_file_path, loader=MetadataLoader):
+    """
+    Parse a metadata yaml file, with libyaml when it's available
+
+    :param metadata_file_path: Path of the metadata file
+    :param loader: PyYAML loader class
+    :return: Metadata dict
+    """
+    with Path(metadata_file_path).open("rb") as f:
+        return yaml.load(f, Loader=loader)
+
+
+def dump_metadata(metadata_doc, dumper=MetadataDumper):
+    """
+    Serialise a plain metadata dict to yaml, with libyaml when it's available
+
+    :param metadata_doc: Metadata dict
+    :param dumper: PyYAML dumper class
+    :return: Metadata yaml
+    """
+    return yaml.dump(metadata_doc, Dumper=dumper, default_flow_style=False)
+
+
+def benchmark_metadata_io(metadata_file_paths, repeat=20):
+    """
+    Time loading and dumping metadata files with the pure Python and the libyaml
+    loaders and dumpers, and with the eodatasets3 serialiser
+
+    :param metadata_file_paths: Paths of the metadata files
+    :param repeat: Number of times each file is loaded and dumped
+    :return: Dict of path name to dict of operation to milliseconds per call
+    """
+
+    def timed(function):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        return (time.perf_counter() - start) * 1000 / repeat
+
+    results = {}
+    for path in map(Path, metadata_file_paths):
+        doc = load_metadata(path)
+        results[path.name] = {
+            "load eodatasets3": timed(partial(serialise.load_yaml, path)),
+            "load python": timed(partial(load_metadata, path, yaml.SafeLoader)),
+            "load libyaml": timed(partial(load_metadata, path, MetadataLoader)),
+            "dump python": timed(partial(dump_metadata, doc, yaml.SafeDumper)),
+            "dump libyaml": timed(partial(dump_metadata, doc, MetadataDumper)),
+        }
+    return results
+
+
+class StacTemplateCache:
+    """
+    Per-product record of the STAC item layouts already validated
+
+    Every STAC item is created once, and validated against its JSON schemas.
+    Validating costs far more than creating the item, and every granule of a
+    product has the same extensions, assets, links and property keys. So with
+    ``validate_known_layouts`` off, items are only validated when their layout
+    differs from the ones already validated for the product, and the values of
+    the others aren't checked.
+    """
+
+    def __init__(self, validate_known_layouts=True):
+        """
+        :param validate_known_layouts: Validate the items whose layout was
+        already validated for their product too
+        """
+        self.validate_known_layouts = validate_known_layouts
+        self._layouts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def layout(item_doc):
+        """
+        :param item_doc: STAC item dict
+        :return: The parts of a STAC item that are the same for a whole product
+        """
+        return (
+            tuple(item_doc.get("stac_extensions", [])),
+            tuple(sorted(item_doc["properties"])),
+            tuple(
+                sorted(
+                    (name, asset.get("type"), tuple(asset.get("roles", [])))
+                    for name, asset in item_doc["assets"].items()
+                )
+            ),
+            tuple(
+                sorted(
+                    (link["rel"], link.get("type", ""))
+                    for link in item_doc.get("links", [])
+                )
+            ),
+        )
+
+    def to_stac(
+        self, dataset, input_metadata, output_path, stac_base_url, explorer_base_url
+    ):
+        """
+        Convert an eo3 dataset to a STAC item, and validate it
+
+        :param dataset: eo3 DatasetDoc
+        :param input_metadata: Path of the eo3 metadata file
+        :param output_path: Path of the STAC item file
+        :param stac_base_url: Base URL the STAC item is uploaded to
+        :param explorer_base_url: Base URL of the Explorer
+        :return: STAC item dict
+        """
+        item_doc = dc_to_stac(
+            dataset,
+            input_metadata,
+            output_path,
+            stac_base_url,
+            explorer_base_url,
+            False,
+        )
+        product = dataset.product.name if dataset.product else None
+        layout = self.layout(item_doc)
+        with self._lock:
+            known = layout in self._layouts.get(product, set())
+        if self.validate_known_layouts or not known:
+            # Raises if the item isn't valid
+            validate_item(item_doc)
+            with self._lock:
+                self._layouts.setdefault(product, set()).add(layout)
+        return item_doc
+
+
+STAC_TEMPLATES = StacTemplateCache()
+
+
+def dump_stac(item_doc, pretty=True):
+    """
+    Serialise a STAC item
+
+    :param item_doc: STAC item dict
+    :param pretty: Indent the JSON for people to read, or make it compact
+    :return: STAC item JSON
+    """
+    if pretty:
+        return json.dumps(item_doc, indent=4, default=json_fallback)
+    return json.dumps(item_doc, separators=(",", ":"), default=json_fallback)
+
+
+class HashingWriter(io.BytesIO):
+    """
+    In-memory binary buffer which computes the sha1 of the data as it is written
+
+    Documents serialised into it are hashed in the same pass, and the buffer
+    itself is handed to the uploader, so the bytes are never re-read or copied.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self._sha1.update(data)
+        return super().write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def hexdigest(self):
+        """
+        :return: sha1 of everything written, as in a checksum file
+        """
+        return self._sha1.hexdigest()
+
+    def rewind(self):
+        """
+        Seek back to the start of the buffer, ready to be uploaded
+
+        :return: The buffer
+        """
+        self.seek(0)
+        return self
+
+
+def parse_checksums(lines):
+    """
+    Parse the lines of a checksum file, as written by eodatasets
+
+    :param lines: Lines of the checksum file
+    :return: Dict of filename to sha1
+    """
+    checksums = {}
+    for line in lines:
+        if line.strip():
+            hash_, filename = line.strip().split("\t")
+            checksums[filename] = hash_
+    return checksums
+
+
+def get_checksum_file_path(nci_metadata_file_path):
+    """
+    :param nci_metadata_file_path: Path of metadata file
+    :return: Path of the checksum file next to it
+    """
+    checksum_filename = nci_metadata_file_path.stem.replace(".odc-metadata", "")
+    return nci_metadata_file_path.with_name(f"{checksum_filename}.sha1")
+
+
+def read_checksum_file(checksum_file_path):
+    """
+    Parse a checksum file, as written by eodatasets
+
+    :param checksum_file_path: Path of checksum file
+    :return: Dict of filename to sha1
+    """
+    with Path(checksum_file_path).open("r") as f:
+        return parse_checksums(f)
+
+
+def read_s3_checksum_file(s3_bucket, s3_checksum_file):
+    """
+    Parse a checksum file uploaded to S3
+
+    :param s3_bucket: Name of the S3 bucket
+    :param s3_checksum_file: Path of checksum file in S3
+    :return: Dict of filename to sha1, empty if there is no checksum file
+    """
+    try:
+        s3_client = CLIENTS.client("s3", max_attempts=SINGLE_ATTEMPT)
+        body = S3_REQUESTS.call(
+            s3_client.get_object, Bucket=s3_bucket, Key=s3_checksum_file
+        )
+    except ClientError as exception:
+        if exception.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return {}
+        raise S3SyncException(str(exception))
+    except BotoCoreError as exception:
+        raise S3SyncException(str(exception))
+    return parse_checksums(body["Body"].read().decode("utf-8").splitlines())
+
+
+def build_checksum_file(
+    nci_metadata_file_path,
+    checksum_file_path,
+    new_checksum_list,
+    excluded_pattern=("ga_*_nbar_*.*",),
+    checksums=None,
+):
+    """
+    Updates the checksum file with the rewritten metadata files
+
+    :param nci_metadata_file_path: Path of metadata file
+    :param checksum_file_path: Path of checksum file
+    :param new_checksum_list: List of filename and updated checksum
+    :param excluded_pattern: a list of file patterns to exclude from the checksum
+    :param checksums: Checksum file already parsed by read_checksum_file
+    :return: HashingWriter holding the checksum file
+    """
+    if checksums is None:
+        checksums = read_checksum_file(checksum_file_path)
+
+    # Identify list of files to be included in checksum file, the patterns
+    # only apply to files at the top of the granule directory
+    excluded_pattern = [
+        *excluded_pattern,
+        nci_metadata_file_path.name,
+        checksum_file_path.name,
+    ]
+    new_checksum_list = dict(new_checksum_list)
+    for filename, hash_ in checksums.items():
+        if "/" in filename or not is_excluded(filename, excluded_pattern):
+            new_checksum_list[filename] = hash_
+
+    # Write checksum to buffer
+    temp_checksum = HashingWriter()
+    temp_checksum.writelines(
+        f"{str(hash_)}\t{str(filename)}\n".encode("utf-8")
+        for filename, hash_ in sorted(new_checksum_list.items())
+    )
+    return temp_checksum.rewind()
+
+
+def upload_checksum(
+    nci_metadata_file_path,
+    checksum_file_path,
+    new_checksum_list,
+    s3_bucket,
+    s3_path,
+    session=None,
+    excluded_pattern=("ga_*_nbar_*.*",),
+    checksums=None,
+):
+    """
+    Updates and uploads checksum file
+
+    :param nci_metadata_file_path: Path of metadata file
+    :param checksum_file_path: Path of checksum file
+    :param new_checksum_list: List of filename and updated checksum
+    :param s3_bucket: Name of the S3 bucket
+    :param s3_path: Path of the S3 bucket
+    :param session: boto3 Session object
+    :param excluded_pattern: a list of file patterns to exclude from the checksum
+    :param checksums: Checksum file already parsed by read_checksum_file
+    """
+    with build_checksum_file(
+        nci_metadata_file_path,
+        checksum_file_path,
+        new_checksum_list,
+        excluded_pattern=excluded_pattern,
+        checksums=checksums,
+    ) as temp_checksum:
+        # Write checksum sha1 object into S3
+        s3_checksum_file = f"{s3_path}/{checksum_file_path.name}"
+        upload_s3_resource(
+            s3_bucket,
+            s3_checksum_file,
+            temp_checksum,
+            session=session,
+            content_type="text/plain",
+        )
+
+
+def get_common_message_attributes(stac_doc: Dict) -> Dict:
+    """
+    Returns common message attributes dict
+    :param stac_doc: STAC dict
+    :return: common message attributes dict
+    """
+    msg_attributes = {}
+
+    product = dicttoolz.get_in(["properties", "odc:product"], stac_doc)
+    if product:
+        msg_attributes["product"] = {
+            "DataType": "String",
+            "StringValue": product,
+        }
+
+    datetime = dicttoolz.get_in(["properties", "datetime"], stac_doc)
+    if datetime:
         msg_attributes["datetime"] = {
             "DataType": "String",
             "StringValue": datetime,
@@ -233,227 +1738,1890 @@ def get_common_message_attributes(stac_doc: Dict) -> Dict:
             "StringValue": str(bbox[3]),
         }
 
-    gqa_iterative_mean_xy = dicttoolz.get_in(
-        ["properties", "gqa:iterative_mean_xy"], stac_doc
-    )
-    if gqa_iterative_mean_xy and not math.isnan(gqa_iterative_mean_xy):
-        msg_attributes["gqa_iterative_mean_xy"] = {
-            "DataType": "Number",
-            "StringValue": str(gqa_iterative_mean_xy),
-        }
+    gqa_iterative_mean_xy = dicttoolz.get_in(
+        ["properties", "gqa:iterative_mean_xy"], stac_doc
+    )
+    if gqa_iterative_mean_xy and not math.isnan(gqa_iterative_mean_xy):
+        msg_attributes["gqa_iterative_mean_xy"] = {
+            "DataType": "Number",
+            "StringValue": str(gqa_iterative_mean_xy),
+        }
+
+    return msg_attributes
+
+
+@STATSD.timed("duration.metadata")
+def generate_metadata(
+    nci_metadata_file_path, s3_path, s3_base_url, explorer_base_url, compact_stac=False
+):
+    """
+    Rewrite the metadata yaml with the nbar elements removed, and create the
+    STAC doc and SNS message, without touching S3
+
+    :param nci_metadata_file_path: Path of metadata file in NCI
+    :param s3_path: Path in S3
+    :param s3_base_url: Base URL of the S3 bucket
+    :param explorer_base_url: Base URL of the explorer
+    :param compact_stac: Serialise the STAC doc without indentation
+    :return: Dict of the documents to upload, as rewound HashingWriters, and to
+    publish, their S3 keys, and their sha1 for the checksum file
+    """
+    temp_metadata = load_metadata(nci_metadata_file_path)
+
+    # Deleting Nbar related metadata
+    # Because Landsat 8 is different, we need to check if the fields exist
+    # before removing them.
+    if "nbar_blue" in temp_metadata["measurements"]:
+        del temp_metadata["measurements"]["nbar_blue"]
+    if "nbar_green" in temp_metadata["measurements"]:
+        del temp_metadata["measurements"]["nbar_green"]
+    if "nbar_nir" in temp_metadata["measurements"]:
+        del temp_metadata["measurements"]["nbar_nir"]
+    if "nbar_red" in temp_metadata["measurements"]:
+        del temp_metadata["measurements"]["nbar_red"]
+    if "nbar_swir_1" in temp_metadata["measurements"]:
+        del temp_metadata["measurements"]["nbar_swir_1"]
+    if "nbar_swir_2" in temp_metadata["measurements"]:
+        del temp_metadata["measurements"]["nbar_swir_2"]
+    if "nbar_coastal_aerosol" in temp_metadata["measurements"]:
+        del temp_metadata["measurements"]["nbar_coastal_aerosol"]
+    if "nbar_panchromatic" in temp_metadata["measurements"]:
+        del temp_metadata["measurements"]["nbar_panchromatic"]
+    if "oa_nbar_contiguity" in temp_metadata["measurements"]:
+        del temp_metadata["measurements"]["oa_nbar_contiguity"]
+    if "thumbnail:nbar" in temp_metadata["accessories"]:
+        del temp_metadata["accessories"]["thumbnail:nbar"]
+
+    # Format an eo3 dataset dict for human-readable yaml serialisation.
+    temp_metadata = serialise.prepare_formatting(temp_metadata)
+
+    # Dump metadata yaml into buffer, hashing it as it's written
+    temp_yaml = HashingWriter()
+    serialise.dumps_yaml(temp_yaml, temp_metadata)
+
+    # Create stac metadata
+    name = nci_metadata_file_path.stem.replace(".odc-metadata", "")
+    stac_output_file_path = nci_metadata_file_path.with_name(f"{name}.stac-item.json")
+    stac_url_path = f"{s3_base_url if s3_base_url else CLIENTS.client('s3').meta.endpoint_url}/{s3_path}/"
+    item_doc = STAC_TEMPLATES.to_stac(
+        serialise.from_doc(temp_metadata),
+        nci_metadata_file_path,
+        stac_output_file_path,
+        stac_url_path,
+        explorer_base_url,
+    )
+    stac_dump = dump_stac(item_doc, pretty=not compact_stac)
+    temp_stac = HashingWriter()
+    temp_stac.write(stac_dump.encode())
+    # Nobody reads the SNS message, so it's always compact
+    message = stac_dump if compact_stac else dump_stac(item_doc, pretty=False)
+
+    message_attributes = get_common_message_attributes(json.loads(message))
+    message_attributes.update(
+        {"action": {"DataType": "String", "StringValue": "ADDED"}}
+    )
+
+    return {
+        "metadata": temp_yaml.rewind(),
+        "s3_metadata_file": f"{s3_path}/{nci_metadata_file_path.name}",
+        "stac": temp_stac.rewind(),
+        "s3_stac_file": f"{s3_path}/{stac_output_file_path.name}",
+        "message": message,
+        "message_attributes": message_attributes,
+        "checksums": {
+            nci_metadata_file_path.name: temp_yaml.hexdigest(),
+            stac_output_file_path.name: temp_stac.hexdigest(),
+        },
+    }
+
+
+class BlockingRequests:
+    """
+    Carry out the operations yielded by the ``*_steps`` generators on the calling
+    thread, with the boto3 helpers
+    """
+
+    @staticmethod
+    def run(function):
+        """
+        :param function: Blocking function to call, without arguments
+        :return: Result of the function
+        """
+        return function()
+
+    @staticmethod
+    def exists(s3_bucket, s3_key, existence_index=None):
+        """
+        :return: True if the key exists
+        """
+        return granule_exists(s3_bucket, s3_key, existence_index)
+
+    @staticmethod
+    def put(s3_bucket, s3_key, body, content_type):
+        """
+        Upload an object
+        """
+        upload_s3_resource(s3_bucket, s3_key, body, content_type=content_type)
+
+    @staticmethod
+    def read_s3_checksum_file(s3_bucket, s3_checksum_file):
+        """
+        :return: Dict of filename to sha1, empty if there is no checksum file
+        """
+        return read_s3_checksum_file(s3_bucket, s3_checksum_file)
+
+    @staticmethod
+    def publish(sns_topic, message, message_attributes):
+        """
+        Publish a message to the SNS topic
+        """
+        publish_sns(sns_topic, message, message_attributes)
+
+
+def run_steps(steps, requests=BlockingRequests):
+    """
+    Drive a ``*_steps`` generator, carrying out each operation it yields
+
+    The generators decide what to do with a granule, from its journal stages and
+    the results of the operations, so the threaded and asyncio modes share that
+    logic. Each operation is a tuple of the name of a method of ``requests``
+    and its arguments; its result is sent back into the generator, or its
+    S3SyncException is thrown into it.
+
+    :param steps: Generator of operations
+    :param requests: BlockingRequests, or an object with the same methods
+    :return: Value returned by the generator
+    """
+    send, value = steps.send, None
+    while True:
+        try:
+            operation, *args = send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, send = getattr(requests, operation)(*args), steps.send
+        except S3SyncException as exception:
+            value, send = exception, steps.throw
+
+
+def upload_metadata_documents_steps(
+    nci_metadata_file,
+    s3_bucket,
+    s3_base_url,
+    explorer_base_url,
+    s3_path,
+    journal,
+    checksums=None,
+    compact_stac=False,
+):
+    """
+    Steps of upload_metadata_documents, see run_steps
+    """
+    completed_stages = journal.completed_stages(nci_metadata_file)
+
+    # Initialise error list
+    metadata_error_list = []
+
+    nci_metadata_file_path = Path(nci_metadata_file)
+    if checksums is None and SyncJournal.CHECKSUM not in completed_stages:
+        checksums = yield (
+            "run",
+            partial(read_checksum_file, get_checksum_file_path(nci_metadata_file_path)),
+        )
+
+    generated = yield (
+        "run",
+        partial(
+            generate_metadata,
+            nci_metadata_file_path,
+            s3_path,
+            s3_base_url,
+            explorer_base_url,
+            compact_stac,
+        ),
+    )
+
+    # Write odc metadata yaml object into S3
+    s3_metadata_file = generated["s3_metadata_file"]
+    if SyncJournal.METADATA in completed_stages:
+        LOG.info(f"Metadata already uploaded to {s3_metadata_file}")
+    else:
+        try:
+            yield (
+                "put",
+                s3_bucket,
+                s3_metadata_file,
+                generated["metadata"],
+                "text/vnd.yaml",
+            )
+            journal.mark_done(nci_metadata_file, SyncJournal.METADATA)
+            LOG.info(f"Finished uploading metadata to {s3_metadata_file}")
+        except S3SyncException as exp:
+            LOG.error(f"Failed uploading metadata to {s3_metadata_file} - {exp}")
+            metadata_error_list.append(
+                f"Failed uploading metadata to {s3_metadata_file} - {exp}"
+            )
+
+    # Write stac metadata json object into S3
+    s3_stac_file = generated["s3_stac_file"]
+    if SyncJournal.STAC in completed_stages:
+        LOG.info(f"STAC metadata already uploaded to {s3_stac_file}")
+    else:
+        try:
+            yield (
+                "put",
+                s3_bucket,
+                s3_stac_file,
+                generated["stac"],
+                "application/json",
+            )
+            journal.mark_done(nci_metadata_file, SyncJournal.STAC)
+            LOG.info(f"Finished uploading STAC metadata to {s3_stac_file}")
+        except S3SyncException as exp:
+            LOG.error(f"Failed uploading STAC metadata to {s3_stac_file} - {exp}")
+            metadata_error_list.append(
+                f"Failed uploading STAC metadata to {s3_stac_file} - {exp}"
+            )
+
+    return generated, checksums, metadata_error_list
+
+
+def upload_metadata_documents(
+    nci_metadata_file,
+    s3_bucket,
+    s3_base_url,
+    explorer_base_url,
+    s3_path,
+    journal=None,
+    checksums=None,
+    compact_stac=False,
+):
+    """
+    Uploads updated metadata with nbar element removed and the STAC doc created,
+    the first half of upload_metadata
+
+    :param nci_metadata_file: Path of metadata file in NCI
+    :param s3_bucket: Name of S3 bucket
+    :param s3_base_url: Base URL of the S3 bucket
+    :param explorer_base_url: Base URL of the explorer
+    :param s3_path: Path in S3
+    :param journal: SyncJournal recording the stages already completed
+    :param checksums: Checksum file of the granule already parsed by
+    read_checksum_file
+    :param compact_stac: Upload the STAC item without indentation
+    :return: Documents created by generate_metadata, the checksum file, and the
+    list of errors
+    """
+    if journal is None:
+        journal = SyncJournal()
+    return run_steps(
+        upload_metadata_documents_steps(
+            nci_metadata_file,
+            s3_bucket,
+            s3_base_url,
+            explorer_base_url,
+            s3_path,
+            journal,
+            checksums=checksums,
+            compact_stac=compact_stac,
+        )
+    )
+
+
+def publish_metadata_steps(
+    nci_metadata_file,
+    generated,
+    s3_bucket,
+    sns_topic,
+    s3_path,
+    journal,
+    publisher=None,
+    checksums=None,
+):
+    """
+    Steps of publish_metadata, see run_steps
+    """
+    completed_stages = journal.completed_stages(nci_metadata_file)
+
+    # Initialise error list
+    metadata_error_list = []
+
+    nci_metadata_file_path = Path(nci_metadata_file)
+    checksum_file_path = get_checksum_file_path(nci_metadata_file_path)
+
+    # Publish message containing STAC metadata to SNS Topic
+    if SyncJournal.SNS_ADDED in completed_stages:
+        LOG.info(f"SNS Message already published to SNS Topic {sns_topic}")
+    elif publisher is not None:
+        # Sending a full batch blocks
+        yield (
+            "run",
+            partial(
+                publisher.publish,
+                generated["message"],
+                generated["message_attributes"],
+                on_success=partial(
+                    journal.mark_done, nci_metadata_file, SyncJournal.SNS_ADDED
+                ),
+            ),
+        )
+    else:
+        try:
+            yield (
+                "publish",
+                sns_topic,
+                generated["message"],
+                generated["message_attributes"],
+            )
+            journal.mark_done(nci_metadata_file, SyncJournal.SNS_ADDED)
+            LOG.info(f"Finished publishing SNS Message to SNS Topic {sns_topic}")
+        except S3SyncException as exp:
+            LOG.error(f"Failed publishing SNS Message to SNS Topic {sns_topic} - {exp}")
+            metadata_error_list.append(
+                f"Failed publishing SNS Message to SNS Topic {sns_topic} - {exp}"
+            )
+
+    # Update checksum file
+    if SyncJournal.CHECKSUM in completed_stages:
+        LOG.info(
+            f"Checksum file already uploaded to {s3_path}/{checksum_file_path.name}"
+        )
+        return metadata_error_list
+    try:
+        with build_checksum_file(
+            nci_metadata_file_path,
+            checksum_file_path,
+            generated["checksums"],
+            checksums=checksums,
+        ) as temp_checksum:
+            # Write checksum sha1 object into S3
+            yield (
+                "put",
+                s3_bucket,
+                f"{s3_path}/{checksum_file_path.name}",
+                temp_checksum,
+                "text/plain",
+            )
+        journal.mark_done(nci_metadata_file, SyncJournal.CHECKSUM)
+        LOG.info(
+            f"Finished uploading checksum file " f"{s3_path}/{checksum_file_path.name}"
+        )
+    except S3SyncException as exp:
+        LOG.error(
+            f"Failed uploading checksum file "
+            f"{s3_path}/{checksum_file_path.name} - {exp}"
+        )
+        metadata_error_list.append(
+            f"Failed uploading checksum file "
+            f"{s3_path}/{checksum_file_path.name} - {exp}"
+        )
+
+    return metadata_error_list
+
+
+def publish_metadata(
+    nci_metadata_file,
+    generated,
+    s3_bucket,
+    sns_topic,
+    s3_path,
+    journal=None,
+    publisher=None,
+    checksums=None,
+):
+    """
+    Publish SNS message and upload updated checksum file, the second half of
+    upload_metadata
+
+    :param nci_metadata_file: Path of metadata file in NCI
+    :param generated: Documents created by generate_metadata
+    :param s3_bucket: Name of S3 bucket
+    :param sns_topic: ARN of the SNS topic
+    :param s3_path: Path in S3
+    :param journal: SyncJournal recording the stages already completed
+    :param publisher: BatchPublisher to buffer the SNS message in, instead of
+    publishing it straight away
+    :param checksums: Checksum file of the granule already parsed by
+    read_checksum_file
+    :return: List of errors
+    """
+    if journal is None:
+        journal = SyncJournal()
+    return run_steps(
+        publish_metadata_steps(
+            nci_metadata_file,
+            generated,
+            s3_bucket,
+            sns_topic,
+            s3_path,
+            journal,
+            publisher=publisher,
+            checksums=checksums,
+        )
+    )
+
+
+def upload_metadata_steps(
+    nci_metadata_file,
+    s3_bucket,
+    s3_base_url,
+    explorer_base_url,
+    sns_topic,
+    s3_path,
+    journal,
+    publisher=None,
+    checksums=None,
+    compact_stac=False,
+):
+    """
+    Steps of upload_metadata, see run_steps
+    """
+    generated, checksums, metadata_error_list = yield from (
+        upload_metadata_documents_steps(
+            nci_metadata_file,
+            s3_bucket,
+            s3_base_url,
+            explorer_base_url,
+            s3_path,
+            journal,
+            checksums=checksums,
+            compact_stac=compact_stac,
+        )
+    )
+    metadata_error_list.extend(
+        (
+            yield from publish_metadata_steps(
+                nci_metadata_file,
+                generated,
+                s3_bucket,
+                sns_topic,
+                s3_path,
+                journal,
+                publisher=publisher,
+                checksums=checksums,
+            )
+        )
+    )
+    return metadata_error_list
+
+
+def upload_metadata(
+    nci_metadata_file,
+    s3_bucket,
+    s3_base_url,
+    explorer_base_url,
+    sns_topic,
+    s3_path,
+    journal=None,
+    publisher=None,
+    checksums=None,
+    compact_stac=False,
+):
+    """
+    Uploads updated metadata with nbar element removed, updated checksum file, STAC doc created
+    and publish SNS message
+
+    :param nci_metadata_file: Path of metadata file in NCI
+    :param s3_bucket: Name of S3 bucket
+    :param s3_base_url: Base URL of the S3 bucket
+    :param explorer_base_url: Base URL of the explorer
+    :param sns_topic: ARN of the SNS topic
+    :param s3_path: Path in S3
+    :param journal: SyncJournal recording the stages already completed
+    :param publisher: BatchPublisher to buffer the SNS message in, instead of
+    publishing it straight away
+    :param checksums: Checksum file of the granule already parsed by
+    read_checksum_file
+    :param compact_stac: Upload the STAC item without indentation
+    :return: List of errors
+    """
+    if journal is None:
+        journal = SyncJournal()
+    return run_steps(
+        upload_metadata_steps(
+            nci_metadata_file,
+            s3_bucket,
+            s3_base_url,
+            explorer_base_url,
+            sns_topic,
+            s3_path,
+            journal,
+            publisher=publisher,
+            checksums=checksums,
+            compact_stac=compact_stac,
+        )
+    )
+
+
+def is_excluded(relative_path, exclude):
+    """
+    Check a file against exclude patterns, the same way ``aws s3 sync --exclude`` does
+
+    :param relative_path: Path of the file relative to the granule directory
+    :param exclude: list of file patterns to exclude
+    :return: True if the file matches any of the patterns
+    """
+    return any(fnmatch.fnmatch(relative_path, pattern) for pattern in exclude or [])
+
+
+def granule_files(local_path, exclude=None):
+    """
+    Find the files of a granule directory which are synced to S3
+
+    :param local_path: Local directory of the granule
+    :param exclude: list of file patterns to exclude
+    :return: Iterator of the relative path and Path of each file, in sorted order
+    """
+    for path in sorted(local_path.rglob("*")):
+        if not path.is_file():
+            continue
+        relative_path = path.relative_to(local_path).as_posix()
+        if not is_excluded(relative_path, exclude):
+            yield relative_path, path
+
+
+def upload_request_count(size, multipart_chunksize=MULTIPART_CHUNKSIZE):
+    """
+    Count the S3 requests needed to upload a file
+
+    :param size: Size of the file in bytes
+    :param multipart_chunksize: Part size of multipart uploads, in bytes
+    :return: 1 for a PutObject, or the parts plus creating and completing a
+    multipart upload
+    """
+    if size < multipart_chunksize:
+        return 1
+    return math.ceil(size / multipart_chunksize) + 2
+
+
+class NativeTransfer:
+    """
+    In-process replacement for the ``aws s3 sync`` and ``aws s3 rm`` commands
+
+    Every granule shares one S3 client, and so one connection pool, and files are
+    uploaded through boto3's TransferManager, which does multipart uploads of large
+    files concurrently.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        max_concurrency=10,
+        multipart_chunksize=MULTIPART_CHUNKSIZE,
+        workers=1,
+    ):
+        """
+        :param client: boto3 S3 client, a new one is created if not provided
+        :param max_concurrency: Maximum number of concurrent part uploads
+        :param multipart_chunksize: Part size for multipart uploads, in bytes
+        :param workers: Number of threads listing and deleting objects with the
+        client while the part uploads run
+        """
+        if client is None:
+            # A connection for every part upload, and one for every worker
+            client = boto3.client(
+                "s3", config=Config(max_pool_connections=max_concurrency + workers)
+            )
+        self.client = client
+        self.manager = create_transfer_manager(
+            client,
+            TransferConfig(
+                max_concurrency=max_concurrency,
+                multipart_threshold=multipart_chunksize,
+                multipart_chunksize=multipart_chunksize,
+            ),
+        )
+
+    def list_objects(self, s3_bucket, prefix):
+        """
+        List objects under a prefix
+
+        :param s3_bucket: Name of the S3 bucket
+        :param prefix: Key prefix, usually ending with a '/'
+        :return: Dict of key to listing entry
+        """
+        paginator = self.client.get_paginator("list_objects_v2")
+        try:
+            return {
+                obj["Key"]: obj
+                for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix)
+                for obj in page.get("Contents", [])
+            }
+        except (BotoCoreError, ClientError) as exception:
+            raise S3SyncException(str(exception))
+
+    def sync(
+        self,
+        local_path,
+        s3_bucket,
+        s3_prefix,
+        exclude=None,
+        cross_account=False,
+        checksums=None,
+        remote_checksums=None,
+    ):
+        """
+        Upload new and modified files from a local directory, like ``aws s3 sync``
+
+        A file is uploaded when it is missing from S3 or its size differs. When
+        the sha1 of a file is known on both sides, from the local checksum file
+        and the one uploaded to S3, the file is uploaded only if its content
+        changed. Otherwise it is uploaded if the local copy is newer than the
+        object in S3.
+
+        :param local_path: Local directory to upload
+        :param s3_bucket: Name of the S3 bucket
+        :param s3_prefix: Key prefix of the directory in S3
+        :param exclude: list of file patterns to exclude
+        :param cross_account: Grant the bucket owner full control of the objects
+        :param checksums: Dict of relative path to sha1 of the local files
+        :param remote_checksums: Dict of relative path to sha1 of the files in S3
+        :return: Dict of uploaded keys to their size in bytes
+        """
+        checksums = checksums or {}
+        remote_checksums = remote_checksums or {}
+        local_path = Path(local_path)
+        if not local_path.is_dir():
+            raise S3SyncException(f"Local directory {local_path} does not exist")
+
+        remote_objects = self.list_objects(s3_bucket, f"{s3_prefix}/")
+
+        futures = {}
+        uploaded = {}
+        for relative_path, path in granule_files(local_path, exclude):
+            key = f"{s3_prefix}/{relative_path}"
+            stat = path.stat()
+            remote = remote_objects.get(key)
+            if remote is not None and remote["Size"] == stat.st_size:
+                if relative_path in checksums and relative_path in remote_checksums:
+                    unchanged = (
+                        checksums[relative_path] == remote_checksums[relative_path]
+                    )
+                else:
+                    # S3 only keeps the last modified time to the second
+                    unchanged = remote["LastModified"].timestamp() >= int(stat.st_mtime)
+                if unchanged:
+                    continue
+
+            extra_args = {}
+            if relative_path in checksums:
+                extra_args["Metadata"] = {"sha1": checksums[relative_path]}
+            content_type, _ = mimetypes.guess_type(path.name)
+            if content_type:
+                extra_args["ContentType"] = content_type
+            if cross_account:
+                extra_args["ACL"] = "bucket-owner-full-control"
+            futures[key] = self.manager.upload(
+                str(path), s3_bucket, key, extra_args=extra_args
+            )
+            uploaded[key] = stat.st_size
+
+        failures = []
+        for key, future in futures.items():
+            try:
+                future.result()
+            except (
+                BotoCoreError,
+                ClientError,
+                S3UploadFailedError,
+                OSError,
+            ) as exception:
+                failures.append(f"{key} - {exception}")
+        if failures:
+            raise S3SyncException(
+                "Failed uploading files to S3: " + ", ".join(failures)
+            )
+
+        return uploaded
+
+    def close(self):
+        """
+        Wait for outstanding transfers and release the transfer threads
+        """
+        self.manager.shutdown()
+
+
+def archive_granule(granule, s3_root_path, s3_bucket):
+    """
+    Run AWS rm command to delete granules from S3 bucket
+
+    :param granule: Name of the granule
+    :param s3_root_path: Root folder of the S3 bucket
+    :param s3_bucket: Name of the S3 bucket
+    :return: Returns code zero, if success.
+    """
+    s3_path = f"s3://{s3_bucket}/{s3_root_path}/{granule}"
+
+    # Remove any data that shouldn't be there and exclude the metadata
+    command = f"aws s3 rm {s3_path} --only-show-error --recursive "
+
+    return_code = subprocess.call(command, shell=True)
+
+    if return_code != 0:
+        raise S3SyncException("Failed running S3 rm command")
+
+
+class S3Archiver:
+    """
+    Delete archived granules from S3 with batched DeleteObjects requests
+
+    The keys of each granule are listed and queued, and the keys of several
+    granules are packed into requests of up to 1000 keys. A granule is only
+    reported as archived once every one of its keys has been deleted; keys that
+    failed are collected in ``errors``.
+    """
+
+    def __init__(self, client=None, batch_size=DELETE_BATCH_SIZE):
+        """
+        :param client: boto3 S3 client, the shared one is used if not provided
+        :param batch_size: Maximum number of keys in a DeleteObjects request
+        """
+        self.client = client or CLIENTS.client("s3", max_attempts=SINGLE_ATTEMPT)
+        self.batch_size = batch_size
+        self.errors = []
+        self.request_count = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def list_keys(self, s3_bucket, s3_prefix):
+        """
+        :param s3_bucket: Name of the S3 bucket
+        :param s3_prefix: Key prefix of the directory in S3
+        :return: List of keys under the prefix
+        """
+        paginator = self.client.get_paginator("list_objects_v2")
+        try:
+            return [
+                obj["Key"]
+                for page in paginator.paginate(Bucket=s3_bucket, Prefix=f"{s3_prefix}/")
+                for obj in page.get("Contents", [])
+            ]
+        except (BotoCoreError, ClientError) as exception:
+            raise S3SyncException(str(exception))
+
+    def archive(self, s3_bucket, s3_prefix, granule, on_success=None):
+        """
+        Queue every object under a prefix for deletion, like ``aws s3 rm --recursive``
+
+        :param s3_bucket: Name of the S3 bucket
+        :param s3_prefix: Key prefix of the granule in S3
+        :param granule: Name of the granule, for error messages
+        :param on_success: Called once all the keys are deleted, may return a
+        list of errors
+        """
+        keys = self.list_keys(s3_bucket, s3_prefix)
+        pending = {"granule": granule, "remaining": len(keys), "failures": []}
+        pending["on_success"] = on_success
+        if not keys:
+            self._finish(pending)
+            return
+
+        batches = []
+        with self._lock:
+            queued_keys = self._pending.setdefault(s3_bucket, [])
+            queued_keys.extend((key, pending) for key in keys)
+            while len(queued_keys) >= self.batch_size:
+                batches.append(queued_keys[: self.batch_size])
+                del queued_keys[: self.batch_size]
+        # Sent without the lock, so other workers keep queueing keys meanwhile
+        for batch in batches:
+            self._delete(s3_bucket, batch)
+
+    def _delete(self, s3_bucket, batch):
+        """
+        Delete a batch of queued keys, and finish the granules it completes
+        """
+        keys = [key for key, _ in batch]
+        failed = {}
+        for attempt in range(S3_REQUESTS.max_attempts):
+            if attempt:
+                time.sleep(S3_REQUESTS.backoff(attempt))
+            with self._lock:
+                self.request_count += 1
+            try:
+                response = S3_REQUESTS.call(
+                    self.client.delete_objects,
+                    Bucket=s3_bucket,
+                    Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+                )
+            except (BotoCoreError, ClientError) as exception:
+                failed.update({key: f"{key} - {exception}" for key in keys})
+                break
+            errors = response.get("Errors", [])
+            failed.update(
+                {error["Key"]: f"{error['Key']} - {error['Code']}" for error in errors}
+            )
+            # Keys throttled, or failing transiently, on their own are sent again
+            keys = [
+                error["Key"]
+                for error in errors
+                if error["Code"] in THROTTLING_ERRORS | TRANSIENT_ERRORS
+            ]
+            if not keys or attempt == S3_REQUESTS.max_attempts - 1:
+                break
+            if any(error["Code"] in THROTTLING_ERRORS for error in errors):
+                S3_REQUESTS.on_throttle()
+            for key in keys:
+                del failed[key]
+
+        # The keys of a granule can be spread over batches sent by several workers
+        finished = []
+        with self._lock:
+            for key, pending in batch:
+                if key in failed:
+                    pending["failures"].append(failed[key])
+                pending["remaining"] -= 1
+                if pending["remaining"] == 0:
+                    finished.append(pending)
+        for pending in finished:
+            self._finish(pending)
+
+    def _finish(self, pending):
+        """
+        Report the result of a granule whose keys have all been sent
+        """
+        granule = pending["granule"]
+        errors = []
+        if pending["failures"]:
+            message = (
+                f"Failed to archive {granule} because of an error deleting files from S3 - "
+                + ", ".join(pending["failures"])
+            )
+            LOG.error(message)
+            errors.append(message)
+        elif pending["on_success"] is not None:
+            errors.extend(pending["on_success"]() or [])
+        with self._lock:
+            self.errors.extend(errors)
+
+    def flush(self):
+        """
+        Delete every queued key
+        """
+        with self._lock:
+            queued, self._pending = self._pending, {}
+        for s3_bucket, keys in queued.items():
+            for start in range(0, len(keys), self.batch_size):
+                self._delete(s3_bucket, keys[start : start + self.batch_size])
+
+    def close(self):
+        """
+        Delete every queued key, and report the granules archived
+        """
+        self.flush()
+        LOG.info(f"Archived granules with {self.request_count} DeleteObjects requests")
+
+
+@STATSD.timed("duration.sync")
+def sync_granule(
+    granule,
+    nci_dir,
+    s3_root_path,
+    s3_bucket,
+    exclude=DEFAULT_EXCLUDE,
+    cross_account=False,
+    transfer=None,
+    checksums=None,
+    remote_checksums=None,
+):
+    """
+    Run AWS sync command to sync granules to S3 bucket
+
+    :param granule: Name of the granule
+    :param nci_dir: Source directory for the files in NCI
+    :param s3_root_path: Root folder of the S3 bucket
+    :param s3_bucket: Name of the S3 bucket
+    :param exclude: list of file patterns to exclude.
+    :param cross_account: Grant the bucket owner full control of the objects
+    :param transfer: NativeTransfer to upload in-process, instead of the AWS CLI
+    :param checksums: Dict of relative path to sha1 of the local files, to only
+    upload files whose content changed, with the native transfer
+    :param remote_checksums: Dict of relative path to sha1 of the files in S3
+    :return: Dict of uploaded keys to their size in bytes with the native
+    transfer, None with the AWS CLI
+    """
+    local_path = Path(nci_dir).joinpath(granule)
+
+    if transfer is not None:
+        uploaded = transfer.sync(
+            local_path,
+            s3_bucket,
+            f"{s3_root_path}/{granule}",
+            exclude=exclude,
+            cross_account=cross_account,
+            checksums=checksums,
+            remote_checksums=remote_checksums,
+        )
+        STATSD.incr("files", len(uploaded))
+        STATSD.incr("bytes", sum(uploaded.values()))
+        return uploaded
+
+    s3_path = f"s3://{s3_bucket}/{s3_root_path}/{granule}"
+
+    # Remove any data that shouldn't be there and exclude the metadata
+    exclude_string = ""
+    if exclude:
+        exclude_string = " ".join(f"--exclude {pattern}" for pattern in exclude)
+
+    command = f"aws s3 sync {local_path} {s3_path} --only-show-errors {exclude_string}"
+    if cross_account:
+        command += " --acl bucket-owner-full-control"
+
+    return_code = subprocess.call(command, shell=True)
+
+    if return_code != 0:
+        raise S3SyncException(
+            f"Failed running S3 sync command. Return error code: {return_code}"
+        )
+
+
+def is_archived_row(granule_row):
+    """
+    Check if a row of the csv file lists an archived granule
+
+    :param granule_row: Row of the csv file, metadata path and archived date
+    :return: True if the granule has been archived
+    """
+    return True if (len(granule_row) > 1 and granule_row[1]) else False
+
+
+def get_s3_metadata_file(metadata_file, nci_dir, s3_root_path):
+    """
+    Get the S3 key of the metadata file of a granule
+
+    :param metadata_file: Path of metadata file in NCI
+    :param nci_dir: Source directory for the files in NCI
+    :param s3_root_path: Root folder of the S3 bucket
+    :return: S3 key of the metadata file
+    """
+    metadata_file_path = Path(metadata_file)
+    granule = metadata_file_path.relative_to(nci_dir).parent
+    return f"{s3_root_path}/{granule}/{metadata_file_path.name}"
+
+
+def is_granule_complete(metadata_file, granule, is_archived, completed_stages):
+    """
+    Log the start of processing a granule, and check if the journal shows a
+    previous run already finished it
+
+    :param metadata_file: Path of metadata file in NCI
+    :param granule: Directory of the granule relative to the NCI dir
+    :param is_archived: Whether the granule is archived, rather than added
+    :param completed_stages: Stages of the granule recorded in the SyncJournal
+    :return: True if every stage of the granule is done
+    """
+    action = "archived" if is_archived else "added"
+    LOG.info(f"Processing {action} granule - {metadata_file} ")
+    STATSD.incr("granules")
+    all_stages = ARCHIVED_STAGES if is_archived else ADDED_STAGES
+    if completed_stages >= all_stages:
+        LOG.info(f"Journal shows {action} granule is complete, skipping {granule}")
+        return True
+    return False
+
+
+def sync_added_granule_steps(
+    metadata_file,
+    nci_dir,
+    s3_root_path,
+    s3_bucket,
+    journal,
+    update=False,
+    transfer=None,
+    existence_index=None,
+    delta=False,
+):
+    """
+    Steps of sync_added_granule, see run_steps
+    """
+    # Initialise error list
+    error_list = []
+
+    metadata_file_path = Path(metadata_file)
+    granule = metadata_file_path.relative_to(nci_dir).parent
+    s3_path = f"{s3_root_path}/{granule}"
+    s3_metadata_file = get_s3_metadata_file(metadata_file, nci_dir, s3_root_path)
+    completed_stages = journal.completed_stages(metadata_file)
+
+    # Checking if metadata file exists
+    if not (yield ("run", metadata_file_path.exists)):
+        LOG.error(
+            f"Failed to sync {metadata_file} "
+            f"because of missing metadata file in NCI"
+        )
+        error_list.append(
+            f"Failed to sync {metadata_file} "
+            f"because of missing metadata file in NCI"
+        )
+        return False, None, error_list
+
+    # s3://dea-public-data
+    # /analysis-ready-data/ga_ls5t_ard_3/088/080/1990/11/15
+    # /ga_ls5t_ard_3-0-0_088080_1990-11-15_final.odc-metadata.yaml
+
+    try:
+        # Check if already processed and update flag set to force replace, a
+        # granule partly done by a previous run is always finished
+        if not completed_stages and not update:
+            if (yield ("exists", s3_bucket, s3_metadata_file, existence_index)):
+                LOG.warning(
+                    f"Metadata exists in S3 and update is not set to True, "
+                    f"not syncing {granule}"
+                )
+                return False, None, error_list
+
+        checksums = remote_checksums = None
+        if delta:
+            checksum_file_path = get_checksum_file_path(metadata_file_path)
+            checksums = yield ("run", partial(read_checksum_file, checksum_file_path))
+            remote_checksums = yield (
+                "read_s3_checksum_file",
+                s3_bucket,
+                f"{s3_path}/{checksum_file_path.name}",
+            )
+
+        if SyncJournal.SYNCED in completed_stages:
+            LOG.info(f"S3 sync of granule already done - {granule}")
+        else:
+            yield (
+                "run",
+                partial(
+                    sync_granule,
+                    granule,
+                    nci_dir,
+                    s3_root_path,
+                    s3_bucket,
+                    transfer=transfer,
+                    checksums=checksums,
+                    remote_checksums=remote_checksums,
+                ),
+            )
+            journal.mark_done(metadata_file, SyncJournal.SYNCED)
+            LOG.info(f"Finished S3 sync of granule - {granule}")
+
+    # if the s3 sync has exception, not touch metadata
+    except S3SyncException as exp:
+        LOG.error(
+            f"Failed to sync of {granule} "
+            f"because of an error in the sync command - {exp}"
+        )
+        error_list.append(
+            f"Failed to sync of {granule} "
+            f"because of an error in the sync command - {exp}"
+        )
+        return False, None, error_list
+
+    return True, checksums, error_list
+
+
+def sync_added_granule(
+    metadata_file,
+    nci_dir,
+    s3_root_path,
+    s3_bucket,
+    update=False,
+    transfer=None,
+    existence_index=None,
+    journal=None,
+    delta=False,
+):
+    """
+    Sync the data files of a granule added in the csv file, the first half of
+    process_granule
+
+    :param metadata_file: Path of metadata file in NCI
+    :param nci_dir: Source directory for the files in NCI
+    :param s3_root_path: Root folder of the S3 bucket
+    :param s3_bucket: Name of the S3 bucket
+    :param update: Sets flag for a fresh sync of data and replace the metadata
+    :param transfer: NativeTransfer to upload in-process, instead of the AWS CLI
+    :param existence_index: S3ExistenceIndex to look up existing granules in
+    :param journal: SyncJournal recording the stages already completed
+    :param delta: Only upload files whose content changed, according to the
+    checksum files in NCI and S3
+    :return: True if the metadata should be uploaded next, the checksum file read
+    for a delta sync, and the list of errors
+    """
+    if journal is None:
+        journal = SyncJournal()
+    return run_steps(
+        sync_added_granule_steps(
+            metadata_file,
+            nci_dir,
+            s3_root_path,
+            s3_bucket,
+            journal,
+            update=update,
+            transfer=transfer,
+            existence_index=existence_index,
+            delta=delta,
+        )
+    )
+
+
+def added_granule_steps(
+    metadata_file,
+    nci_dir,
+    s3_root_path,
+    s3_bucket,
+    s3_base_url,
+    explorer_base_url,
+    sns_topic,
+    journal,
+    update=False,
+    transfer=None,
+    existence_index=None,
+    publisher=None,
+    delta=False,
+    compact_stac=False,
+):
+    """
+    Steps of syncing a granule added in the csv file and uploading its metadata,
+    see run_steps and process_granule
+    """
+    synced, checksums, error_list = yield from sync_added_granule_steps(
+        metadata_file,
+        nci_dir,
+        s3_root_path,
+        s3_bucket,
+        journal,
+        update=update,
+        transfer=transfer,
+        existence_index=existence_index,
+        delta=delta,
+    )
+
+    if synced:
+        # s3 sync and metadata update happen in same section
+        granule = Path(metadata_file).relative_to(nci_dir).parent
+        metadata_update_error_list = yield from upload_metadata_steps(
+            metadata_file,
+            s3_bucket,
+            s3_base_url,
+            explorer_base_url,
+            sns_topic,
+            f"{s3_root_path}/{granule}",
+            journal,
+            publisher=publisher,
+            checksums=checksums,
+            compact_stac=compact_stac,
+        )
+        error_list.extend(metadata_update_error_list)
+
+    return error_list
+
+
+def process_granule(
+    granule_row,
+    nci_dir,
+    s3_root_path,
+    s3_bucket,
+    s3_base_url,
+    explorer_base_url,
+    sns_topic,
+    update=False,
+    transfer=None,
+    existence_index=None,
+    journal=None,
+    publisher=None,
+    delta=False,
+    archiver=None,
+    compact_stac=False,
+):
+    """
+    Sync, or archive, a single granule listed in the csv file
+
+    :param granule_row: Row of the csv file, metadata path and archived date
+    :param nci_dir: Source directory for the files in NCI
+    :param s3_root_path: Root folder of the S3 bucket
+    :param s3_bucket: Name of the S3 bucket
+    :param s3_base_url: Base URL of the S3 bucket
+    :param explorer_base_url: Base URL of the Explorer
+    :param sns_topic: ARN of the SNS topic
+    :param update: Sets flag for a fresh sync of data and replace the metadata
+    :param transfer: NativeTransfer to use instead of the AWS CLI
+    :param existence_index: S3ExistenceIndex to look up existing granules in
+    :param journal: SyncJournal recording the stages already completed
+    :param publisher: BatchPublisher to buffer SNS messages in, instead of
+    publishing them straight away
+    :param delta: Only upload files whose content changed, according to the
+    checksum files in NCI and S3
+    :param archiver: S3Archiver to delete archived granules in batches with, the
+    granule is then only archived and published once the archiver flushes,
+    without one the AWS CLI deletes them
+    :param compact_stac: Upload STAC items without indentation
+    :return: List of errors
+    """
+    if journal is None:
+        journal = SyncJournal()
+
+    # Initialise error list
+    error_list = []
+
+    metadata_file = granule_row[0] if len(granule_row) > 0 else None
+    is_archived = is_archived_row(granule_row)
+
+    metadata_file_path = Path(metadata_file)
+    granule = metadata_file_path.relative_to(nci_dir).parent
+    s3_path = f"{s3_root_path}/{granule}"
+    s3_metadata_file = get_s3_metadata_file(metadata_file, nci_dir, s3_root_path)
+    s3_stac_file = f"{s3_path}/{metadata_file_path.stem.replace('.odc-metadata', '')}.stac-item.json"
+
+    completed_stages = journal.completed_stages(metadata_file)
+
+    with granule_log_context(granule):
+        if is_granule_complete(metadata_file, granule, is_archived, completed_stages):
+            return error_list
+
+        if is_archived:
+            # Checks if metadata file exists in S3, unless a previous run
+            # already started deleting it
+            try:
+                exists_in_s3 = (
+                    SyncJournal.ARCHIVED in completed_stages
+                    or granule_exists(s3_bucket, s3_metadata_file, existence_index)
+                )
+            except S3SyncException as exp:
+                LOG.error(f"Failed to archive {granule} - {exp}")
+                error_list.append(f"Failed to archive {granule} - {exp}")
+                return error_list
+            if exists_in_s3:
+
+                def publish_archived(stac_dump):
+                    # Publish message containing STAC metadata to SNS Topic
+                    message_attributes = get_common_message_attributes(stac_dump)
+                    message_attributes.update(
+                        {
+                            "action": {
+                                "DataType": "String",
+                                "StringValue": "ARCHIVED",
+                            }
+                        }
+                    )
+                    if publisher is not None:
+                        publisher.publish(
+                            json.dumps(stac_dump),
+                            message_attributes,
+                            on_success=partial(
+                                journal.mark_done,
+                                metadata_file,
+                                SyncJournal.SNS_ARCHIVED,
+                            ),
+                        )
+                        return []
+                    try:
+                        publish_sns(
+                            sns_topic, json.dumps(stac_dump), message_attributes
+                        )
+                        journal.mark_done(metadata_file, SyncJournal.SNS_ARCHIVED)
+                        LOG.info(
+                            f"Finished publishing SNS Message to SNS Topic {sns_topic}"
+                        )
+                    except S3SyncException as exp:
+                        LOG.error(
+                            f"Failed publishing SNS Message to SNS Topic {sns_topic} - {exp}"
+                        )
+                        return [
+                            f"Failed publishing SNS Message to SNS Topic {sns_topic} - {exp}"
+                        ]
+                    return []
+
+                def archived(stac_dump):
+                    # Runs on whichever thread sent the last delete batch of the
+                    # granule, when archiving in batches
+                    with granule_log_context(granule):
+                        # Keep the STAC document for the SNS message, as it's
+                        # gone from S3 now
+                        journal.mark_done(
+                            metadata_file,
+                            SyncJournal.ARCHIVED,
+                            payload=json.dumps(stac_dump),
+                        )
+                        LOG.info(f"Finished S3 archive of granule - {granule}")
+                        return publish_archived(stac_dump)
+
+                try:
+                    if SyncJournal.ARCHIVED in completed_stages:
+                        stac_dump = json.loads(
+                            journal.get_payload(metadata_file, SyncJournal.ARCHIVED)
+                        )
+                        LOG.info(f"S3 archive of granule already done - {granule}")
+                        error_list.extend(publish_archived(stac_dump))
+                    else:
+                        stac_dump = json.load(load_s3_resource(s3_bucket, s3_stac_file))
+
+                        # Delete all files from the S3 path
+                        if archiver is not None:
+                            archiver.archive(
+                                s3_bucket,
+                                s3_path,
+                                granule,
+                                on_success=partial(archived, stac_dump),
+                            )
+                        else:
+                            archive_granule(granule, s3_root_path, s3_bucket)
+                            error_list.extend(archived(stac_dump))
 
-    return msg_attributes
+                except S3SyncException as exp:
+                    LOG.error(
+                        f"Failed to archive {granule} "
+                        f"because of an error in the rm command - {exp}"
+                    )
+                    error_list.append(
+                        f"Failed to archive {granule} "
+                        f"because of an error in the rm command - {exp}"
+                    )
+            else:
+                LOG.warning(
+                    f"Metadata doesn't exists in S3, "
+                    f"not deleting anything from S3 for {granule}"
+                )
+        else:
+            error_list.extend(
+                run_steps(
+                    added_granule_steps(
+                        metadata_file,
+                        nci_dir,
+                        s3_root_path,
+                        s3_bucket,
+                        s3_base_url,
+                        explorer_base_url,
+                        sns_topic,
+                        journal,
+                        update=update,
+                        transfer=transfer,
+                        existence_index=existence_index,
+                        publisher=publisher,
+                        delta=delta,
+                        compact_stac=compact_stac,
+                    )
+                )
+            )
 
+    return error_list
 
-def upload_metadata(
-    nci_metadata_file, s3_bucket, s3_base_url, explorer_base_url, sns_topic, s3_path
+
+def build_existence_index(
+    granule_rows, nci_dir, s3_root_path, s3_bucket, update, journal, group_depth=1
 ):
     """
-    Uploads updated metadata with nbar element removed, updated checksum file, STAC doc created
-    and publish SNS message
+    Build the existence index for a chunk of the csv file
 
-    :param nci_metadata_file: Path of metadata file in NCI
-    :param s3_bucket: Name of S3 bucket
-    :param s3_base_url: Base URL of the S3 bucket
-    :param explorer_base_url: Base URL of the explorer
-    :param sns_topic: ARN of the SNS topic
-    :param s3_path: Path in S3
-    :return: List of errors
+    :param granule_rows: Rows of the csv file
+    :param nci_dir: Source directory for the files in NCI
+    :param s3_root_path: Root folder of the S3 bucket
+    :param s3_bucket: Name of the S3 bucket
+    :param update: Sets flag for a fresh sync of data and replace the metadata
+    :param journal: SyncJournal recording the stages already completed
+    :param group_depth: Number of directory levels that granules listed
+    together may differ by, None to list the whole chunk under its deepest
+    shared prefix
+    :return: S3ExistenceIndex
     """
-    # Initialise error list
-    metadata_error_list = []
-    # Initialise checksum list
-    new_checksum_list = {}
+    # Added granules are only checked when not forcing an update
+    s3_metadata_files = [
+        get_s3_metadata_file(granule_row[0], nci_dir, s3_root_path)
+        for granule_row in granule_rows
+        if granule_row
+        and (is_archived_row(granule_row) or not update)
+        and not journal.completed_stages(granule_row[0])
+    ]
+    index = S3ExistenceIndex(s3_bucket, s3_metadata_files, group_depth=group_depth)
+    LOG.info(
+        f"Checked {len(s3_metadata_files)} granules in S3 "
+        f"with {index.request_count} list requests, the others with HEAD requests"
+    )
+    return index
 
-    nci_metadata_file_path = Path(nci_metadata_file)
-    temp_metadata = serialise.load_yaml(nci_metadata_file_path)
 
-    # Deleting Nbar related metadata
-    # Because Landsat 8 is different, we need to check if the fields exist
-    # before removing them.
-    if "nbar_blue" in temp_metadata["measurements"]:
-        del temp_metadata["measurements"]["nbar_blue"]
-    if "nbar_green" in temp_metadata["measurements"]:
-        del temp_metadata["measurements"]["nbar_green"]
-    if "nbar_nir" in temp_metadata["measurements"]:
-        del temp_metadata["measurements"]["nbar_nir"]
-    if "nbar_red" in temp_metadata["measurements"]:
-        del temp_metadata["measurements"]["nbar_red"]
-    if "nbar_swir_1" in temp_metadata["measurements"]:
-        del temp_metadata["measurements"]["nbar_swir_1"]
-    if "nbar_swir_2" in temp_metadata["measurements"]:
-        del temp_metadata["measurements"]["nbar_swir_2"]
-    if "nbar_coastal_aerosol" in temp_metadata["measurements"]:
-        del temp_metadata["measurements"]["nbar_coastal_aerosol"]
-    if "nbar_panchromatic" in temp_metadata["measurements"]:
-        del temp_metadata["measurements"]["nbar_panchromatic"]
-    if "oa_nbar_contiguity" in temp_metadata["measurements"]:
-        del temp_metadata["measurements"]["oa_nbar_contiguity"]
-    if "thumbnail:nbar" in temp_metadata["accessories"]:
-        del temp_metadata["accessories"]["thumbnail:nbar"]
+class AsyncUploader:
+    """
+    Upload granules from a single asyncio event loop
 
-    # Format an eo3 dataset dict for human-readable yaml serialisation.
-    temp_metadata = serialise.prepare_formatting(temp_metadata)
+    The small requests of each granule, existence checks, metadata, STAC and
+    checksum uploads and SNS messages, are sent with aiobotocore, so hundreds of
+    them can be in flight from one thread. Reading and rewriting the metadata and
+    syncing the data files block, so they run on a small thread pool. The steps
+    of each granule are the same as in the threaded mode, with the operations
+    awaited instead of called, see run_steps. Archived granules are handed to
+    process_granule on the thread pool, as the archiver deletes them in batches
+    anyway.
+    """
+
+    def __init__(
+        self,
+        s3,
+        sns,
+        executor,
+        nci_dir,
+        s3_root_path,
+        s3_bucket,
+        s3_base_url,
+        explorer_base_url,
+        sns_topic,
+        update=False,
+        transfer=None,
+        journal=None,
+        publisher=None,
+        archiver=None,
+        delta=False,
+        compact_stac=False,
+    ):
+        """
+        :param s3: aiobotocore S3 client
+        :param sns: aiobotocore SNS client
+        :param executor: Executor running the blocking work
+
+        See process_granule for the other parameters.
+        """
+        self.s3 = s3
+        self.sns = sns
+        self.executor = executor
+        self.nci_dir = nci_dir
+        self.s3_root_path = s3_root_path
+        self.s3_bucket = s3_bucket
+        self.s3_base_url = s3_base_url
+        self.explorer_base_url = explorer_base_url
+        self.sns_topic = sns_topic
+        self.update = update
+        self.transfer = transfer
+        self.journal = journal if journal is not None else SyncJournal()
+        self.publisher = publisher
+        self.archiver = archiver
+        self.delta = delta
+        self.compact_stac = compact_stac
+        self._slots = {}
 
-    # Dump metadata yaml into buffer
-    with io.BytesIO() as temp_yaml:
-        serialise.dumps_yaml(temp_yaml, temp_metadata)
-        temp_yaml.seek(
-            0
-        )  # Seek back to the beginning of the file before next read/write
-        new_checksum_list[nci_metadata_file_path.name] = verify.calculate_hash(
-            temp_yaml
+    async def run_in_executor(self, function, *args, **kwargs):
+        """
+        Run a blocking function on the executor, keeping the granule of the
+        log lines
+        """
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(context.run, function, *args, **kwargs)
         )
 
-        # Write odc metadata yaml object into S3
-        s3_metadata_file = f"{s3_path}/{nci_metadata_file_path.name}"
+    @asynccontextmanager
+    async def slot(self, controller):
+        """
+        Wait until the controller allows another request in flight, like
+        AdaptiveConcurrency.slot but without blocking the event loop
+
+        :param controller: AdaptiveConcurrency of the service
+        """
+        condition = self._slots.setdefault(id(controller), asyncio.Condition())
+        async with condition:
+            while not controller.try_acquire():
+                # Requests finishing on other threads don't notify the condition
+                try:
+                    await asyncio.wait_for(condition.wait(), SLOT_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
         try:
-            upload_s3_resource(
-                s3_bucket,
-                s3_metadata_file,
-                temp_yaml.getvalue(),
-                content_type="text/vnd.yaml",
+            yield
+        finally:
+            controller.release()
+            async with condition:
+                condition.notify_all()
+
+    async def call(self, controller, method, **kwargs):
+        """
+        Send a request within the limit of the controller, retrying it with
+        backoff when it's throttled
+
+        :param controller: AdaptiveConcurrency of the service
+        :param method: aiobotocore client method
+        :return: Response of the request
+        """
+        for attempt in range(controller.max_attempts):
+            async with self.slot(controller):
+                try:
+                    result = await method(**kwargs)
+                except (BotoCoreError, ClientError) as exception:
+                    if not controller.on_error(exception, attempt):
+                        raise
+                else:
+                    controller.on_success()
+                    return result
+            await asyncio.sleep(controller.backoff(attempt))
+
+    async def run(self, function):
+        """
+        Run a blocking function of the steps on the executor
+
+        :param function: Blocking function to call, without arguments
+        :return: Result of the function
+        """
+        return await self.run_in_executor(function)
+
+    async def exists(self, s3_bucket, s3_key, existence_index=None):
+        """
+        Check if a key exists, with the index when it covers the key
+
+        :param s3_bucket: Name of the S3 bucket
+        :param s3_key: S3 key
+        :param existence_index: S3ExistenceIndex built for the chunk of granules
+        :return: True if the key exists
+        """
+        if existence_index is not None and existence_index.covers(s3_key):
+            return existence_index.exists(s3_key)
+        try:
+            await self.call(
+                S3_REQUESTS, self.s3.head_object, Bucket=s3_bucket, Key=s3_key
             )
-            LOG.info(f"Finished uploading metadata to {s3_metadata_file}")
-        except S3SyncException as exp:
-            LOG.error(f"Failed uploading metadata to {s3_metadata_file} - {exp}")
-            metadata_error_list.append(
-                f"Failed uploading metadata to {s3_metadata_file} - {exp}"
+        except ClientError:
+            return False
+        except BotoCoreError as exception:
+            raise S3SyncException(
+                f"Failed checking s3://{s3_bucket}/{s3_key} - {exception}"
+            )
+        return True
+
+    async def put(self, s3_bucket, s3_key, body, content_type):
+        """
+        Upload an object
+
+        :param s3_bucket: Name of the S3 bucket
+        :param s3_key: S3 key
+        :param body: Content of the object, bytes or a file object
+        :param content_type: Content type of the object
+        """
+
+        async def put_object():
+            # Retries send the body again from the start
+            if hasattr(body, "seek"):
+                body.seek(0)
+            return await self.s3.put_object(
+                Bucket=s3_bucket, Key=s3_key, Body=body, ContentType=content_type
             )
 
-    # Create stac metadata
-    name = nci_metadata_file_path.stem.replace(".odc-metadata", "")
-    stac_output_file_path = nci_metadata_file_path.with_name(f"{name}.stac-item.json")
-    stac_url_path = f"{s3_base_url if s3_base_url else boto3.client('s3').meta.endpoint_url}/{s3_path}/"
-    item_doc = dc_to_stac(
-        serialise.from_doc(temp_metadata),
-        nci_metadata_file_path,
-        stac_output_file_path,
-        stac_url_path,
-        explorer_base_url,
-        True,
-    )
-    stac_dump = json.dumps(item_doc, indent=4, default=json_fallback)
-
-    # Write stac json to buffer
-    with io.BytesIO() as temp_stac:
-        temp_stac.write(stac_dump.encode())
-        temp_stac.seek(
-            0
-        )  # Seek back to the beginning of the file before next read/write
-        new_checksum_list[stac_output_file_path.name] = verify.calculate_hash(temp_stac)
-
-        # Write stac metadata json object into S3
-        s3_stac_file = f"{s3_path}/{stac_output_file_path.name}"
         try:
-            upload_s3_resource(
-                s3_bucket,
-                s3_stac_file,
-                temp_stac.getvalue(),
-                content_type="application/json",
+            await self.call(S3_REQUESTS, put_object)
+        except (BotoCoreError, ClientError) as exception:
+            raise S3SyncException(str(exception))
+
+    async def publish(self, sns_topic, message, message_attributes):
+        """
+        Publish a message to the SNS topic
+
+        :param sns_topic: ARN of the SNS topic
+        :param message: SNS message
+        :param message_attributes: SNS message attributes
+        """
+        try:
+            with STATSD.timer("duration.sns"):
+                await self.call(
+                    SNS_REQUESTS,
+                    self.sns.publish,
+                    TopicArn=sns_topic,
+                    Message=message,
+                    MessageAttributes=message_attributes,
+                )
+        except (BotoCoreError, ClientError) as exception:
+            raise S3SyncException(str(exception))
+
+    async def read_s3_checksum_file(self, s3_bucket, s3_checksum_file):
+        """
+        Parse a checksum file uploaded to S3
+
+        :param s3_bucket: Name of the S3 bucket
+        :param s3_checksum_file: Path of checksum file in S3
+        :return: Dict of filename to sha1, empty if there is no checksum file
+        """
+        try:
+            response = await self.call(
+                S3_REQUESTS,
+                self.s3.get_object,
+                Bucket=s3_bucket,
+                Key=s3_checksum_file,
             )
-            LOG.info(f"Finished uploading STAC metadata to {s3_stac_file}")
-        except S3SyncException as exp:
-            LOG.error(f"Failed uploading STAC metadata to {s3_stac_file} - {exp}")
-            metadata_error_list.append(
-                f"Failed uploading STAC metadata to {s3_stac_file} - {exp}"
+            async with response["Body"] as stream:
+                body = await stream.read()
+        except ClientError as exception:
+            if exception.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return {}
+            raise S3SyncException(str(exception))
+        except BotoCoreError as exception:
+            raise S3SyncException(str(exception))
+        return parse_checksums(body.decode("utf-8").splitlines())
+
+    async def run_steps(self, steps):
+        """
+        Asyncio version of run_steps, awaiting each operation
+
+        :param steps: Generator of operations
+        :return: Value returned by the generator
+        """
+        send, value = steps.send, None
+        while True:
+            try:
+                operation, *args = send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, send = await getattr(self, operation)(*args), steps.send
+            except S3SyncException as exception:
+                value, send = exception, steps.throw
+
+    async def process_granule(self, granule_row, existence_index=None):
+        """
+        Asyncio version of process_granule
+
+        :param granule_row: Row of the csv file, metadata path and archived date
+        :param existence_index: S3ExistenceIndex built for the chunk of granules
+        :return: List of errors
+        """
+        if is_archived_row(granule_row):
+            return await self.run_in_executor(
+                process_granule,
+                granule_row,
+                self.nci_dir,
+                self.s3_root_path,
+                self.s3_bucket,
+                self.s3_base_url,
+                self.explorer_base_url,
+                self.sns_topic,
+                update=self.update,
+                transfer=self.transfer,
+                existence_index=existence_index,
+                journal=self.journal,
+                publisher=self.publisher,
+                archiver=self.archiver,
             )
 
-    # Publish message containing STAC metadata to SNS Topic
-    message_attributes = get_common_message_attributes(json.loads(stac_dump))
-    message_attributes.update(
-        {"action": {"DataType": "String", "StringValue": "ADDED"}}
-    )
-    try:
-        publish_sns(sns_topic, stac_dump, message_attributes)
-        LOG.info(f"Finished publishing SNS Message to SNS Topic {sns_topic}")
-    except S3SyncException as exp:
-        LOG.error(f"Failed publishing SNS Message to SNS Topic {sns_topic} - {exp}")
-        metadata_error_list.append(
-            f"Failed publishing SNS Message to SNS Topic {sns_topic} - {exp}"
-        )
+        metadata_file = granule_row[0]
+        granule = Path(metadata_file).relative_to(self.nci_dir).parent
+        with granule_log_context(granule):
+            if is_granule_complete(
+                metadata_file,
+                granule,
+                False,
+                self.journal.completed_stages(metadata_file),
+            ):
+                return []
+            return await self.run_steps(
+                added_granule_steps(
+                    metadata_file,
+                    self.nci_dir,
+                    self.s3_root_path,
+                    self.s3_bucket,
+                    self.s3_base_url,
+                    self.explorer_base_url,
+                    self.sns_topic,
+                    self.journal,
+                    update=self.update,
+                    transfer=self.transfer,
+                    existence_index=existence_index,
+                    publisher=self.publisher,
+                    delta=self.delta,
+                    compact_stac=self.compact_stac,
+                )
+            )
 
-    # Update checksum file
-    checksum_filename = nci_metadata_file_path.stem.replace(".odc-metadata", "")
-    checksum_file_path = nci_metadata_file_path.with_name(f"{checksum_filename}.sha1")
-    try:
-        upload_checksum(
-            nci_metadata_file_path,
-            checksum_file_path,
-            new_checksum_list,
-            s3_bucket,
-            s3_path,
-        )
-        LOG.info(
-            f"Finished uploading checksum file " f"{s3_path}/{checksum_file_path.name}"
-        )
-    except S3SyncException as exp:
-        LOG.error(
-            f"Failed uploading checksum file "
-            f"{s3_path}/{checksum_file_path.name} - {exp}"
-        )
-        metadata_error_list.append(
-            f"Failed uploading checksum file "
-            f"{s3_path}/{checksum_file_path.name} - {exp}"
-        )
+    async def process_granules(self, granule_chunks, build_index=None, concurrency=100):
+        """
+        Process granules concurrently, reading them a chunk at a time
 
-    return metadata_error_list
+        :param granule_chunks: Iterable of lists of rows of the csv file
+        :param build_index: Function building the S3ExistenceIndex of a chunk
+        :param concurrency: Maximum number of granules processed at once
+        :return: Number of granules processed, and list of errors
+        """
+        error_list = []
+        granules_count = 0
+        pending = set()
 
+        def collect(done):
+            for task in done:
+                error_list.extend(task.result())
 
-def archive_granule(granule, s3_root_path, s3_bucket):
-    """
-    Run AWS rm command to delete granules from S3 bucket
+        for granule_rows in granule_chunks:
+            index = None
+            if build_index is not None:
+                index = await self.run_in_executor(build_index, granule_rows)
+            for granule_row in granule_rows:
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    collect(done)
+                pending.add(
+                    asyncio.ensure_future(self.process_granule(granule_row, index))
+                )
+                granules_count += 1
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            collect(done)
+        return granules_count, error_list
 
-    :param granule: Name of the granule
-    :param s3_root_path: Root folder of the S3 bucket
-    :param s3_bucket: Name of the S3 bucket
-    :return: Returns code zero, if success.
-    """
-    s3_path = f"s3://{s3_bucket}/{s3_root_path}/{granule}"
 
-    # Remove any data that shouldn't be there and exclude the metadata
-    command = f"aws s3 rm {s3_path} --only-show-error --recursive "
+async def async_process_granules(
+    granule_chunks, build_index=None, concurrency=100, workers=4, **options
+):
+    """
+    Process granules with AsyncUploader, on aiobotocore clients
 
-    return_code = subprocess.call(command, shell=True)
+    :param granule_chunks: Iterable of lists of rows of the csv file
+    :param build_index: Function building the S3ExistenceIndex of a chunk
+    :param concurrency: Maximum number of granules processed at once
+    :param workers: Number of threads running the blocking work
+    :param options: Parameters of AsyncUploader
+    :return: Number of granules processed, and list of errors
+    """
+    if get_aio_session is None:
+        raise S3SyncException("The asyncio mode needs aiobotocore")
 
-    if return_code != 0:
-        raise S3SyncException("Failed running S3 rm command")
+    session = get_aio_session()
+    # Only the controllers retry requests
+    config = AioConfig(
+        max_pool_connections=concurrency,
+        retries={"total_max_attempts": SINGLE_ATTEMPT},
+    )
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="granule"
+    ) as executor:
+        async with session.create_client(
+            "s3", config=config
+        ) as s3, session.create_client("sns", config=config) as sns:
+            uploader = AsyncUploader(s3, sns, executor, **options)
+            return await uploader.process_granules(
+                granule_chunks, build_index, concurrency
+            )
 
 
-def sync_granule(
-    granule,
+def plan_sync(
+    file_path,
     nci_dir,
     s3_root_path,
     s3_bucket,
-    exclude=["ga_*_nbar_*.*", "ga_*_nbar-*.*", "*.sha1", "*.stac-item.json", "*.odc-metadata.yaml"],
-    cross_account=False,
+    update=False,
+    existence_index=True,
+    index_group_depth=1,
+    journal_path=None,
+    chunk_size=1000,
+    delta=False,
+    bandwidth=100.0,
 ):
     """
-    Run AWS sync command to sync granules to S3 bucket
+    Estimate what syncing the granules would move, without changing anything
 
-    :param granule: Name of the granule
+    Granules are skipped the same way sync_granules skips them, by the journal
+    and by the existence index, and the files of the others are found with the
+    same exclude patterns. Every file of a granule is counted, so for granules
+    already partly in S3 the plan is an upper bound.
+
+    :param file_path: File path for the csv file listing scenes path
     :param nci_dir: Source directory for the files in NCI
     :param s3_root_path: Root folder of the S3 bucket
     :param s3_bucket: Name of the S3 bucket
-    :param exclude: list of file patterns to exclude.
-    :return: Returns code zero, if success.
+    :param update: Sets flag for a fresh sync of data and replace the metadata
+    :param existence_index: Check which granules exist with a few prefix listings,
+    otherwise every added granule is planned
+    :param index_group_depth: Number of directory levels that granules listed
+    together may differ by, None to list each chunk under its deepest shared prefix
+    :param journal_path: Path of the SyncJournal file a run would resume from
+    :param chunk_size: Number of rows of the csv file read, and checked in S3, at a time
+    :param delta: Count reading the checksum file in S3 of every granule
+    :param bandwidth: Upload bandwidth in MB/s to estimate the duration with
+    :return: JSON serialisable plan
     """
-    local_path = Path(nci_dir).joinpath(granule)
-    s3_path = f"s3://{s3_bucket}/{s3_root_path}/{granule}"
+    # Don't leave a new journal behind
+    if journal_path is not None and not os.path.exists(journal_path):
+        journal_path = None
 
-    # Remove any data that shouldn't be there and exclude the metadata
-    exclude_string = ""
-    if exclude:
-        exclude_string = " ".join(f"--exclude {pattern}" for pattern in exclude)
+    plan = {
+        "granules": {
+            "added": 0,
+            "archived": 0,
+            "existing": 0,
+            "complete": 0,
+            "missing": 0,
+        },
+        "files": 0,
+        "bytes": 0,
+        "s3_requests": 0,
+        "sns_messages": 0,
+    }
+    granule_counts = plan["granules"]
 
-    command = f"aws s3 sync {local_path} {s3_path} --only-show-errors {exclude_string}"
-    if cross_account:
-        command += " --acl bucket-owner-full-control"
+    journal = SyncJournal(journal_path) if journal_path else SyncJournal()
+    try:
+        for granule_rows in chunked(find_granules(file_path), chunk_size):
+            index = None
+            if existence_index:
+                index = build_existence_index(
+                    granule_rows,
+                    nci_dir,
+                    s3_root_path,
+                    s3_bucket,
+                    update,
+                    journal,
+                    group_depth=index_group_depth,
+                )
 
-    return_code = subprocess.call(command, shell=True)
+            for granule_row in granule_rows:
+                if not granule_row:
+                    continue
+                metadata_file = granule_row[0]
+                completed_stages = journal.completed_stages(metadata_file)
+                is_archived = is_archived_row(granule_row)
+                if completed_stages >= (
+                    ARCHIVED_STAGES if is_archived else ADDED_STAGES
+                ):
+                    granule_counts["complete"] += 1
+                    continue
 
-    if return_code != 0:
-        raise S3SyncException("Failed running S3 sync command. Return error code: " + return_code)
+                if is_archived:
+                    # Listing the objects, and their share of a DeleteObjects request
+                    granule_counts["archived"] += 1
+                    plan["s3_requests"] += 2
+                    if index is not None and not index.covers(
+                        get_s3_metadata_file(metadata_file, nci_dir, s3_root_path)
+                    ):
+                        # The HEAD request checking it's in S3
+                        plan["s3_requests"] += 1
+                    plan["sns_messages"] += 1
+                    continue
+
+                metadata_file_path = Path(metadata_file)
+                if not metadata_file_path.exists():
+                    granule_counts["missing"] += 1
+                    continue
+                s3_metadata_file = get_s3_metadata_file(
+                    metadata_file, nci_dir, s3_root_path
+                )
+                if (
+                    index is not None
+                    and not completed_stages
+                    and not update
+                    and index.exists(s3_metadata_file)
+                ):
+                    granule_counts["existing"] += 1
+                    continue
+
+                granule_counts["added"] += 1
+                if SyncJournal.SYNCED not in completed_stages:
+                    # Listing the objects of the granule before uploading
+                    plan["s3_requests"] += 2 if delta else 1
+                    for _relative_path, path in granule_files(
+                        metadata_file_path.parent, DEFAULT_EXCLUDE
+                    ):
+                        size = path.stat().st_size
+                        plan["files"] += 1
+                        plan["bytes"] += size
+                        plan["s3_requests"] += upload_request_count(size)
+                plan["s3_requests"] += METADATA_UPLOAD_REQUESTS
+                plan["sns_messages"] += 1
+            if index is not None:
+                # The listings, and the HEAD requests of the granules they don't cover
+                plan["s3_requests"] += index.request_count
+    finally:
+        journal.close()
+
+    plan["bandwidth"] = bandwidth
+    plan["estimated_seconds"] = round(plan["bytes"] / (bandwidth * MB), 1)
+    return plan
 
 
 def sync_granules(
@@ -465,6 +3633,27 @@ def sync_granules(
     explorer_base_url,
     sns_topic,
     update=False,
+    workers=1,
+    transfer_backend="native",
+    transfer_concurrency=10,
+    existence_index=True,
+    index_group_depth=1,
+    journal_path=None,
+    sns_batch=True,
+    sns_batch_wait=1.0,
+    chunk_size=1000,
+    delta=False,
+    compact_stac=False,
+    asyncio_mode=False,
+    async_concurrency=100,
+    pipeline=False,
+    sync_workers=4,
+    metadata_workers=2,
+    publish_workers=2,
+    queue_size=None,
+    queue_report_interval=60.0,
+    queue_report_path=None,
+    error_report_path=None,
 ):
     """
     Sync granules to S3 bucket for specified dates
@@ -477,139 +3666,259 @@ def sync_granules(
     :param explorer_base_url: Base URL of the Explorer
     :param sns_topic: ARN of the SNS topic
     :param update: Sets flag for a fresh sync of data and replace the metadata
+    :param workers: Number of granules to process concurrently
+    :param transfer_backend: 'native' to transfer in-process with boto3, or 'cli'
+    to run the AWS CLI for every granule
+    :param transfer_concurrency: Maximum number of concurrent part uploads shared
+    by all granules, for the native backend
+    :param existence_index: Check which granules exist with a few prefix listings,
+    instead of a HEAD request per granule
+    :param index_group_depth: Number of directory levels that granules listed
+    together may differ by, None to list each chunk under its deepest shared prefix
+    :param journal_path: Path of the SyncJournal file to resume from and record to
+    :param sns_batch: Publish SNS messages in batches with PublishBatch
+    :param sns_batch_wait: Seconds an SNS message may wait for its batch to fill,
+    0 to send every message straight away
+    :param chunk_size: Number of rows of the csv file read, and checked in S3, at a time
+    :param delta: Only upload files whose content changed, according to the
+    checksum files in NCI and S3, with the native transfer backend
+    :param compact_stac: Upload STAC items without indentation
+    :param asyncio_mode: Send the metadata requests of many granules at once from
+    an asyncio event loop, workers is then the number of threads syncing data
+    and generating metadata
+    :param async_concurrency: Maximum number of granules processed at once in
+    asyncio mode
+    :param pipeline: Sync data, upload metadata and publish SNS messages in
+    separate stages, each with its own workers and a bounded queue
+    :param sync_workers: Number of threads syncing data in the pipeline
+    :param metadata_workers: Number of threads generating and uploading metadata
+    in the pipeline
+    :param publish_workers: Number of threads publishing SNS messages and
+    uploading checksum files in the pipeline
+    :param queue_size: Maximum number of granules waiting for each stage of the
+    pipeline, twice the number of its workers by default
+    :param queue_report_interval: Seconds between reporting the queue depths of
+    the pipeline
+    :param queue_report_path: Path of the JSON file to write the latest queue
+    depths of the pipeline to
+    :param error_report_path: Path of the JSON file to write the number of
+    granules processed and the errors to, for merging the reports of shards
     """
     # Initialise error list
     error_list = []
+    granules_count = 0
 
-    # Get list of granules
-    list_of_granules = find_granules(file_path)
-    granules_count = len(list_of_granules)
-    LOG.info(f"Found {granules_count} files to process")
-
-    # For each granule, sync it if it needs syncing
-    if granules_count > 0:
-        for granule_row in list_of_granules:
-
-            metadata_file = granule_row[0] if len(granule_row) > 0 else None
-            is_archived = True if (len(granule_row) > 1 and granule_row[1]) else False
-            action = "archived" if is_archived else "added"
-            LOG.info(f"Processing {action} granule - {metadata_file} ")
-
-            metadata_file_path = Path(metadata_file)
-            granule = metadata_file_path.relative_to(nci_dir).parent
-            metadata_file_name = metadata_file_path.name
-            s3_path = f"{s3_root_path}/{granule}"
-            s3_metadata_file = f"{s3_path}/{metadata_file_name}"
-            s3_stac_file = f"{s3_path}/{metadata_file_path.stem.replace('.odc-metadata', '')}.stac-item.json"
-
-            if is_archived:
-                # Checks if metadata file exists in S3
-                exists_in_s3 = check_granule_exists(s3_bucket, s3_metadata_file)
-                if exists_in_s3:
-                    try:
-                        stac_dump = json.load(load_s3_resource(s3_bucket, s3_stac_file))
+    transfer = None
+    if transfer_backend == "native":
+        transfer = NativeTransfer(
+            max_concurrency=transfer_concurrency,
+            workers=sync_workers if pipeline else workers,
+        )
 
-                        # Delete all files from the S3 path
-                        archive_granule(granule, s3_root_path, s3_bucket)
-                        LOG.info(f"Finished S3 archive of granule - {granule}")
+    journal = SyncJournal(journal_path) if journal_path else SyncJournal()
+    # The cli backend deletes with the AWS CLI too
+    archiver = S3Archiver() if transfer is not None else None
+    publisher = None
+    if sns_batch:
+        publisher = BatchPublisher(sns_topic, max_wait=sns_batch_wait)
 
-                        # Publish message containing STAC metadata to SNS Topic
-                        message_attributes = get_common_message_attributes(stac_dump)
-                        message_attributes.update(
-                            {
-                                "action": {
-                                    "DataType": "String",
-                                    "StringValue": "ARCHIVED",
-                                }
-                            }
-                        )
-                        try:
-                            publish_sns(
-                                sns_topic, json.dumps(stac_dump), message_attributes
-                            )
-                            LOG.info(
-                                f"Finished publishing SNS Message to SNS Topic {sns_topic}"
-                            )
-                        except S3SyncException as exp:
-                            LOG.error(
-                                f"Failed publishing SNS Message to SNS Topic {sns_topic} - {exp}"
-                            )
-                            error_list.append(
-                                f"Failed publishing SNS Message to SNS Topic {sns_topic} - {exp}"
-                            )
+    def build_index(granule_rows):
+        return build_existence_index(
+            granule_rows,
+            nci_dir,
+            s3_root_path,
+            s3_bucket,
+            update,
+            journal,
+            group_depth=index_group_depth,
+        )
 
-                    except S3SyncException as exp:
-                        LOG.error(
-                            f"Failed to archive {granule} "
-                            f"because of an error in the rm command - {exp}"
-                        )
-                        error_list.append(
-                            f"Failed to archive {granule} "
-                            f"because of an error in the rm command - {exp}"
-                        )
-                else:
-                    LOG.warning(
-                        f"Metadata doesn't exists in S3, "
-                        f"not deleting anything from S3 for {granule}"
-                    )
-            else:
+    def indexed_granules():
+        # Read the csv file lazily, a chunk at a time, so memory use doesn't
+        # depend on the length of the list
+        for granule_rows in chunked(find_granules(file_path), chunk_size):
+            index = build_index(granule_rows) if existence_index else None
+            for granule_row in granule_rows:
+                yield granule_row, index
 
-                # Checking if metadata file exists
-                if metadata_file_path.exists():
-                    # s3://dea-public-data
-                    # /analysis-ready-data/ga_ls5t_ard_3/088/080/1990/11/15
-                    # /ga_ls5t_ard_3-0-0_088080_1990-11-15_final.odc-metadata.yaml
+    def process(indexed_granule):
+        granule_row, index = indexed_granule
+        return process_granule(
+            granule_row,
+            nci_dir,
+            s3_root_path,
+            s3_bucket,
+            s3_base_url,
+            explorer_base_url,
+            sns_topic,
+            update=update,
+            transfer=transfer,
+            existence_index=index,
+            journal=journal,
+            publisher=publisher,
+            delta=delta,
+            archiver=archiver,
+            compact_stac=compact_stac,
+        )
 
-                    already_processed = check_granule_exists(
-                        s3_bucket, s3_metadata_file
-                    )
+    def pipeline_jobs():
+        for granule_row, index in indexed_granules():
+            metadata_file = granule_row[0]
+            granule = Path(metadata_file).relative_to(nci_dir).parent
+            yield {
+                "row": granule_row,
+                "index": index,
+                "metadata_file": metadata_file,
+                "granule": granule,
+                "s3_path": f"{s3_root_path}/{granule}",
+                "checksums": None,
+                "errors": [],
+            }
 
-                    # Check if already processed and update flag set to force replace
-                    if not already_processed or update:
-                        try:
-                            sync_granule(granule, nci_dir, s3_root_path, s3_bucket)
-                            LOG.info(f"Finished S3 sync of granule - {granule}")
+    def sync_stage(job):
+        if is_archived_row(job["row"]):
+            # Archiving is a few requests, done in the first stage
+            job["errors"].extend(process((job["row"], job["index"])))
+            return False
+        with granule_log_context(job["granule"]):
+            if is_granule_complete(
+                job["metadata_file"],
+                job["granule"],
+                False,
+                journal.completed_stages(job["metadata_file"]),
+            ):
+                return False
+            synced, job["checksums"], sync_error_list = sync_added_granule(
+                job["metadata_file"],
+                nci_dir,
+                s3_root_path,
+                s3_bucket,
+                update=update,
+                transfer=transfer,
+                existence_index=job["index"],
+                journal=journal,
+                delta=delta,
+            )
+            job["errors"].extend(sync_error_list)
+            return synced
 
-                            # s3 sync and metadata update happen in same section
-                            metadata_update_error_list = upload_metadata(
-                                metadata_file,
-                                s3_bucket,
-                                s3_base_url,
-                                explorer_base_url,
-                                sns_topic,
-                                s3_path,
-                            )
-                            error_list.extend(metadata_update_error_list)
+    def metadata_stage(job):
+        with granule_log_context(job["granule"]):
+            (
+                job["generated"],
+                job["checksums"],
+                metadata_error_list,
+            ) = upload_metadata_documents(
+                job["metadata_file"],
+                s3_bucket,
+                s3_base_url,
+                explorer_base_url,
+                job["s3_path"],
+                journal=journal,
+                checksums=job["checksums"],
+                compact_stac=compact_stac,
+            )
+            job["errors"].extend(metadata_error_list)
+            return True
 
-                        # if the s3 sync has exception, not touch metadata
-                        except S3SyncException as exp:
-                            LOG.error(
-                                f"Failed to sync of {granule} "
-                                f"because of an error in the sync command - {exp}"
-                            )
-                            error_list.append(
-                                f"Failed to sync of {granule} "
-                                f"because of an error in the sync command - {exp}"
-                            )
+    def publish_stage(job):
+        with granule_log_context(job["granule"]):
+            job["errors"].extend(
+                publish_metadata(
+                    job["metadata_file"],
+                    job["generated"],
+                    s3_bucket,
+                    sns_topic,
+                    job["s3_path"],
+                    journal=journal,
+                    publisher=publisher,
+                    checksums=job["checksums"],
+                )
+            )
+            return True
 
-                    else:
-                        LOG.warning(
-                            f"Metadata exists in S3 and update is not set to True, "
-                            f"not syncing {granule}"
-                        )
+    # For each granule, sync it if it needs syncing
+    try:
+        if pipeline:
+            LOG.info(
+                f"Processing granules with {sync_workers} sync, "
+                f"{metadata_workers} metadata and {publish_workers} publish workers"
+            )
+            staged_pipeline = StagedPipeline(
+                [
+                    ("sync", sync_stage, sync_workers),
+                    ("metadata", metadata_stage, metadata_workers),
+                    ("publish", publish_stage, publish_workers),
+                ],
+                queue_size=queue_size,
+                report_interval=queue_report_interval,
+                report_path=queue_report_path,
+            )
+            granules_count = staged_pipeline.run(pipeline_jobs())
+            error_list.extend(staged_pipeline.errors)
+        elif asyncio_mode:
+            LOG.info(
+                f"Processing up to {async_concurrency} granules at once "
+                f"with asyncio and {workers} workers"
+            )
+            granules_count, async_error_list = asyncio.run(
+                async_process_granules(
+                    chunked(find_granules(file_path), chunk_size),
+                    build_index if existence_index else None,
+                    concurrency=async_concurrency,
+                    workers=workers,
+                    nci_dir=nci_dir,
+                    s3_root_path=s3_root_path,
+                    s3_bucket=s3_bucket,
+                    s3_base_url=s3_base_url,
+                    explorer_base_url=explorer_base_url,
+                    sns_topic=sns_topic,
+                    update=update,
+                    transfer=transfer,
+                    journal=journal,
+                    publisher=publisher,
+                    archiver=archiver,
+                    delta=delta,
+                    compact_stac=compact_stac,
+                )
+            )
+            error_list.extend(async_error_list)
+        elif workers > 1:
+            LOG.info(f"Processing granules with {workers} workers")
+            with ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="granule"
+            ) as executor:
+                for granule_error_list in bounded_map(
+                    executor, process, indexed_granules(), window=workers * 2
+                ):
+                    granules_count += 1
+                    error_list.extend(granule_error_list)
+        else:
+            for indexed_granule in indexed_granules():
+                granules_count += 1
+                error_list.extend(process(indexed_granule))
+    finally:
+        # Archived granules publish their SNS message once they're deleted
+        if archiver is not None:
+            archiver.close()
+            error_list.extend(archiver.errors)
+        if publisher is not None:
+            publisher.close()
+            error_list.extend(publisher.errors)
+        if transfer is not None:
+            transfer.close()
+        journal.close()
 
-                else:
-                    LOG.error(
-                        f"Failed to sync {metadata_file} "
-                        f"because of missing metadata file in NCI"
-                    )
-                    error_list.append(
-                        f"Failed to sync {metadata_file} "
-                        f"because of missing metadata file in NCI"
-                    )
+    if granules_count > 0:
+        LOG.info(f"Processed {granules_count} granules")
     else:
         LOG.warning("Didn't find any granules to process...")
 
+    if error_report_path is not None:
+        write_json_report(
+            error_report_path, {"granules": granules_count, "errors": error_list}
+        )
+
     # Raise exception if there was any error during sync process
     if error_list:
         raise S3SyncException("\n".join(error_list))
@@ -632,6 +3941,38 @@ class S3SyncException(Exception):
 @click.option("--explorerbaseurl", "-e", type=str, default="")
 @click.option("--snstopic", "-t", type=str, required=True)
 @click.option("--force-update", is_flag=True)
+@click.option("--workers", "-w", type=click.IntRange(min=1), default=1)
+@click.option(
+    "--transfer-backend", type=click.Choice(["native", "cli"]), default="native"
+)
+@click.option("--transfer-concurrency", type=click.IntRange(min=1), default=10)
+@click.option("--max-pool-connections", type=click.IntRange(min=1), default=10)
+@click.option("--existence-index/--no-existence-index", default=True)
+@click.option("--index-group-depth", type=click.IntRange(min=0), default=1)
+@click.option("--index-batch-prefix", is_flag=True)
+@click.option("--journal", type=click.Path(dir_okay=False), default=None)
+@click.option("--sns-batch/--no-sns-batch", default=True)
+@click.option("--sns-batch-wait", type=click.FloatRange(min=0), default=1.0)
+@click.option("--chunk-size", type=click.IntRange(min=1), default=1000)
+@click.option("--delta", is_flag=True)
+@click.option("--compact-stac", is_flag=True)
+@click.option("--skip-known-stac-layouts", is_flag=True)
+@click.option("--asyncio", "asyncio_mode", is_flag=True)
+@click.option("--async-concurrency", type=click.IntRange(min=1), default=100)
+@click.option("--pipeline", is_flag=True)
+@click.option("--sync-workers", type=click.IntRange(min=1), default=4)
+@click.option("--metadata-workers", type=click.IntRange(min=1), default=2)
+@click.option("--publish-workers", type=click.IntRange(min=1), default=2)
+@click.option("--queue-size", type=click.IntRange(min=1), default=None)
+@click.option("--queue-report-interval", type=click.FloatRange(min=0), default=60.0)
+@click.option("--queue-report", type=click.Path(dir_okay=False), default=None)
+@click.option("--error-report", type=click.Path(dir_okay=False), default=None)
+@click.option("--plan", is_flag=True)
+@click.option(
+    "--plan-bandwidth", type=click.FloatRange(min=0, min_open=True), default=100.0
+)
+@click.option("--plan-max-hours", type=click.FloatRange(min=0), default=None)
+@click.option("--statsd-setting", type=str, default=None)
 def main(
     filepath,
     ncidir,
@@ -641,6 +3982,34 @@ def main(
     explorerbaseurl,
     snstopic,
     force_update,
+    workers,
+    transfer_backend,
+    transfer_concurrency,
+    max_pool_connections,
+    existence_index,
+    index_group_depth,
+    index_batch_prefix,
+    journal,
+    sns_batch,
+    sns_batch_wait,
+    chunk_size,
+    delta,
+    compact_stac,
+    skip_known_stac_layouts,
+    asyncio_mode,
+    async_concurrency,
+    pipeline,
+    sync_workers,
+    metadata_workers,
+    publish_workers,
+    queue_size,
+    queue_report_interval,
+    queue_report,
+    error_report,
+    plan,
+    plan_bandwidth,
+    plan_max_hours,
+    statsd_setting,
 ):
     """
     Script to sync Collection 3 data from NCI to AWS S3 bucket
@@ -654,12 +4023,76 @@ def main(
     :param snstopic: ARN of the SNS topic
     :param force_update: If this flag is set then do a fresh sync of data and
     replace the metadata
+    :param workers: Number of granules to process concurrently
+    :param transfer_backend: 'native' to transfer in-process with boto3, or 'cli'
+    to run the AWS CLI for every granule
+    :param transfer_concurrency: Maximum number of concurrent part uploads
+    :param max_pool_connections: Size of the connection pool of each boto3 client
+    :param existence_index: Check which granules exist with a few prefix listings
+    :param index_group_depth: Number of directory levels that granules listed
+    together may differ by
+    :param index_batch_prefix: List each chunk of granules under the deepest
+    prefix they all share, instead of grouping them by index_group_depth
+    :param journal: Path of the SQLite journal of completed stages, which lets a
+    retried run resume where the last one stopped
+    :param sns_batch: Publish SNS messages in batches of up to ten
+    :param sns_batch_wait: Seconds an SNS message may wait for its batch to fill,
+    0 to send every message straight away
+    :param chunk_size: Number of rows of the csv file read, and checked in S3, at a time
+    :param delta: Only upload files whose sha1 or size changed since the last sync,
+    useful with force_update when reprocessing only changed some files
+    :param compact_stac: Upload STAC items without indentation, SNS messages are
+    always compact
+    :param skip_known_stac_layouts: Only validate the STAC items whose layout
+    wasn't validated yet for their product, without checking the values of the
+    others
+    :param asyncio_mode: Send the S3 and SNS requests of many granules at once
+    from an asyncio event loop, needs aiobotocore
+    :param async_concurrency: Maximum number of granules processed at once in
+    asyncio mode
+    :param pipeline: Sync data, upload metadata and publish SNS messages in
+    separate stages, so each can be sized for the resource it's bound by
+    :param sync_workers: Number of threads syncing data in the pipeline
+    :param metadata_workers: Number of threads generating and uploading metadata
+    in the pipeline
+    :param publish_workers: Number of threads publishing SNS messages in the
+    pipeline
+    :param queue_size: Maximum number of granules waiting for each stage of the
+    pipeline
+    :param queue_report_interval: Seconds between reporting the queue depths of
+    the pipeline, 0 to only report them at the end
+    :param queue_report: Path of the JSON file to keep the latest queue depths of
+    the pipeline in, for monitoring which stage is the bottleneck
+    :param error_report: Path of the JSON file to write the number of granules
+    processed and the errors to, even when there are none
+    :param plan: Print a JSON plan of the files, bytes, S3 requests and SNS
+    messages the sync would take, instead of syncing
+    :param plan_bandwidth: Upload bandwidth in MB/s to estimate the duration of
+    the plan with
+    :param plan_max_hours: Fail if the estimated duration of the plan is longer
+    :param statsd_setting: Address of the StatsD server to send timers and
+    counters to, as 'host:port'
     """
-    formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+    if pipeline and asyncio_mode:
+        raise click.UsageError("--pipeline and --asyncio can't be used together")
+    if delta and transfer_backend != "native":
+        raise click.UsageError("--delta needs the native transfer backend")
+    if asyncio_mode and get_aio_session is None:
+        raise click.UsageError("--asyncio needs aiobotocore to be installed")
+
+    formatter = logging.Formatter(
+        "%(name)s - %(levelname)s - %(threadName)s - %(granule)s - %(message)s"
+    )
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
+    handler.addFilter(GranuleLogFilter())
     LOG.setLevel(logging.DEBUG)
     LOG.addHandler(handler)
+    if statsd_setting:
+        STATSD.configure(statsd_setting)
+        LOG.addHandler(StatsdFailureHandler())
+    CLIENTS.max_pool_connections = max_pool_connections
+    STAC_TEMPLATES.validate_known_layouts = not skip_known_stac_layouts
     LOG.info(
         f"Syncing granules listed in file {filepath} "
         f"from NCI dir {ncidir} "
@@ -667,8 +4100,34 @@ def main(
         f"S3 base URL is {s3baseurl} and "
         f"explorerbaseurl is {explorerbaseurl} and "
         f"snstopic is {snstopic} and "
-        f"update is {force_update}"
+        f"update is {force_update} and "
+        f"workers is {workers} and "
+        f"transfer backend is {transfer_backend}"
     )
+    if index_batch_prefix:
+        index_group_depth = None
+    if plan:
+        sync_plan = plan_sync(
+            filepath,
+            ncidir,
+            s3path,
+            s3bucket,
+            update=force_update,
+            existence_index=existence_index,
+            index_group_depth=index_group_depth,
+            journal_path=journal,
+            chunk_size=chunk_size,
+            delta=delta,
+            bandwidth=plan_bandwidth,
+        )
+        click.echo(json.dumps(sync_plan, indent=2))
+        estimated_hours = sync_plan["estimated_seconds"] / 3600
+        if plan_max_hours is not None and estimated_hours > plan_max_hours:
+            raise click.ClickException(
+                f"Plan would take an estimated {estimated_hours:.1f} hours, "
+                f"more than {plan_max_hours}"
+            )
+        return
     sync_granules(
         filepath,
         ncidir,
@@ -678,6 +4137,27 @@ def main(
         explorerbaseurl,
         snstopic,
         force_update,
+        workers,
+        transfer_backend,
+        transfer_concurrency,
+        existence_index,
+        index_group_depth,
+        journal,
+        sns_batch,
+        sns_batch_wait,
+        chunk_size,
+        delta,
+        compact_stac,
+        asyncio_mode,
+        async_concurrency,
+        pipeline,
+        sync_workers,
+        metadata_workers,
+        publish_workers,
+        queue_size,
+        queue_report_interval,
+        queue_report,
+        error_report,
     )
 
 
@@ -1,29 +1,308 @@
 #!/usr/bin/env python
 
+import heapq
 import os
 import sys
+import tempfile
 
+import click
 import humanize
 import psutil
 
 process = psutil.Process(os.getpid())
-file1 = sys.argv[1]
-file2 = sys.argv[2]
 
-print(f"Computing {file1} - {file2}", file=sys.stderr)
+MB = 1024 * 1024
+# Number of sorted runs merged at once, each reading through its own file buffer
+MAX_FAN_IN = 64
+_END = object()
 
-with open(sys.argv[1]) as fin:
-    set1 = set(line.strip() for line in fin.readlines())
 
-with open(sys.argv[2]) as fin:
-    set2 = set(line.strip() for line in fin.readlines())
+def unique(sorted_lines):
+    """
+    :param sorted_lines: Iterable of sorted lines
+    :return: Generator of the lines, without the repeated ones
+    """
+    previous = _END
+    for line in sorted_lines:
+        if line != previous:
+            yield line
+            previous = line
 
-print(f"len(set1) = {len(set1)}, len(set2) = {len(set2)}", file=sys.stderr)
 
-# or
-# import resource
-# resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-print(f"Current RAM: {humanize.naturalsize(process.memory_info().rss)}", file=sys.stderr)
+def write_run(lines, tmp_dir):
+    """
+    Sort lines and write them to a temporary run file, once each
 
-for line in sorted(set1 - set2):
-    print(line)
+    :param lines: List of lines, sorted in place
+    :param tmp_dir: Directory of the run files
+    :return: Path of the run file
+    """
+    lines.sort()
+    with tempfile.NamedTemporaryFile(
+        "w", dir=tmp_dir, suffix=".run", delete=False
+    ) as run:
+        for line in unique(lines):
+            run.write(f"{line}\n")
+    return run.name
+
+
+def read_run(path):
+    """
+    :param path: Path of a run file
+    :return: Generator of its lines
+    """
+    with open(path) as run:
+        for line in run:
+            yield line[:-1]
+
+
+def sorted_runs(path, memory_cap, tmp_dir):
+    """
+    Split a file into sorted runs of its stripped lines, each one sorted in memory
+
+    :param path: Path of the file
+    :param memory_cap: Bytes of lines to hold in memory at most
+    :param tmp_dir: Directory of the run files
+    :return: List of the paths of the run files
+    """
+    runs = []
+    chunk, size = [], 0
+    with open(path) as fin:
+        for line in fin:
+            line = line.strip()
+            chunk.append(line)
+            # The string, and its pointer in the list
+            size += sys.getsizeof(line) + 8
+            if size >= memory_cap:
+                runs.append(write_run(chunk, tmp_dir))
+                chunk, size = [], 0
+    if chunk or not runs:
+        runs.append(write_run(chunk, tmp_dir))
+    return runs
+
+
+def merged_lines(runs, tmp_dir):
+    """
+    Merge sorted run files into one stream of sorted unique lines
+
+    Runs are merged MAX_FAN_IN at a time into longer runs first, when there
+    are more of them, so only that many files are open at once.
+    :param runs: List of the paths of the run files
+    :param tmp_dir: Directory of the intermediate run files
+    :return: Generator of the lines
+    """
+    runs = list(runs)
+    while len(runs) > MAX_FAN_IN:
+        batch, runs = runs[:MAX_FAN_IN], runs[MAX_FAN_IN:]
+        with tempfile.NamedTemporaryFile(
+            "w", dir=tmp_dir, suffix=".run", delete=False
+        ) as run:
+            for line in unique(heapq.merge(*(read_run(path) for path in batch))):
+                run.write(f"{line}\n")
+        for path in batch:
+            os.remove(path)
+        runs.append(run.name)
+    return unique(heapq.merge(*(read_run(path) for path in runs)))
+
+
+def merge_diff(left, right):
+    """
+    Walk two streams of sorted unique lines side by side
+
+    :param left: Iterable of sorted unique lines
+    :param right: Iterable of sorted unique lines
+    :return: Generator of ("left", line), ("right", line) or ("common", line)
+    """
+    left, right = iter(left), iter(right)
+    left_line, right_line = next(left, _END), next(right, _END)
+    while left_line is not _END and right_line is not _END:
+        if left_line < right_line:
+            yield "left", left_line
+            left_line = next(left, _END)
+        elif right_line < left_line:
+            yield "right", right_line
+            right_line = next(right, _END)
+        else:
+            yield "common", left_line
+            left_line, right_line = next(left, _END), next(right, _END)
+    while left_line is not _END:
+        yield "left", left_line
+        left_line = next(left, _END)
+    while right_line is not _END:
+        yield "right", right_line
+        right_line = next(right, _END)
+
+
+def streaming_diff(file1, file2, outputs, memory_cap, tmp_dir=None):
+    """
+    Compare two files with an external sort of each, and a merge of the two
+
+    :param file1: Path of the left file
+    :param file2: Path of the right file
+    :param outputs: Dict of "left", "right" and "common" to the files to write
+    those lines to, the lines of the missing ones are dropped
+    :param memory_cap: Bytes of lines to hold in memory at most
+    :param tmp_dir: Directory to create the temporary run files in
+    :return: Dict of the number of lines of each kind
+    """
+    counts = {"left": 0, "right": 0, "common": 0}
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        # One file is sorted at a time, so each can use the whole cap
+        left_runs = sorted_runs(file1, memory_cap, run_dir)
+        right_runs = sorted_runs(file2, memory_cap, run_dir)
+        print(
+            f"Sorted into {len(left_runs)} and {len(right_runs)} runs",
+            file=sys.stderr,
+        )
+        for side, line in merge_diff(
+            merged_lines(left_runs, run_dir), merged_lines(right_runs, run_dir)
+        ):
+            counts[side] += 1
+            if side in outputs:
+                print(line, file=outputs[side])
+    return counts
+
+
+def hashed_lines(path):
+    """
+    :param path: Path of a file
+    :return: Sorted NumPy array of the unique 64-bit hashes of its stripped lines
+    """
+    import numpy
+
+    with open(path) as fin:
+        hashes = numpy.fromiter((hash(line.strip()) for line in fin), dtype=numpy.int64)
+    return numpy.unique(hashes.view(numpy.uint64))
+
+
+def hashed_difference(set1, file2):
+    """
+    Compute the lines of set1 not in a file, holding 8 bytes per line of the file
+
+    The lines of the file are only kept as hashes. A line of set1 whose hash is
+    found might still be missing from the file, when it collides with another
+    line, so those are checked against the file in a second pass over it.
+    Python's string hashes are only stable within a process, which is all
+    this needs.
+    :param set1: Set of lines
+    :param file2: Path of the file
+    :return: Sorted list of the lines, and number of the hashes of the file
+    """
+    import numpy
+
+    hashes2 = hashed_lines(file2)
+    lines1 = list(set1)
+    hashes1 = numpy.fromiter(
+        (hash(line) for line in lines1), dtype=numpy.int64, count=len(lines1)
+    ).view(numpy.uint64)
+
+    found = numpy.zeros(len(lines1), dtype=bool)
+    if len(hashes2):
+        positions = numpy.searchsorted(hashes2, hashes1)
+        found = hashes2[numpy.minimum(positions, len(hashes2) - 1)] == hashes1
+
+    difference = [line for line, hit in zip(lines1, found) if not hit]
+    candidates = {line for line, hit in zip(lines1, found) if hit}
+    with open(file2) as fin:
+        for line in fin:
+            if not candidates:
+                break
+            candidates.discard(line.strip())
+    if candidates:
+        print(f"{len(candidates)} hash collisions", file=sys.stderr)
+    difference.extend(candidates)
+    return sorted(difference), len(hashes2)
+
+
+@click.command()
+@click.argument("file1", type=click.Path(exists=True, dir_okay=False))
+@click.argument("file2", type=click.Path(exists=True, dir_okay=False))
+@click.option("--streaming", is_flag=True)
+@click.option("--hashed", is_flag=True)
+@click.option("--memory-cap", type=click.IntRange(min=1), default=512)
+@click.option("--tmp-dir", type=click.Path(file_okay=False), default=None)
+@click.option("--left-only", type=click.File("w"), default=None)
+@click.option("--right-only", type=click.File("w"), default=None)
+@click.option("--common", type=click.File("w"), default=None)
+def main(
+    file1, file2, streaming, hashed, memory_cap, tmp_dir, left_only, right_only, common
+):
+    """
+    Print the lines of FILE1 that aren't in FILE2, sorted
+
+    Both files are loaded into memory, unless --streaming is given. Then each
+    file is sorted in chunks of at most --memory-cap MB of lines, written to
+    temporary files in --tmp-dir, and the two are merged in one pass.
+
+    With --hashed, only FILE1 is loaded, and FILE2 is kept as a sorted array of
+    64-bit hashes of its lines, checked with vectorised binary searches.
+
+    The lines only in FILE1 go to --left-only instead of stdout when given,
+    and those only in FILE2 and those in both to --right-only and --common.
+    """
+    if hashed and (streaming or right_only is not None or common is not None):
+        raise click.UsageError(
+            "--hashed only computes FILE1 - FILE2, without --streaming, "
+            "--right-only or --common"
+        )
+
+    print(f"Computing {file1} - {file2}", file=sys.stderr)
+
+    outputs = {"left": left_only or sys.stdout}
+    if right_only is not None:
+        outputs["right"] = right_only
+    if common is not None:
+        outputs["common"] = common
+
+    if streaming:
+        counts = streaming_diff(file1, file2, outputs, memory_cap * MB, tmp_dir)
+        print(
+            f"left only = {counts['left']}, right only = {counts['right']}, "
+            f"common = {counts['common']}",
+            file=sys.stderr,
+        )
+        print(
+            f"Current RAM: {humanize.naturalsize(process.memory_info().rss)}",
+            file=sys.stderr,
+        )
+        return
+
+    with open(file1) as fin:
+        set1 = set(line.strip() for line in fin.readlines())
+
+    if hashed:
+        difference, hashes_count = hashed_difference(set1, file2)
+        print(f"len(set1) = {len(set1)}, len(set2) = {hashes_count}", file=sys.stderr)
+        print(
+            f"Current RAM: {humanize.naturalsize(process.memory_info().rss)}",
+            file=sys.stderr,
+        )
+        for line in difference:
+            print(line, file=outputs["left"])
+        return
+
+    with open(file2) as fin:
+        set2 = set(line.strip() for line in fin.readlines())
+
+    print(f"len(set1) = {len(set1)}, len(set2) = {len(set2)}", file=sys.stderr)
+
+    # or
+    # import resource
+    # resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        f"Current RAM: {humanize.naturalsize(process.memory_info().rss)}",
+        file=sys.stderr,
+    )
+
+    for line in sorted(set1 - set2):
+        print(line, file=outputs["left"])
+    if "right" in outputs:
+        for line in sorted(set2 - set1):
+            print(line, file=outputs["right"])
+    if "common" in outputs:
+        for line in sorted(set1 & set2):
+            print(line, file=outputs["common"])
+
+
+if __name__ == "__main__":
+    main()
@@ -5,30 +5,52 @@ Script to sync Sentinel-2 data from NCI to AWS S3 bucket
 import datetime
 import json
 import logging
+import multiprocessing
 import os
+import sqlite3
 import sys
+import threading
+import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures._base import as_completed
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
-import boto3
 import click
-import yaml
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from shapely import wkb
 from shapely.geometry.polygon import Polygon
 from tqdm import tqdm
 
-from eodatasets3 import DatasetAssembler, serialise
+from eodatasets3 import DatasetAssembler, GridSpec, serialise
+from eodatasets3.images import MeasurementBundler
 from eodatasets3.model import AccessoryDoc, DatasetDoc, ProductDoc
-from eodatasets3.scripts.tostac import json_fallback
 from eodatasets3.stac import to_stac_item
-from odc.aws import s3_dump
 
 from c3_to_s3_rolling import (
-    check_granule_exists,
+    CLIENTS,
+    MB,
+    SINGLE_ATTEMPT,
+    STATSD,
+    NativeTransfer,
+    S3ExistenceIndex,
+    StatsdFailureHandler,
+    SyncJournal,
+    bounded_map,
+    chunked,
+    dump_metadata,
+    dump_stac,
+    granule_exists,
+    granule_log_context,
+    load_metadata,
     publish_sns,
     get_common_message_attributes,
     sync_granule,
+    upload_s3_resource,
+    write_json_report,
 )
 
 S2_NBART_NCI = uuid.UUID("3ab25466-5e34-4c84-a760-a89d40a838e1")
@@ -37,6 +59,212 @@ S3_BUCKET = "dea-public-data"
 WORK_DIR = Path("/g/data/v10/work/s2_nbart_rolling_archive")
 _LOG = logging.getLogger("upload_s2_nbart")
 
+# Stages needed to complete the upload of a granule
+S2_STAGES = {
+    SyncJournal.SYNCED,
+    SyncJournal.METADATA,
+    SyncJournal.SNS_ADDED,
+    SyncJournal.STAC,
+}
+
+
+class UploadStats:
+    """
+    Live throughput, stage latencies and slowest granules of an upload run
+
+    The percentiles of each stage are over its last ``window`` durations, so
+    they follow changes in the load during runs lasting days. Snapshots are
+    logged, and written to a JSON file, every ``report_interval`` seconds.
+    """
+
+    STAGES = ("sync", "eo3", "stac", "sns")
+
+    def __init__(self, window=1000, slowest=10):
+        """
+        :param window: Number of the latest durations of each stage kept
+        :param slowest: Number of the slowest granules in flight to report
+        """
+        self.slowest = slowest
+        self.total = None
+        self.counts = {"uploaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+        self._durations = {stage: deque(maxlen=window) for stage in self.STAGES}
+        # Start time of each granule in flight, and its current stage and start
+        self._in_flight = {}
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._reporter = None
+
+    def incr(self, name, value=1):
+        """
+        :param name: One of the counters: uploaded, skipped, failed or bytes
+        :param value: Amount to add
+        """
+        with self._lock:
+            self.counts[name] += value
+
+    @contextmanager
+    def granule(self, granule_id):
+        """
+        Track a granule as in flight during the block, and count it as failed
+        if the block raises
+        """
+        with self._lock:
+            self._in_flight[granule_id] = (time.monotonic(), None, None)
+        try:
+            yield
+        except Exception:
+            self.incr("failed")
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[granule_id]
+
+    @contextmanager
+    def stage(self, granule_id, stage):
+        """
+        Record the duration of a stage of a granule, whether it succeeds or not
+        """
+        start = time.monotonic()
+        with self._lock:
+            if granule_id in self._in_flight:
+                granule_start = self._in_flight[granule_id][0]
+                self._in_flight[granule_id] = (granule_start, stage, start)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._durations[stage].append(time.monotonic() - start)
+
+    def snapshot(self):
+        """
+        :return: Dict of the granule counts, throughput, estimated time left,
+        percentiles of each stage and slowest granules in flight
+        """
+        now = time.monotonic()
+        elapsed = now - self._start
+        with self._lock:
+            counts = dict(self.counts)
+            durations = {
+                stage: sorted(values) for stage, values in self._durations.items()
+            }
+            in_flight = sorted(self._in_flight.items(), key=lambda item: item[1][0])
+
+        granules_per_second = counts["uploaded"] / elapsed if elapsed else 0.0
+        eta_seconds = None
+        if self.total is not None and granules_per_second:
+            done = counts["uploaded"] + counts["skipped"] + counts["failed"]
+            eta_seconds = round(max(self.total - done, 0) / granules_per_second)
+        return {
+            "time": time.time(),
+            "elapsed_seconds": round(elapsed),
+            "granules": {
+                **{name: counts[name] for name in ("uploaded", "skipped", "failed")},
+                "in_flight": len(in_flight),
+                "total": self.total,
+            },
+            "granules_per_second": round(granules_per_second, 3),
+            "mb_per_second": round(counts["bytes"] / MB / elapsed, 3)
+            if elapsed
+            else 0.0,
+            "eta_seconds": eta_seconds,
+            "stages": {
+                stage: {
+                    "count": len(values),
+                    "p50": round(percentile(values, 0.5), 3) if values else None,
+                    "p95": round(percentile(values, 0.95), 3) if values else None,
+                }
+                for stage, values in durations.items()
+            },
+            "slowest_in_flight": [
+                {
+                    "granule": granule_id,
+                    "seconds": round(now - granule_start, 1),
+                    "stage": stage,
+                    "stage_seconds": round(now - stage_start, 1)
+                    if stage_start is not None
+                    else None,
+                }
+                for granule_id, (granule_start, stage, stage_start) in in_flight[
+                    : self.slowest
+                ]
+            ],
+        }
+
+    def report(self, path=None):
+        """
+        Log a snapshot, and write it to a JSON file
+
+        :param path: Path of the JSON file, if any
+        """
+        snapshot = self.snapshot()
+        _LOG.info(f"Upload stats - {json.dumps(snapshot)}")
+        if path is not None:
+            write_json_report(path, snapshot)
+
+    def _report(self, interval, path):
+        while not self._stopped.wait(interval):
+            self.report(path)
+
+    def start_reporting(self, interval, path=None):
+        """
+        Report a snapshot every ``interval`` seconds, from a daemon thread
+
+        :param interval: Seconds between snapshots
+        :param path: Path of the JSON file to write the latest snapshot to
+        """
+        self._reporter = threading.Thread(
+            target=self._report, args=(interval, path), daemon=True
+        )
+        self._reporter.start()
+
+    def stop_reporting(self, path=None):
+        """
+        Stop the reporting thread, and report a last snapshot
+
+        :param path: Path of the JSON file to write the snapshot to
+        """
+        self._stopped.set()
+        if self._reporter is not None:
+            self._reporter.join()
+        self.report(path)
+
+
+STATS = UploadStats()
+
+
+def percentile(sorted_values, fraction):
+    """
+    :param sorted_values: Non empty sorted list of numbers
+    :param fraction: Percentile wanted, between 0 and 1
+    :return: The value of that rank, the nearest one
+    """
+    return sorted_values[round(fraction * (len(sorted_values) - 1))]
+
+
+def start_worker():
+    """
+    Create the boto3 session and clients of an executor thread when it starts,
+    so every granule it uploads reuses them, and their open connections
+    """
+    CLIENTS.resource("s3")
+    CLIENTS.resource("s3", max_attempts=SINGLE_ATTEMPT)
+    CLIENTS.client("sns", max_attempts=SINGLE_ATTEMPT)
+
+
+def start_metadata_process(statsd_setting=None, footprint_options=None):
+    """
+    Set up a process of the metadata pool, which doesn't inherit the
+    configuration of the main process
+
+    :param statsd_setting: Address of the StatsD server, as 'host:port'
+    :param footprint_options: Keyword arguments of FOOTPRINTS.configure
+    """
+    if statsd_setting:
+        STATSD.configure(statsd_setting)
+    if footprint_options:
+        FOOTPRINTS.configure(**footprint_options)
+
 
 def setup_logging():
     """Log to stdout (via TQDM if running interactively) as well as into a file."""
@@ -64,132 +292,357 @@ def setup_logging():
 
 @click.command()
 @click.option("--workers", type=int, default=10)
+@click.option(
+    "--transfer-backend", type=click.Choice(["native", "cli"]), default="native"
+)
+@click.option("--transfer-concurrency", type=int, default=20)
+@click.option("--max-pool-connections", type=int, default=10)
+@click.option("--journal", type=click.Path(dir_okay=False), default="s3_uploads.sqlite")
+@click.option("--chunk-size", type=int, default=1000)
+@click.option("--statsd-setting", type=str, default=None)
+@click.option("--metadata-processes", type=click.IntRange(min=0), default=0)
+@click.option("--footprint-cache", type=click.Path(dir_okay=False), default=None)
+@click.option("--footprint-band", type=str, default=None)
+@click.option("--footprint-overview", type=click.IntRange(min=1), default=1)
+@click.option("--stats-interval", type=click.FloatRange(min=0), default=60.0)
+@click.option("--stats-report", type=click.Path(dir_okay=False), default=None)
+@click.option("--stats-slowest", type=click.IntRange(min=0), default=10)
 @click.argument("granule_ids", type=click.File("r"))
 @click.argument("sns_topic_arn", type=str)
-def main(granule_ids, sns_topic_arn, workers):
+def main(
+    granule_ids,
+    sns_topic_arn,
+    workers,
+    transfer_backend,
+    transfer_concurrency,
+    max_pool_connections,
+    journal,
+    chunk_size,
+    statsd_setting,
+    metadata_processes,
+    footprint_cache,
+    footprint_band,
+    footprint_overview,
+    stats_interval,
+    stats_report,
+    stats_slowest,
+):
     """
     Script to sync Sentinel-2 data from NCI to AWS S3 bucket
     Pass in a file containing destination S3 urls that need to be uploaded.
-    """
 
-    setup_logging()
+    With --metadata-processes, the eo3 and STAC documents are generated in a
+    pool of that many processes, so computing valid data geometries isn't held
+    back by the GIL, while the --workers threads keep doing the network I/O.
 
-    granule_ids = [granule_id.strip() for granule_id in granule_ids.readlines()]
+    Granules without a valid data geometry in their ARD metadata get one
+    computed from their bands. With --footprint-cache these are kept in a
+    SQLite file, so retried runs don't compute them again. --footprint-band
+    computes them from a single band, eg. 'nbart_red', instead of every band,
+    and --footprint-overview N from reads of the bands decimated N times.
 
-    _LOG.info(f"{len(granule_ids)} granules to upload.")
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = {
-            executor.submit(upload_granule, granule_id, sns_topic_arn)
-            for granule_id in granule_ids
-        }
+    Every --stats-interval seconds, the granules and MB uploaded per second,
+    the p50 and p95 durations of each stage and the slowest granules in flight
+    are logged, and written to the --stats-report JSON file.
+    """
 
-        for future in tqdm(
-            as_completed(futures),
-            total=len(granule_ids),
-            unit="granules",
-            desc="processed",
-            disable=None,
-        ):
-            futures.remove(future)
-            _LOG.info(f"Completed upload: {future.result()}")
+    setup_logging()
+    CLIENTS.max_pool_connections = max_pool_connections
+    if statsd_setting:
+        # Timers and counters of every granule, under its product
+        STATSD.configure(statsd_setting)
+        _LOG.addHandler(StatsdFailureHandler())
+
+    footprint_options = dict(
+        cache_path=footprint_cache,
+        band=footprint_band,
+        overview_factor=footprint_overview,
+    )
+    FOOTPRINTS.configure(**footprint_options)
+
+    STATS.slowest = stats_slowest
+    if granule_ids.seekable():
+        # For the estimated time left, only when the list can be read twice
+        STATS.total = sum(1 for _line in granule_ids)
+        granule_ids.seek(0)
+    if stats_interval:
+        STATS.start_reporting(stats_interval, stats_report)
+
+    # Restart point: skip granules a previous run already finished
+    journal = SyncJournal(journal)
+
+    # One transfer manager, and connection pool, shared by every worker
+    transfer = None
+    if transfer_backend == "native":
+        transfer = NativeTransfer(max_concurrency=transfer_concurrency, workers=workers)
+
+    metadata_pool = None
+    if metadata_processes:
+        # Spawned, as forking copies the locks held by the other threads
+        metadata_pool = ProcessPoolExecutor(
+            max_workers=metadata_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=start_metadata_process,
+            initargs=(statsd_setting, footprint_options),
+        )
 
+    def indexed_granules():
+        # Read the list lazily, a chunk at a time, so memory use doesn't depend
+        # on its length
+        stripped_ids = (granule_id.strip() for granule_id in granule_ids)
+        for chunk in chunked(stripped_ids, chunk_size):
+            unfinished = [
+                granule_id
+                for granule_id in chunk
+                if journal.completed_stages(granule_id) < S2_STAGES
+            ]
+            if len(unfinished) < len(chunk):
+                _LOG.info(
+                    f"{len(chunk) - len(unfinished)} granules already uploaded "
+                    f"according to journal."
+                )
+                STATS.incr("skipped", len(chunk) - len(unfinished))
+
+            # Look up which granules are already uploaded with a few listings per day
+            existence_index = S3ExistenceIndex(
+                S3_BUCKET,
+                [
+                    get_granule_s3_stac_path(granule_id)
+                    for granule_id in unfinished
+                    if not journal.completed_stages(granule_id)
+                ],
+            )
+            _LOG.info(
+                f"Checked {len(unfinished)} granules in S3 "
+                f"with {existence_index.request_count} list requests"
+            )
+            for granule_id in unfinished:
+                yield granule_id, existence_index
+
+    def upload(indexed_granule):
+        granule_id, existence_index = indexed_granule
+        with granule_log_context(
+            granule_id, product=get_granule_product(granule_id)
+        ), STATS.granule(granule_id):
+            return upload_granule(
+                granule_id,
+                sns_topic_arn,
+                transfer,
+                existence_index,
+                journal,
+                metadata_pool,
+            )
 
-def upload_granule(granule_id, sns_topic_arn):
+    try:
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="granule", initializer=start_worker
+        ) as executor:
+            for result in tqdm(
+                bounded_map(executor, upload, indexed_granules(), window=workers * 2),
+                unit="granules",
+                desc="processed",
+                disable=None,
+            ):
+                _LOG.info(f"Completed upload: {result}")
+    finally:
+        # Commit the stages recorded since the last commit, even on failure
+        if metadata_pool is not None:
+            metadata_pool.shutdown()
+        if transfer is not None:
+            transfer.close()
+        FOOTPRINTS.close()
+        journal.close()
+        STATS.stop_reporting(stats_report)
+
+
+def upload_granule(
+    granule_id,
+    sns_topic_arn,
+    transfer=None,
+    existence_index=None,
+    journal=None,
+    metadata_pool=None,
+):
     """
     :param granule_id: the id of the granule in format 'date/tile_id'
+    :param sns_topic_arn: ARN of the SNS topic
+    :param transfer: NativeTransfer to upload in-process, instead of the AWS CLI
+    :param existence_index: S3ExistenceIndex to look up uploaded granules in
+    :param journal: SyncJournal recording the stages already completed
+    :param metadata_pool: ProcessPoolExecutor to generate the metadata in,
+    instead of the current thread
     """
     _LOG.info(f"Processing {granule_id}")
-    session = boto3.session.Session()
-    bucket_stac_path = f"{get_granule_s3_path(granule_id)}/stac-ARD-METADATA.json"
-
-    if not check_granule_exists(S3_BUCKET, bucket_stac_path, session=session):
-
-        sync_granule(
-            granule_id,
-            NCI_DIR,
-            Path(get_granule_s3_path(granule_id)).parent.parent,
-            S3_BUCKET,
-            exclude=["NBAR/*", "ARD-METADATA.yaml", "*NBAR_CONTIGUITY.TIF"],
-            cross_account=True,
-        )
-
-        stac_dump, s3_stac_path = upload_metadata(granule_id)
-
-        message_attributes = get_common_message_attributes(json.loads(stac_dump))
+    STATSD.incr("granules")
+    bucket_stac_path = get_granule_s3_stac_path(granule_id)
+    if journal is None:
+        journal = SyncJournal()
+    completed_stages = journal.completed_stages(granule_id)
+
+    # A granule partly uploaded by a previous run is always finished
+    if completed_stages or not granule_exists(
+        S3_BUCKET, bucket_stac_path, existence_index
+    ):
+
+        if SyncJournal.SYNCED not in completed_stages:
+            with STATS.stage(granule_id, "sync"):
+                uploaded = sync_granule(
+                    granule_id,
+                    NCI_DIR,
+                    Path(get_granule_s3_path(granule_id)).parent.parent,
+                    S3_BUCKET,
+                    exclude=["NBAR/*", "ARD-METADATA.yaml", "*NBAR_CONTIGUITY.TIF"],
+                    cross_account=True,
+                    transfer=transfer,
+                )
+            if uploaded:
+                STATS.incr("bytes", sum(uploaded.values()))
+            journal.mark_done(granule_id, SyncJournal.SYNCED)
+
+        with STATS.stage(granule_id, "eo3"):
+            documents = upload_metadata(
+                granule_id,
+                upload_eo3=SyncJournal.METADATA not in completed_stages,
+                metadata_pool=metadata_pool,
+            )
+        journal.mark_done(granule_id, SyncJournal.METADATA)
+
+        message_attributes = dict(documents["message_attributes"])
         message_attributes.update(
             {"action": {"DataType": "String", "StringValue": "ADDED"}}
         )
 
-        _LOG.info(f"Sending SNS. Granule id: {granule_id}")
-        try:
-            publish_sns(sns_topic_arn, stac_dump, message_attributes, session=session)
-        except Exception as e:
-            _LOG.info(f"SNS send failed: {e}. Granule id: {granule_id}")
+        if SyncJournal.SNS_ADDED not in completed_stages:
+            _LOG.info(f"Sending SNS. Granule id: {granule_id}")
+            try:
+                with STATS.stage(granule_id, "sns"):
+                    publish_sns(sns_topic_arn, documents["message"], message_attributes)
+                journal.mark_done(granule_id, SyncJournal.SNS_ADDED)
+            except Exception as e:
+                _LOG.info(f"SNS send failed: {e}. Granule id: {granule_id}")
+                STATSD.incr("failures")
 
         _LOG.info(f"Uploading STAC: {granule_id}")
-        s3_dump(
-            stac_dump,
-            s3_stac_path,
-            ACL="bucket-owner-full-control",
-            ContentType="application/json",
-        )  # upload STAC last
+        with STATS.stage(granule_id, "stac"):
+            upload_s3_resource(
+                S3_BUCKET,
+                documents["stac_key"],
+                documents["stac"],
+                content_type="application/json",
+                acl="bucket-owner-full-control",
+            )  # upload STAC last
+        journal.mark_done(granule_id, SyncJournal.STAC)
+        STATS.incr("uploaded")
     else:
         _LOG.info(f"Granule {granule_id} already uploaded, skipping.")
+        STATS.incr("skipped")
 
 
-def get_granule_s3_path(granule_id):
-
+def get_granule_product(granule_id):
+    """
+    :param granule_id: the id of the granule in format 'date/tile_id'
+    :return: Name of the product the granule is uploaded as
+    """
     if "S2A" in granule_id:
-        granule_s3_path = f"baseline/s2a_ard_granule/{granule_id}"
+        return "s2a_ard_granule"
     elif "S2B" in granule_id:
-        granule_s3_path = f"baseline/s2b_ard_granule/{granule_id}"
+        return "s2b_ard_granule"
     else:
         raise ValueError(f"granule_id: must contain 'S2A' or S2B, found {granule_id}.")
 
-    return granule_s3_path
 
+def get_granule_s3_path(granule_id):
+
+    return f"baseline/{get_granule_product(granule_id)}/{granule_id}"
 
-def upload_metadata(granule_id):
+
+def get_granule_s3_stac_path(granule_id):
+    """
+    :param granule_id: the id of the granule in format 'date/tile_id'
+    :return: S3 key checked to tell if the granule is already uploaded
+    """
+    return f"{get_granule_s3_path(granule_id)}/stac-ARD-METADATA.json"
+
+
+def upload_metadata(granule_id, upload_eo3=True, metadata_pool=None):
     """
     Creates and uploads metadata in stac and eo3 formats.
     :param granule_id: the id of the granule in format 'date/tile_id'
-    :return: serialized stac metadata
+    :param upload_eo3: Upload the eo3 metadata, False if it's already uploaded
+    :param metadata_pool: ProcessPoolExecutor to create the documents in,
+    instead of the current thread
+    :return: the documents created by create_metadata_documents
     """
+    if metadata_pool is None:
+        documents = create_metadata_documents(granule_id)
+    else:
+        # The thread is free for I/O again once the process is done
+        documents = metadata_pool.submit(create_metadata_documents, granule_id).result()
 
-    local_path = Path(NCI_DIR) / granule_id
-    granule_s3_path = get_granule_s3_path(granule_id)
+    if upload_eo3:
+        upload_s3_resource(
+            S3_BUCKET,
+            documents["eo3_key"],
+            documents["eo3"],
+            content_type="text/vnd.yaml",
+            acl="bucket-owner-full-control",
+        )
 
-    s3_path = f"s3://{S3_BUCKET}/{granule_s3_path}/"
-    s3_eo3_path = f"{s3_path}eo3-ARD-METADATA.odc-metadata.yaml"
-    s3_stac_path = f"{s3_path}stac-ARD-METADATA.stac-item.json"
+    return documents
 
-    product = "s2b_ard_granule" if "S2B" in granule_id else "s2a_ard_granule"
-    eo3 = create_eo3(local_path, granule_id)
-    stac = to_stac_item(
-        eo3,
-        stac_item_destination_url=s3_stac_path,
-        odc_dataset_metadata_url=s3_eo3_path,
-        dataset_location=s3_path,
-    )
-    stac["properties"]["title"] = stac["properties"]["title"].replace(
-        stac["properties"]["odc:product"], product
-    )
-    stac["properties"]["odc:product"] = product
-    stac_dump = json.dumps(stac, default=json_fallback, indent=4)
-
-    eo3 = serialise.to_doc(eo3)
-    # Hack to replace UUIDs with Strings.
-    eo3["lineage"]["ard"] = [str(lineage_id) for lineage_id in eo3["lineage"]["ard"]]
-    eo3["label"] = eo3["label"].replace(eo3["product"]["name"], product)
-    eo3["product"]["name"] = product
-    s3_dump(
-        yaml.safe_dump(eo3, default_flow_style=False),
-        s3_eo3_path,
-        ACL="bucket-owner-full-control",
-        ContentType="text/vnd.yaml",
-    )
 
-    return stac_dump, s3_stac_path
+def create_metadata_documents(granule_id):
+    """
+    Creates the metadata of a granule in eo3 and stac formats, and its SNS message.
+
+    The documents are serialised here, so when this runs in a process pool only
+    strings are sent back to the uploading thread, rather than the document
+    objects being pickled and then serialised again.
+    :param granule_id: the id of the granule in format 'date/tile_id'
+    :return: dict of the serialised documents, the attributes of the SNS
+    message, and the S3 keys to upload the documents to
+    """
+    # Metrics of the processes of the pool are reported under the granule product too
+    with granule_log_context(granule_id, product=get_granule_product(granule_id)):
+        local_path = Path(NCI_DIR) / granule_id
+        granule_s3_path = get_granule_s3_path(granule_id)
+
+        eo3_key = f"{granule_s3_path}/eo3-ARD-METADATA.odc-metadata.yaml"
+        stac_key = f"{granule_s3_path}/stac-ARD-METADATA.stac-item.json"
+        s3_path = f"s3://{S3_BUCKET}/{granule_s3_path}/"
+        s3_eo3_path = f"s3://{S3_BUCKET}/{eo3_key}"
+        s3_stac_path = f"s3://{S3_BUCKET}/{stac_key}"
+
+        product = get_granule_product(granule_id)
+        eo3 = create_eo3(local_path, granule_id)
+        stac = to_stac_item(
+            eo3,
+            stac_item_destination_url=s3_stac_path,
+            odc_dataset_metadata_url=s3_eo3_path,
+            dataset_location=s3_path,
+        )
+        stac["properties"]["title"] = stac["properties"]["title"].replace(
+            stac["properties"]["odc:product"], product
+        )
+        stac["properties"]["odc:product"] = product
+
+        eo3 = serialise.to_doc(eo3)
+        # Hack to replace UUIDs with Strings.
+        eo3["lineage"]["ard"] = [
+            str(lineage_id) for lineage_id in eo3["lineage"]["ard"]
+        ]
+        eo3["label"] = eo3["label"].replace(eo3["product"]["name"], product)
+        eo3["product"]["name"] = product
+
+        message = dump_stac(stac, pretty=False)
+        return {
+            "eo3_key": eo3_key,
+            "eo3": dump_metadata(eo3),
+            "stac_key": stac_key,
+            "stac": dump_stac(stac),
+            "message": message,
+            "message_attributes": get_common_message_attributes(json.loads(message)),
+        }
 
 
 class TqdmLoggingHandler(logging.Handler):
@@ -221,53 +674,240 @@ code_to_band = {
     "B8A": "nbart_nir_2",
 }
 
+# Band names of the measurement files in each subfolder of a granule
+MEASUREMENT_BAND_NAMES = {
+    "NBART": lambda x: code_to_band[x.split("_")[-1]],
+    "SUPPLEMENTARY": lambda x: x[3:].lower(),
+    "QA": lambda x: x[3:].lower().replace("combined_", ""),
+}
 
-def add_to_eo3(assembler, granule_dir, folder, func, expand_valid_data):
+
+# Subfolders of a granule with the measurement bands, NBART also has the thumbnail
+MEASUREMENT_FOLDERS = ("NBART", "SUPPLEMENTARY", "QA")
+
+
+class GranuleInventory:
     """
-    Helper function to add measurements to the DatasetAssembler
+    Files and ARD metadata of a granule, read once and shared by the helpers
+    building its eo3 document
 
-    :param assembler: the DatasetAssembler
-    :param granule_dir (Path): the firectory of the granule
+    Every metadata operation is slow on the Lustre file system of /g/data, so
+    each measurement folder is scanned once and ARD-METADATA.yaml parsed once.
+    """
+
+    def __init__(self, granule_dir, folders=MEASUREMENT_FOLDERS):
+        """
+        :param granule_dir (Path): the directory of the granule
+        :param folders: the subfolders to list
+        """
+        self.granule_dir = Path(granule_dir)
+        self.metadata = load_metadata(self.granule_dir / "ARD-METADATA.yaml")
+        self.files = {}
+        for folder in folders:
+            with os.scandir(self.granule_dir / folder) as entries:
+                # The type comes with the entry, without a stat per file
+                self.files[folder] = sorted(
+                    entry.name for entry in entries if entry.is_file()
+                )
+
+
+class FootprintCache:
+    """
+    Valid data footprints computed for granules, in a local SQLite file
+
+    Footprints are stored as WKB, with a fingerprint of the band files they
+    were computed from, so a reprocessed granule gets a new footprint.
+    Processes of the metadata pool each open their own connection to the file.
+    """
+
+    def __init__(self, path=":memory:"):
+        """
+        :param path: Path of the SQLite file
+        """
+        self.path = str(path)
+        self._lock = threading.Lock()
+        # Wait for the writes of the other processes, rather than failing
+        self._connection = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS granule_footprint ("
+                "granule TEXT PRIMARY KEY, "
+                "fingerprint TEXT NOT NULL, "
+                "footprint BLOB NOT NULL)"
+            )
+
+    def get(self, granule, fingerprint):
+        """
+        :param granule: Name of the granule
+        :param fingerprint: Fingerprint of the files of the footprint
+        :return: The cached footprint, or None if missing or out of date
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT footprint FROM granule_footprint "
+                "WHERE granule = ? AND fingerprint = ?",
+                (str(granule), fingerprint),
+            ).fetchone()
+        return wkb.loads(row[0]) if row else None
+
+    def put(self, granule, fingerprint, footprint):
+        """
+        Record the footprint of a granule, it's costly enough to commit at once
+
+        :param granule: Name of the granule
+        :param fingerprint: Fingerprint of the files of the footprint
+        :param footprint: Shapely geometry of the footprint
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO granule_footprint "
+                "(granule, fingerprint, footprint) VALUES (?, ?, ?)",
+                (str(granule), fingerprint, wkb.dumps(footprint)),
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class FootprintSettings:
+    """
+    How the valid data footprints missing from the ARD metadata are computed
+
+    A module-level instance, configured by the main process and by each
+    process of the metadata pool.
+    """
+
+    def __init__(self):
+        self.band = None
+        self.overview_factor = 1
+        self.cache = None
+
+    def configure(self, cache_path=None, band=None, overview_factor=1):
+        """
+        :param cache_path: Path of the SQLite file of the FootprintCache
+        :param band: Name of the single band to compute footprints from,
+        instead of every band
+        :param overview_factor: Decimation of the bands read for footprints
+        """
+        self.close()
+        self.band = band
+        self.overview_factor = overview_factor
+        self.cache = FootprintCache(cache_path) if cache_path else None
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+
+FOOTPRINTS = FootprintSettings()
+
+
+def footprint_fingerprint(paths):
+    """
+    :param paths: Paths of the band files a footprint is computed from
+    :return: Text identifying their names, sizes and modification times
+    """
+    fingerprint = []
+    for path in paths:
+        stat = os.stat(path)
+        fingerprint.append([Path(path).name, stat.st_size, stat.st_mtime_ns])
+    return json.dumps(fingerprint)
+
+
+def overview_footprint(paths, overview_factor):
+    """
+    Compute a valid data footprint from decimated reads of bands
+
+    GDAL reads from the overviews of the files where they have them. The
+    footprint is computed as eodatasets3 does for full resolution bands.
+    :param paths: Paths of the band files
+    :param overview_factor: Times fewer pixels to read on each axis
+    :return: Shapely geometry of the footprint
+    """
+    bundler = MeasurementBundler()
+    for path in paths:
+        with rasterio.open(path) as dataset:
+            shape = (
+                max(1, dataset.height // overview_factor),
+                max(1, dataset.width // overview_factor),
+            )
+            image = dataset.read(1, out_shape=shape, resampling=Resampling.nearest)
+            transform = dataset.transform * Affine.scale(
+                dataset.width / shape[1], dataset.height / shape[0]
+            )
+            bundler.record_image(
+                Path(path).name,
+                GridSpec(shape=shape, transform=transform, crs=dataset.crs),
+                path,
+                image,
+                nodata=dataset.nodata,
+            )
+    return bundler.consume_and_get_valid_data()
+
+
+def measurement_files(inventory, folder, func):
+    """
+    :param inventory (GranuleInventory): the files of the granule
     :param folder (str): the subfolder containing the measurement bands
     :param func: a function that transforms file names to the correct band name
+    :return: dict of band names to their files, relative to the granule
     """
     fns = [
         os.path.join(folder, fn)
-        for fn in os.listdir(granule_dir / folder)
-        if fn[-3:] == "TIF"
+        for fn in inventory.files[folder]
+        if fn[-3:] == "TIF" and "QUICKLOOK" not in fn
     ]
-    fns = [fn for fn in fns if "QUICKLOOK" not in fn]
-    for i, fn in enumerate(fns):
-        name = func(fn.split(".")[-2])
+    return {func(fn.split(".")[-2]): fn for fn in fns}
+
+
+def add_to_eo3(
+    assembler, inventory, folder, func, expand_valid_data, footprint_band=None
+):
+    """
+    Helper function to add measurements to the DatasetAssembler
+
+    :param assembler: the DatasetAssembler
+    :param inventory (GranuleInventory): the files of the granule
+    :param folder (str): the subfolder containing the measurement bands
+    :param func: a function that transforms file names to the correct band name
+    :param footprint_band: the only band to expand the valid data with, if any
+    """
+    for name, fn in measurement_files(inventory, folder, func).items():
         assembler.note_measurement(
             name,
             fn,
             relative_to_dataset_location=True,
-            expand_valid_data=expand_valid_data,
+            expand_valid_data=expand_valid_data and footprint_band in (None, name),
         )
 
 
-def add_datetime(assembler, granule_dir):
+def add_datetime(assembler, eo):
     """
     Adds the datetime from the original eo metadata.
+    :param eo: the parsed ARD-METADATA.yaml of the granule
     """
-    eo_path = granule_dir / "ARD-METADATA.yaml"
-    with open(eo_path) as fin:
-        eo = yaml.safe_load(fin)
     assembler.datetime = datetime.datetime.strptime(
         eo["extent"]["center_dt"], "%Y-%m-%dT%H:%M:%S.%fZ"
     )
 
 
-def create_eo3(granule_dir, granule_id):
+@STATSD.timed("duration.metadata")
+def create_eo3(granule_dir, granule_id, inventory=None):
     """
     Creates an eo3 document.
     :param granule_dir (Path): the granule directory
+    :param inventory (GranuleInventory): the files of the granule, listed now
+    if not given
     :return: DatasetDoc of eo3 metadata
     """
-
-    with open(granule_dir / "ARD-METADATA.yaml") as fin:
-        metadata = yaml.safe_load(fin)
+    if inventory is None:
+        inventory = GranuleInventory(granule_dir)
+    metadata = inventory.metadata
 
     try:
         coords = metadata["grid_spatial"]["projection"]["valid_data"]["coordinates"]
@@ -290,37 +930,45 @@ def create_eo3(granule_dir, granule_id):
 
     assembler.processed_now()
 
-    add_datetime(assembler, granule_dir)
-    add_to_eo3(
-        assembler,
-        granule_dir,
-        "NBART",
-        lambda x: code_to_band[x.split("_")[-1]],
-        expand_valid_data,
-    )
-    add_to_eo3(
-        assembler,
-        granule_dir,
-        "SUPPLEMENTARY",
-        lambda x: x[3:].lower(),
-        expand_valid_data,
-    )
-    add_to_eo3(
-        assembler,
-        granule_dir,
-        "QA",
-        lambda x: x[3:].lower().replace("combined_", ""),
-        expand_valid_data,
-    )
+    add_datetime(assembler, metadata)
+
+    footprint = None
+    if expand_valid_data:
+        footprint_paths = [
+            granule_dir / fn
+            for folder, func in MEASUREMENT_BAND_NAMES.items()
+            for name, fn in measurement_files(inventory, folder, func).items()
+            if FOOTPRINTS.band in (None, name)
+        ]
+        if not footprint_paths:
+            raise ValueError(
+                f"No {FOOTPRINTS.band} band to compute the footprint of {granule_id}"
+            )
+        fingerprint = footprint_fingerprint(footprint_paths)
+        if FOOTPRINTS.cache is not None:
+            footprint = FOOTPRINTS.cache.get(granule_id, fingerprint)
+        if footprint is None and FOOTPRINTS.overview_factor > 1:
+            footprint = overview_footprint(footprint_paths, FOOTPRINTS.overview_factor)
+            if FOOTPRINTS.cache is not None:
+                FOOTPRINTS.cache.put(granule_id, fingerprint, footprint)
+
+    # The assembler only reads the bands for a footprint not found above
+    expand_bands = expand_valid_data and footprint is None
+    for folder, func in MEASUREMENT_BAND_NAMES.items():
+        add_to_eo3(assembler, inventory, folder, func, expand_bands, FOOTPRINTS.band)
 
     thumbnail_fn = next(
-        fn for fn in os.listdir(granule_dir / "NBART") if "NBART_THUMBNAIL" in fn
+        fn for fn in inventory.files["NBART"] if "NBART_THUMBNAIL" in fn
     )
     assembler.add_accessory_file("thumbnail:nbart", f"NBART/{thumbnail_fn}")
     assembler.note_source_datasets("ard", metadata["id"])
 
     crs, grid_docs, measurement_docs = assembler._measurements.as_geo_docs()
     valid_data = assembler._measurements.consume_and_get_valid_data()
+    if expand_bands and FOOTPRINTS.cache is not None:
+        FOOTPRINTS.cache.put(granule_id, fingerprint, valid_data)
+    elif footprint is not None:
+        valid_data = footprint
 
     assembler.properties["odc:region_code"] = metadata["provider"]["reference_code"]
     assembler.properties["odc:producer"] = "ga.gov.au"
@@ -0,0 +1,74 @@
+import unittest
+from collection3.nci_c3_upload_s3 import (
+    collection3_products,
+    choose_upload_mode,
+    dag as c3_upload_s3_dag,
+)
+
+
+class testClass(unittest.TestCase):
+    def assertDagDictEqual(self, source, dag):
+        self.assertEqual(dag.task_dict.keys(), source.keys())
+        for task_id, downstream_list in source.items():
+            self.assertTrue(
+                dag.has_task(task_id), msg="Missing task_id: {} in dag".format(task_id)
+            )
+            task = dag.get_task(task_id)
+            self.assertEqual(
+                task.downstream_task_ids,
+                set(downstream_list),
+                msg="unexpected downstream link in {}".format(task_id),
+            )
+
+    def test_c3_upload_s3_dag(self):
+        source = {}
+        for product in collection3_products:
+            source.update(
+                {
+                    f"list_{product}_scenes": [f"sftp_c3_to_s3_script_{product}"],
+                    f"sftp_c3_to_s3_script_{product}": [
+                        f"choose_upload_mode_{product}"
+                    ],
+                    f"choose_upload_mode_{product}": [
+                        f"execute_c3_to_s3_script_{product}",
+                        f"submit_c3_to_s3_shards_{product}",
+                    ],
+                    f"execute_c3_to_s3_script_{product}": [
+                        f"clean_nci_work_dir_{product}"
+                    ],
+                    f"submit_c3_to_s3_shards_{product}": [
+                        f"wait_for_c3_to_s3_shards_{product}"
+                    ],
+                    f"wait_for_c3_to_s3_shards_{product}": [
+                        f"merge_c3_to_s3_shard_reports_{product}"
+                    ],
+                    f"merge_c3_to_s3_shard_reports_{product}": [
+                        f"clean_nci_work_dir_{product}"
+                    ],
+                    f"clean_nci_work_dir_{product}": [],
+                }
+            )
+        self.assertDagDictEqual(source, c3_upload_s3_dag)
+
+    def test_c3_upload_s3_dag_branches(self):
+        for product in collection3_products:
+            # The shards are rendered from the variable as a string
+            for shards, task_id in [
+                ("1", f"execute_c3_to_s3_script_{product}"),
+                ("4", f"submit_c3_to_s3_shards_{product}"),
+            ]:
+                self.assertEqual(choose_upload_mode(shards, product), task_id)
+                self.assertTrue(c3_upload_s3_dag.has_task(task_id))
+
+        # The shard reports are merged even when the sensor fails, to report
+        # the shards that wrote none, and the work dir is cleaned after either branch
+        self.assertEqual(
+            c3_upload_s3_dag.get_task(
+                "merge_c3_to_s3_shard_reports_ga_ls8c_ard_3"
+            ).trigger_rule,
+            "none_skipped",
+        )
+        self.assertEqual(
+            c3_upload_s3_dag.get_task("clean_nci_work_dir_ga_ls8c_ard_3").trigger_rule,
+            "none_failed_or_skipped",
+        )
@@ -1,9 +1,56 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import boto3
+import jsonschema
 import moto
 import pytest
-from scripts.c3_to_s3_rolling import upload_s3_resource
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError
+from scripts import c3_to_s3_rolling
+from scripts.c3_to_s3_rolling import (
+    CLIENTS,
+    DEFAULT_EXCLUDE,
+    AdaptiveConcurrency,
+    AsyncUploader,
+    BatchPublisher,
+    ClientRegistry,
+    HashingWriter,
+    NativeTransfer,
+    S3Archiver,
+    S3ExistenceIndex,
+    ADDED_STAGES,
+    SINGLE_ATTEMPT,
+    S3SyncException,
+    StacTemplateCache,
+    StagedPipeline,
+    StatsdClient,
+    SyncJournal,
+    benchmark_metadata_io,
+    bounded_map,
+    chunked,
+    common_prefixes,
+    granule_log_context,
+    load_metadata,
+    plan_sync,
+    sync_granules,
+    upload_checksum,
+    upload_metadata,
+    upload_s3_resource,
+)
+from eodatasets3 import serialise
+from eodatasets3.properties import PropertyOverrideWarning
+from eodatasets3.scripts.tostac import dc_to_stac
+
+METADATA_FIXTURE = "ga_ls8c_ard_3-1-0_095075_2019-07-28_final.odc-metadata.yaml"
 
 
 @moto.mock_s3
@@ -49,6 +96,1249 @@ def test_upload_with_and_without_content_type(local_stac):
     assert txt_s3.content_type == "binary/octet-stream"
 
 
+@moto.mock_s3
+def test_plan_sync_counts_what_would_move(tmp_path):
+    """
+    The plan skips granules already in S3, honours the exclude patterns and
+    counts the requests of multipart uploads.
+    """
+    bucket_name = "fake-bucket"
+    client = boto3.client("s3", region_name="ap-southeast-2")
+    client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+    nci_dir = tmp_path / "nci"
+    metadata_files = []
+    for day in ["01", "02"]:
+        granule_dir = nci_dir / f"ga_ls8c_ard_3/095/075/2019/07/{day}"
+        granule_dir.mkdir(parents=True)
+        metadata_file = (
+            granule_dir / f"ga_ls8c_ard_3-1-0_095075_2019-07-{day}.odc-metadata.yaml"
+        )
+        metadata_file.write_text("{}")
+        (granule_dir / "ga_ls8c_nbar_3-1-0_band01.tif").write_bytes(b"excluded")
+        (granule_dir / "ga_ls8c_nbart_3-1-0_band01.tif").write_bytes(b"x" * 100)
+        (granule_dir / "ga_ls8c_nbart_3-1-0_band02.tif").write_bytes(
+            b"x" * (16 * 1024 * 1024 + 1)
+        )
+        metadata_files.append(metadata_file)
+    client.put_object(
+        Bucket=bucket_name,
+        Key=f"baseline/{metadata_files[0].relative_to(nci_dir)}",
+        Body=b"",
+    )
+    missing = nci_dir / "ga_ls8c_ard_3/095/075/2019/07/03/missing.odc-metadata.yaml"
+    archived = nci_dir / "ga_ls8c_ard_3/095/075/2019/06/30/archived.odc-metadata.yaml"
+    csv_file = tmp_path / "granules.csv"
+    csv_file.write_text(
+        "".join(f"{path},\n" for path in [*metadata_files, missing])
+        + f"{archived},2019-07-04\n"
+    )
+
+    plan = plan_sync(str(csv_file), str(nci_dir), "baseline", bucket_name, bandwidth=1)
+
+    assert plan["granules"] == {
+        "added": 1,
+        "archived": 1,
+        "existing": 1,
+        "complete": 0,
+        "missing": 1,
+    }
+    assert plan["files"] == 2
+    assert plan["bytes"] == 100 + 16 * 1024 * 1024 + 1
+    # A listing of July and a HEAD request for the granule alone in June for the
+    # existence index, two for archiving, one for syncing, a PutObject, two parts
+    # with creating and completing their upload, and the three metadata files
+    assert plan["s3_requests"] == 2 + 2 + 1 + 1 + 4 + 3
+    assert plan["sns_messages"] == 2
+    assert plan["estimated_seconds"] == 16.0
+
+
+@moto.mock_s3
+def test_native_transfer_sync_and_delete(tmp_path):
+    """
+    The native backend honours the exclude patterns, skips unchanged files and
+    deletes a whole granule prefix.
+    """
+    bucket_name = "fake-bucket"
+    client = boto3.client("s3", region_name="ap-southeast-2")
+    client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+
+    granule_dir = tmp_path / "095/075/2019/07/28"
+    granule_dir.mkdir(parents=True)
+    for name in [
+        "ga_ls8c_nbart_3-1-0_095075_2019-07-28_final_band01.tif",
+        "ga_ls8c_nbar_3-1-0_095075_2019-07-28_final_band01.tif",
+        "ga_ls8c_ard_3-1-0_095075_2019-07-28_final.sha1",
+        "ga_ls8c_ard_3-1-0_095075_2019-07-28_final.odc-metadata.yaml",
+    ]:
+        (granule_dir / name).write_bytes(b"content")
+    (granule_dir / "qa").mkdir()
+    (granule_dir / "qa/ga_ls8c_oa_3-1-0_095075_2019-07-28_final_fmask.tif").write_bytes(
+        b"content"
+    )
+
+    transfer = NativeTransfer(client=client)
+    prefix = "baseline/ga_ls8c_ard_3/095/075/2019/07/28"
+    uploaded = transfer.sync(granule_dir, bucket_name, prefix, exclude=DEFAULT_EXCLUDE)
+
+    assert sorted(uploaded) == [
+        f"{prefix}/ga_ls8c_nbart_3-1-0_095075_2019-07-28_final_band01.tif",
+        f"{prefix}/qa/ga_ls8c_oa_3-1-0_095075_2019-07-28_final_fmask.tif",
+    ]
+    assert sorted(transfer.list_objects(bucket_name, f"{prefix}/")) == sorted(uploaded)
+
+    # Nothing has changed, so nothing is uploaded again
+    assert (
+        transfer.sync(granule_dir, bucket_name, prefix, exclude=DEFAULT_EXCLUDE) == {}
+    )
+
+    archiver = S3Archiver(client)
+    archiver.archive(bucket_name, prefix, "granule")
+    archiver.close()
+    transfer.close()
+    assert transfer.list_objects(bucket_name, f"{prefix}/") == {}
+
+
+def test_native_backend_fails_granules_on_connection_errors(tmp_path, monkeypatch):
+    """
+    A BotoCoreError, like a refused connection, fails the granule that hit it,
+    the same as a failing AWS CLI command did, rather than stopping the run.
+    """
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    # Nothing listens on the discard port, so every request is refused
+    unreachable = boto3.client(
+        "s3",
+        region_name="ap-southeast-2",
+        endpoint_url="http://127.0.0.1:9",
+        config=Config(retries={"total_max_attempts": 1}),
+    )
+    with pytest.raises(EndpointConnectionError):
+        unreachable.list_buckets()
+
+    nci_dir = tmp_path / "nci"
+    metadata_files = []
+    for day in (27, 28):
+        granule_dir = nci_dir / f"ga_ls8c_ard_3/095/075/2019/07/{day}"
+        granule_dir.mkdir(parents=True)
+        metadata_file = granule_dir / "ga_ls8c_ard_3-1-0.odc-metadata.yaml"
+        metadata_file.write_text("id: abc\n")
+        metadata_files.append(metadata_file)
+    csv_file = tmp_path / "granules.csv"
+    csv_file.write_text(
+        "".join(f"{metadata_file}\n" for metadata_file in metadata_files)
+    )
+
+    monkeypatch.setattr(
+        c3_to_s3_rolling,
+        "NativeTransfer",
+        lambda **kwargs: NativeTransfer(client=unreachable, **kwargs),
+    )
+    with pytest.raises(S3SyncException) as exc_info:
+        sync_granules(
+            str(csv_file),
+            str(nci_dir),
+            "baseline",
+            "fake-bucket",
+            "",
+            "",
+            "arn:aws:sns:ap-southeast-2:123456789012:fake-topic",
+            update=True,
+            workers=2,
+            existence_index=False,
+            sns_batch=False,
+        )
+
+    errors = str(exc_info.value).splitlines()
+    assert len(errors) == len(metadata_files)
+    assert all("Could not connect to the endpoint URL" in error for error in errors)
+
+    with pytest.raises(S3SyncException, match="Could not connect"):
+        S3Archiver(unreachable).archive("fake-bucket", "baseline/granule", "granule")
+
+
+@moto.mock_s3
+def test_native_transfer_delta_sync_compares_checksums(tmp_path):
+    """
+    With checksums on both sides, only files whose content changed are uploaded,
+    whatever their modification time.
+    """
+    bucket_name = "fake-bucket"
+    client = boto3.client("s3", region_name="ap-southeast-2")
+    client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+
+    granule_dir = tmp_path / "granule"
+    granule_dir.mkdir()
+    (granule_dir / "changed.tif").write_bytes(b"content")
+    (granule_dir / "touched.tif").write_bytes(b"content")
+    checksums = {
+        "changed.tif": hashlib.sha1(b"content").hexdigest(),
+        "touched.tif": hashlib.sha1(b"content").hexdigest(),
+    }
+
+    transfer = NativeTransfer(client=client)
+    prefix = "baseline/granule"
+    transfer.sync(granule_dir, bucket_name, prefix, checksums=checksums)
+    head = client.head_object(Bucket=bucket_name, Key=f"{prefix}/changed.tif")
+    assert head["Metadata"] == {"sha1": checksums["changed.tif"]}
+
+    # Same size, older modification time, but a different content
+    (granule_dir / "changed.tif").write_bytes(b"CONTENT")
+    os.utime(granule_dir / "changed.tif", (0, 0))
+    # Newer modification time, but the same content
+    os.utime(granule_dir / "touched.tif", (4102444800, 4102444800))
+    remote_checksums = dict(checksums)
+    checksums["changed.tif"] = hashlib.sha1(b"CONTENT").hexdigest()
+
+    uploaded = transfer.sync(
+        granule_dir,
+        bucket_name,
+        prefix,
+        checksums=checksums,
+        remote_checksums=remote_checksums,
+    )
+    transfer.close()
+    assert list(uploaded) == [f"{prefix}/changed.tif"]
+
+
+@moto.mock_s3
+def test_archiver_packs_granules_into_delete_batches():
+    """
+    Keys of several granules share DeleteObjects requests, and a granule is only
+    reported archived once all of its keys are gone.
+    """
+    bucket_name = "fake-bucket"
+    client = boto3.client("s3", region_name="ap-southeast-2")
+    client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+    for granule in range(3):
+        for band in range(3):
+            client.put_object(
+                Bucket=bucket_name, Key=f"baseline/{granule}/band{band}.tif", Body=b""
+            )
+
+    archived = []
+    archiver = S3Archiver(client=client, batch_size=4)
+    for granule in range(3):
+        archiver.archive(
+            bucket_name,
+            f"baseline/{granule}",
+            granule,
+            on_success=lambda granule=granule: archived.append(granule),
+        )
+    # Only the full batches are sent before closing
+    assert archived == [0, 1]
+    archiver.close()
+
+    assert archived == [0, 1, 2]
+    assert archiver.request_count == 3
+    assert archiver.errors == []
+    assert "Contents" not in client.list_objects_v2(Bucket=bucket_name)
+
+
+def test_archiver_retries_keys_failing_transiently(monkeypatch):
+    """
+    Keys failing with a throttling or transient error in a DeleteObjects
+    response are sent again, the others fail their granule.
+    """
+    # Error codes each key gets in the responses, until it's deleted
+    codes = {
+        "a/0": ["SlowDown"],
+        "a/1": ["InternalError", "ServiceUnavailable"],
+        "b/0": ["AccessDenied"],
+    }
+    requests = []
+
+    class FlakyS3:
+        def delete_objects(self, Bucket, Delete):
+            keys = [obj["Key"] for obj in Delete["Objects"]]
+            requests.append(keys)
+            errors = [
+                {"Key": key, "Code": codes[key].pop(0)} for key in keys if codes[key]
+            ]
+            return {"Errors": errors}
+
+    monkeypatch.setattr(
+        c3_to_s3_rolling, "S3_REQUESTS", AdaptiveConcurrency(base_delay=0)
+    )
+    archiver = S3Archiver(client=FlakyS3())
+    monkeypatch.setattr(
+        archiver,
+        "list_keys",
+        lambda s3_bucket, s3_prefix: sorted(
+            key for key in codes if key.startswith(f"{s3_prefix}/")
+        ),
+    )
+    archived = []
+    for granule in ("a", "b"):
+        archiver.archive(
+            "fake-bucket",
+            granule,
+            granule,
+            on_success=lambda granule=granule: archived.append(granule),
+        )
+    archiver.close()
+
+    assert requests == [["a/0", "a/1", "b/0"], ["a/0", "a/1"], ["a/1"]]
+    assert archived == ["a"]
+    assert len(archiver.errors) == 1
+    assert "b/0 - AccessDenied" in archiver.errors[0]
+
+
+def test_adaptive_concurrency_backs_off_and_recovers():
+    """
+    Throttling halves the requests allowed in flight and is retried, successes
+    grow the limit back, and other errors are raised straight away.
+    """
+    responses = [
+        ClientError({"Error": {"Code": "SlowDown"}}, "PutObject"),
+        ClientError({"Error": {"Code": "SlowDown"}}, "PutObject"),
+        "done",
+    ]
+
+    def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    controller = AdaptiveConcurrency(initial=8, base_delay=0, decrease_interval=0)
+    assert controller.call(request) == "done"
+    assert controller.throttled_count == 2
+    assert 2 < controller.limit < 3
+
+    for _ in range(20):
+        controller.on_success()
+    assert controller.limit > 6
+
+    def forbidden():
+        raise ClientError({"Error": {"Code": "AccessDenied"}}, "PutObject")
+
+    with pytest.raises(ClientError):
+        controller.call(forbidden)
+    assert controller.throttled_count == 2
+    assert controller.in_flight == 0
+
+
+def test_adaptive_concurrency_is_the_only_retry(monkeypatch):
+    """
+    Dropped connections are retried without lowering the limit, and clients of
+    controlled requests don't retry on their own.
+    """
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise EndpointConnectionError(endpoint_url="https://s3.invalid")
+        return "done"
+
+    controller = AdaptiveConcurrency(initial=8, base_delay=0)
+    assert controller.call(request) == "done"
+    assert len(attempts) == 2
+    assert controller.throttled_count == 0
+    assert controller.limit > 8
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-southeast-2")
+    registry = ClientRegistry()
+    client = registry.client("s3", max_attempts=SINGLE_ATTEMPT)
+    assert client.meta.config.retries["total_max_attempts"] == 1
+    assert registry.client("s3") is not client
+
+
+def test_async_uploader_bounds_granules_in_flight():
+    """
+    The asyncio mode reads the granules a chunk at a time, keeps at most
+    `concurrency` of them in flight, and retries throttled requests.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        uploader = AsyncUploader(
+            None, None, executor, "/nci", "baseline", "fake-bucket", "", "", "topic"
+        )
+        in_flight = []
+        most_in_flight = 0
+
+        async def process_granule(granule_row, existence_index=None):
+            nonlocal most_in_flight
+            in_flight.append(granule_row)
+            most_in_flight = max(most_in_flight, len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(granule_row)
+            return [f"error {granule_row[0]}"] if granule_row[0] == "7" else []
+
+        uploader.process_granule = process_granule
+        chunks = chunked(([str(number)] for number in range(20)), 6)
+        indexed_chunks = []
+        count, errors = asyncio.run(
+            uploader.process_granules(chunks, indexed_chunks.append, concurrency=4)
+        )
+
+    assert count == 20
+    assert errors == ["error 7"]
+    assert most_in_flight == 4
+    assert [len(chunk) for chunk in indexed_chunks] == [6, 6, 6, 2]
+
+
+class FakeAsyncStream:
+    def __init__(self, body):
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def read(self):
+        return self.body
+
+
+class FakeAsyncClient:
+    """
+    Stands in for an aiobotocore client, keeping objects and messages in memory
+    and throttling the first request of each operation listed
+    """
+
+    def __init__(self, throttle=()):
+        self.objects = {}
+        self.messages = []
+        self.throttle = set(throttle)
+        self.request_count = 0
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    async def _request(self, operation):
+        self.request_count += 1
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.001)
+            if operation in self.throttle:
+                self.throttle.remove(operation)
+                raise ClientError({"Error": {"Code": "SlowDown"}}, operation)
+        finally:
+            self.in_flight -= 1
+
+    async def head_object(self, Bucket, Key):
+        await self._request("HeadObject")
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {}
+
+    async def put_object(self, Bucket, Key, Body, ContentType):
+        await self._request("PutObject")
+        self.objects[Key] = Body.read() if hasattr(Body, "read") else Body
+        return {}
+
+    async def get_object(self, Bucket, Key):
+        await self._request("GetObject")
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": FakeAsyncStream(self.objects[Key])}
+
+    async def publish(self, TopicArn, Message, MessageAttributes):
+        await self._request("Publish")
+        self.messages.append(Message)
+        return {}
+
+
+def test_async_uploader_shares_the_steps_of_process_granule(tmp_path, monkeypatch):
+    """
+    The asyncio mode uploads the same documents as the threaded mode, within the
+    limit of the controllers, and skips granules the journal shows are done.
+    """
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-southeast-2")
+    CLIENTS.clear()
+    # Validating fetches the STAC schemas
+    monkeypatch.setattr(c3_to_s3_rolling, "validate_item", lambda item_doc: None)
+    monkeypatch.setattr(c3_to_s3_rolling, "STAC_TEMPLATES", StacTemplateCache())
+    s3_requests = AdaptiveConcurrency(initial=1, maximum=1, base_delay=0)
+    monkeypatch.setattr(c3_to_s3_rolling, "S3_REQUESTS", s3_requests)
+    monkeypatch.setattr(c3_to_s3_rolling, "SNS_REQUESTS", AdaptiveConcurrency())
+
+    class FakeTransfer:
+        synced = []
+
+        def sync(self, local_path, s3_bucket, s3_prefix, **options):
+            self.synced.append((s3_prefix, options["remote_checksums"]))
+            return {f"{s3_prefix}/band01.tif": 100}
+
+    nci_dir = tmp_path / "nci"
+    fixture = Path(__file__).parent / "data" / METADATA_FIXTURE
+    granule_rows = []
+    for day in ["27", "28"]:
+        granule_dir = nci_dir / "ga_ls8c_ard_3/095/075/2019/07" / day
+        granule_dir.mkdir(parents=True)
+        metadata_file = granule_dir / METADATA_FIXTURE
+        metadata_file.write_bytes(fixture.read_bytes())
+        (granule_dir / "ga_ls8c_ard_3-1-0_095075_2019-07-28_final.sha1").write_text(
+            f"aaa\t{METADATA_FIXTURE}\nbbb\tband01.tif\n"
+        )
+        granule_rows.append([str(metadata_file)])
+
+    s3 = FakeAsyncClient(throttle=["PutObject"])
+    sns = FakeAsyncClient()
+    journal = SyncJournal()
+
+    async def upload():
+        uploader = AsyncUploader(
+            s3,
+            sns,
+            executor,
+            str(nci_dir),
+            "baseline",
+            "fake-bucket",
+            "s3://fake-bucket",
+            "https://explorer",
+            "topic",
+            transfer=FakeTransfer(),
+            journal=journal,
+            delta=True,
+        )
+        return await uploader.process_granules([granule_rows], concurrency=2)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert asyncio.run(upload()) == (2, [])
+
+        # Every stage of both granules is recorded, within the S3 limit
+        assert all(
+            journal.completed_stages(row[0]) == ADDED_STAGES for row in granule_rows
+        )
+        assert s3.most_in_flight == 1
+        assert s3_requests.throttled_count == 1
+        assert len(sns.messages) == 2
+        assert all(remote == {} for _, remote in FakeTransfer.synced)
+
+        prefix = "baseline/ga_ls8c_ard_3/095/075/2019/07/28"
+        metadata = s3.objects[f"{prefix}/{METADATA_FIXTURE}"]
+        checksum_file = s3.objects[
+            f"{prefix}/ga_ls8c_ard_3-1-0_095075_2019-07-28_final.sha1"
+        ].decode()
+        assert f"{hashlib.sha1(metadata).hexdigest()}\t{METADATA_FIXTURE}" in (
+            checksum_file
+        )
+        assert "bbb\tband01.tif" in checksum_file
+
+        # A second run finds both granules complete in the journal
+        request_count = s3.request_count
+        assert asyncio.run(upload()) == (2, [])
+        assert s3.request_count == request_count
+
+
+def test_statsd_client_reports_under_the_granule_product():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(5)
+    statsd = StatsdClient()
+    # Nothing is sent, or fails, before an address is set
+    statsd.incr("granules")
+
+    statsd.configure("127.0.0.1:%d" % server.getsockname()[1])
+    with granule_log_context("ga_ls8c_ard_3/095/075/2019/07/28"):
+        statsd.incr("bytes", 100)
+        with statsd.timer("duration.sync"):
+            pass
+    statsd.incr("retries.sns", product="ga_ls5t_ard_3")
+
+    received = [server.recv(1024).decode("utf-8") for _ in range(3)]
+    server.close()
+    assert received[0] == "nci_upload.ga_ls8c_ard_3.bytes:100|c"
+    assert received[1].startswith("nci_upload.ga_ls8c_ard_3.duration.sync:")
+    assert received[1].endswith("|ms")
+    assert received[2] == "nci_upload.ga_ls5t_ard_3.retries.sns:1|c"
+
+
+def test_client_registry_reuses_clients_per_thread():
+    """
+    Clients are created once per thread, service, region and credentials.
+    """
+    registry = ClientRegistry(max_pool_connections=25)
+    client = registry.client("s3", region_name="ap-southeast-2")
+
+    assert registry.client("s3", region_name="ap-southeast-2") is client
+    assert registry.client("s3", region_name="us-west-2") is not client
+    assert registry.client("sns", region_name="ap-southeast-2") is not client
+    assert client.meta.config.max_pool_connections == 25
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        other_thread_client = executor.submit(
+            registry.client, "s3", region_name="ap-southeast-2"
+        ).result()
+    assert other_thread_client is not client
+
+    registry.clear()
+    assert registry.client("s3", region_name="ap-southeast-2") is not client
+
+
+def test_common_prefixes_groups_granules():
+    keys = [
+        "baseline/ga_ls8c_ard_3/095/075/2019/07/28/a.odc-metadata.yaml",
+        "baseline/ga_ls8c_ard_3/095/075/2019/07/12/b.odc-metadata.yaml",
+        "baseline/ga_ls8c_ard_3/095/075/2019/08/13/c.odc-metadata.yaml",
+        "baseline/ga_ls8c_ard_3/096/075/2019/07/19/d.odc-metadata.yaml",
+    ]
+
+    # Groups of a single granule are left to a HEAD request, cheaper than a LIST
+    assert common_prefixes(keys) == ["baseline/ga_ls8c_ard_3/095/075/2019/07/"]
+    assert common_prefixes(keys, group_depth=3) == [
+        "baseline/ga_ls8c_ard_3/095/075/2019/"
+    ]
+    assert common_prefixes(keys, min_granules=1) == [
+        "baseline/ga_ls8c_ard_3/095/075/2019/07/",
+        "baseline/ga_ls8c_ard_3/095/075/2019/08/13/",
+        "baseline/ga_ls8c_ard_3/096/075/2019/07/19/",
+    ]
+    # The deepest prefix shared by the whole batch
+    assert common_prefixes(keys, group_depth=None) == ["baseline/ga_ls8c_ard_3/"]
+    assert common_prefixes(keys[:3], group_depth=None) == [
+        "baseline/ga_ls8c_ard_3/095/075/2019/"
+    ]
+
+
+@moto.mock_s3
+def test_existence_index_lists_instead_of_head():
+    bucket_name = "fake-bucket"
+    client = boto3.client("s3", region_name="ap-southeast-2")
+    client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+    prefix = "baseline/ga_ls8c_ard_3/095/075/2019/07"
+    existing = [f"{prefix}/{day:02}/metadata.odc-metadata.yaml" for day in range(1, 6)]
+    missing = [f"{prefix}/{day:02}/metadata.odc-metadata.yaml" for day in range(6, 9)]
+    for key in existing:
+        client.put_object(Bucket=bucket_name, Key=key, Body=b"")
+        client.put_object(
+            Bucket=bucket_name, Key=key.replace("metadata.odc", "band"), Body=b""
+        )
+
+    index = S3ExistenceIndex(bucket_name, existing + missing)
+
+    assert index.request_count == 1
+    assert all(index.exists(key) for key in existing)
+    assert not any(index.exists(key) for key in missing)
+    # Keys outside of the batch fall back to a HEAD request
+    assert not index.exists("baseline/ga_ls8c_ard_3/096/075/2019/07/01/other.yaml")
+
+
+@moto.mock_s3
+def test_existence_index_heads_granules_alone_in_their_group():
+    """
+    A daily run has about one granule per path/row and month, listing each of
+    them would cost more than a HEAD request.
+    """
+    bucket_name = "fake-bucket"
+    client = boto3.client("s3", region_name="ap-southeast-2")
+    client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+    keys = [
+        f"baseline/ga_ls8c_ard_3/{path_row}/2019/07/28/metadata.odc-metadata.yaml"
+        for path_row in ["095/075", "096/075", "097/075"]
+    ]
+    client.put_object(Bucket=bucket_name, Key=keys[0], Body=b"")
+
+    index = S3ExistenceIndex(bucket_name, keys)
+    assert index.request_count == 0
+    assert not any(index.covers(key) for key in keys)
+    assert [index.exists(key) for key in keys] == [True, False, False]
+    assert index.request_count == 3
+
+    # Or all of them in one listing, under the prefix they all share
+    index = S3ExistenceIndex(bucket_name, keys, group_depth=None)
+    assert index.request_count == 1
+    assert all(index.covers(key) for key in keys)
+    assert [index.exists(key) for key in keys] == [True, False, False]
+    assert index.request_count == 1
+
+
+def test_sync_journal_records_sns_per_action(tmp_path):
+    """
+    An ADDED message recorded for a granule doesn't stop its ARCHIVED message,
+    also in journals that recorded both under one stage.
+    """
+    journal_path = tmp_path / "journal.sqlite"
+    granule = "/g/data/xu18/ga/ga_ls8c_ard_3/095/075/2019/07/28/a.odc-metadata.yaml"
+    added_stages = ADDED_STAGES - {SyncJournal.SNS_ADDED}
+
+    journal = SyncJournal(journal_path)
+    for stage in added_stages:
+        journal.mark_done(granule, stage)
+    # Recorded by an earlier version for the ADDED message
+    journal.mark_done(granule, "sns published")
+    journal.close()
+
+    journal = SyncJournal(journal_path)
+    assert journal.completed_stages(granule) == ADDED_STAGES
+    is_granule_complete = c3_to_s3_rolling.is_granule_complete
+    assert is_granule_complete(granule, "a", False, journal.completed_stages(granule))
+
+    journal.mark_done(granule, SyncJournal.ARCHIVED)
+    assert not is_granule_complete(
+        granule, "a", True, journal.completed_stages(granule)
+    )
+    journal.mark_done(granule, SyncJournal.SNS_ARCHIVED)
+    assert is_granule_complete(granule, "a", True, journal.completed_stages(granule))
+    journal.close()
+
+
+def test_sync_journal_survives_restart(tmp_path):
+    journal_path = tmp_path / "journal.sqlite"
+    granule = "/g/data/xu18/ga/ga_ls8c_ard_3/095/075/2019/07/28/a.odc-metadata.yaml"
+
+    journal = SyncJournal(journal_path)
+    journal.mark_done(granule, SyncJournal.SYNCED)
+    journal.mark_done(granule, SyncJournal.ARCHIVED, payload='{"id": "a"}')
+    journal.close()
+
+    journal = SyncJournal(journal_path)
+    assert journal.completed_stages(granule) == {
+        SyncJournal.SYNCED,
+        SyncJournal.ARCHIVED,
+    }
+    assert journal.is_done(granule, SyncJournal.SYNCED)
+    assert not journal.is_done(granule, SyncJournal.SNS_ADDED)
+    assert journal.get_payload(granule, SyncJournal.ARCHIVED) == '{"id": "a"}'
+    assert journal.completed_stages("other") == set()
+    journal.close()
+
+
+def test_sync_journal_batches_commits(tmp_path):
+    journal_path = tmp_path / "journal.sqlite"
+    journal = SyncJournal(journal_path, commit_interval=3600)
+    journal.mark_done("a", SyncJournal.SYNCED)
+    assert journal.completed_stages("a") == {SyncJournal.SYNCED}
+
+    # Nothing is committed until the interval passes, or the journal is flushed
+    reader = SyncJournal(journal_path)
+    assert reader.completed_stages("a") == set()
+    journal.flush()
+    assert reader.completed_stages("a") == {SyncJournal.SYNCED}
+    reader.close()
+    journal.close()
+
+
+@moto.mock_sns
+def test_batch_publisher_publishes_every_message(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-southeast-2")
+    CLIENTS.clear()
+    sns = boto3.client("sns", region_name="ap-southeast-2")
+    topic_arn = sns.create_topic(Name="fake-topic")["TopicArn"]
+
+    published = []
+    publisher = BatchPublisher(topic_arn, max_wait=60)
+    for number in range(23):
+        publisher.publish(
+            f'{{"id": {number}}}',
+            {"action": {"DataType": "String", "StringValue": "ADDED"}},
+            on_success=lambda number=number: published.append(number),
+        )
+    # Two full batches were sent straight away, the rest waits for close
+    assert len(published) == 20
+
+    publisher.close()
+    assert sorted(published) == list(range(23))
+    assert publisher.errors == []
+
+
+def test_batch_publisher_reports_connection_errors(monkeypatch):
+    class UnreachableSNS:
+        def publish_batch(self, **kwargs):
+            raise EndpointConnectionError(endpoint_url="https://sns.invalid")
+
+    monkeypatch.setattr(CLIENTS, "client", lambda service, **kwargs: UnreachableSNS())
+    monkeypatch.setattr(
+        c3_to_s3_rolling, "SNS_REQUESTS", AdaptiveConcurrency(base_delay=0)
+    )
+    publisher = BatchPublisher("arn:aws:sns:ap-southeast-2:123456789012:topic")
+    publisher.publish("{}", {}, on_success=pytest.fail)
+    publisher.close()
+    assert len(publisher.errors) == 1
+    assert "Could not connect to the endpoint URL" in publisher.errors[0]
+
+
+def test_batch_publisher_fails_messages_over_the_payload_limit(monkeypatch):
+    class RecordingSNS:
+        def __init__(self):
+            self.batches = []
+
+        def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+            self.batches.append([entry["Id"] for entry in PublishBatchRequestEntries])
+            return {
+                "Successful": [
+                    {"Id": entry["Id"]} for entry in PublishBatchRequestEntries
+                ],
+                "Failed": [],
+            }
+
+    sns_client = RecordingSNS()
+    monkeypatch.setattr(CLIENTS, "client", lambda service, **kwargs: sns_client)
+    publisher = BatchPublisher("arn:aws:sns:ap-southeast-2:123456789012:topic", 60)
+    oversized = "x" * (BatchPublisher.MAX_BATCH_BYTES + 1)
+    # Alone in the buffer, and after a buffered message
+    publisher.publish(oversized, {}, on_success=pytest.fail)
+    published = []
+    publisher.publish("{}", {}, on_success=lambda: published.append(1))
+    publisher.publish(oversized, {}, on_success=pytest.fail)
+    publisher.close()
+
+    assert sns_client.batches == [["1"]]
+    assert published == [1]
+    assert len(publisher.errors) == 2
+    assert all("over the SNS limit" in error for error in publisher.errors)
+
+
+@pytest.mark.parametrize(
+    "code, expected_calls",
+    [
+        # Retried by SNS_REQUESTS, then the batch is sent again
+        ("Throttling", 2 * 3),
+        # Neither retried nor sent again
+        ("AuthorizationError", 1),
+    ],
+)
+def test_batch_publisher_sends_only_throttled_batches_again(
+    monkeypatch, code, expected_calls
+):
+    calls = []
+
+    class FailingSNS:
+        def publish_batch(self, **kwargs):
+            calls.append(kwargs)
+            raise ClientError({"Error": {"Code": code, "Message": ""}}, "PublishBatch")
+
+    monkeypatch.setattr(CLIENTS, "client", lambda service, **kwargs: FailingSNS())
+    monkeypatch.setattr(
+        c3_to_s3_rolling,
+        "SNS_REQUESTS",
+        AdaptiveConcurrency(base_delay=0, max_attempts=2),
+    )
+    publisher = BatchPublisher(
+        "arn:aws:sns:ap-southeast-2:123456789012:topic", 0, max_attempts=3
+    )
+    publisher.publish("{}", {}, on_success=pytest.fail)
+    publisher.close()
+    assert len(calls) == expected_calls
+    assert len(publisher.errors) == 1
+    assert code in publisher.errors[0]
+
+
+def test_batch_publisher_reports_entries_missing_from_the_response(monkeypatch):
+    class ForgetfulSNS:
+        def publish_batch(self, **kwargs):
+            return {"Successful": [], "Failed": []}
+
+    monkeypatch.setattr(CLIENTS, "client", lambda service, **kwargs: ForgetfulSNS())
+    monkeypatch.setattr(
+        c3_to_s3_rolling, "SNS_REQUESTS", AdaptiveConcurrency(base_delay=0)
+    )
+    publisher = BatchPublisher("arn:aws:sns:ap-southeast-2:123456789012:topic", 0)
+    publisher.publish("{}", {}, on_success=pytest.fail)
+    publisher.close()
+    assert len(publisher.errors) == 1
+    assert publisher.errors[0].endswith("Missing from the PublishBatch response")
+
+
+def test_batch_publisher_without_publish_batch_sends_each_message(monkeypatch):
+    class OldSNS:
+        # botocore before 1.23 has no publish_batch
+        def __init__(self):
+            self.messages = []
+
+        def publish(self, TopicArn, Message, MessageAttributes):
+            self.messages.append(Message)
+
+    sns_client = OldSNS()
+    monkeypatch.setattr(CLIENTS, "client", lambda service, **kwargs: sns_client)
+    publisher = BatchPublisher("arn:aws:sns:ap-southeast-2:123456789012:topic", 0)
+    published = []
+    publisher.publish("{}", {}, on_success=lambda: published.append(1))
+    # Without a wait every message is sent straight away
+    assert sns_client.messages == ["{}"]
+    assert published == [1]
+    publisher.close()
+    assert publisher.errors == []
+
+
+def test_bounded_map_consumes_items_lazily():
+    consumed = []
+
+    def items():
+        for number in range(100):
+            consumed.append(number)
+            yield number
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = bounded_map(executor, lambda number: number * 2, items(), window=4)
+        first = next(results)
+        # Only the submission window has been read from the iterator
+        assert len(consumed) <= 5
+        assert sorted([first, *results]) == [number * 2 for number in range(100)]
+
+
+def test_staged_pipeline_applies_backpressure(tmp_path):
+    consumed = []
+    published = []
+    release = threading.Event()
+
+    def jobs():
+        for number in range(20):
+            consumed.append(number)
+            yield {"number": number, "errors": []}
+
+    def sync(job):
+        if job["number"] == 3:
+            raise ValueError("broken granule")
+        return True
+
+    def publish(job):
+        # The slow stage holds up everything before it
+        release.wait()
+        published.append(job["number"])
+        job["errors"].append(f"published {job['number']}")
+        return True
+
+    pipeline = StagedPipeline(
+        [("sync", sync, 2), ("publish", publish, 1)],
+        queue_size=2,
+        report_interval=0,
+        report_path=tmp_path / "queues.json",
+    )
+    runner = ThreadPoolExecutor(max_workers=1)
+    count = runner.submit(pipeline.run, jobs())
+    try:
+        time.sleep(0.5)
+        # Two queues of two, a job in each sync worker, one being published and
+        # one waiting to be queued
+        assert len(consumed) <= 9
+        assert pipeline.depths() == {"sync": 2, "publish": 2}
+    finally:
+        release.set()
+    assert count.result() == 20
+    runner.shutdown()
+
+    assert sorted(published) == [number for number in range(20) if number != 3]
+    assert "Unexpected error in the sync stage - broken granule" in pipeline.errors
+    assert len(pipeline.errors) == 20
+
+    # The final snapshot is written once the pipeline is drained
+    snapshot = json.loads((tmp_path / "queues.json").read_text())
+    assert snapshot["stages"]["sync"]["processed"] == 20
+    assert snapshot["stages"]["publish"] == {
+        "workers": 1,
+        "depth": 0,
+        "max_depth": 2,
+        "processed": 19,
+    }
+
+
+def test_hashing_writer_hashes_serialised_yaml():
+    with HashingWriter() as writer:
+        serialise.dumps_yaml(writer, {"id": "a", "measurements": {"blue": {}}})
+        assert writer.hexdigest() == hashlib.sha1(writer.getvalue()).hexdigest()
+        assert writer.rewind().read() == writer.getvalue()
+
+
+@moto.mock_s3
+def test_upload_checksum_rewrites_manifest(tmp_path):
+    bucket_name = "fake-bucket"
+    client = boto3.client("s3", region_name="ap-southeast-2")
+    client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+    metadata_file = (
+        tmp_path / "ga_ls8c_ard_3-1-0_095075_2019-07-28_final.odc-metadata.yaml"
+    )
+    checksum_file = tmp_path / "ga_ls8c_ard_3-1-0_095075_2019-07-28_final.sha1"
+    checksum_file.write_text(
+        "aaa\tga_ls8c_ard_3-1-0_095075_2019-07-28_final.odc-metadata.yaml\n"
+        "bbb\tga_ls8c_nbar_3-1-0_095075_2019-07-28_final_band01.tif\n"
+        "ccc\tga_ls8c_nbart_3-1-0_095075_2019-07-28_final_band01.tif\n"
+    )
+
+    upload_checksum(
+        metadata_file,
+        checksum_file,
+        {metadata_file.name: "ddd"},
+        bucket_name,
+        "baseline/095/075/2019/07/28",
+    )
+
+    body = client.get_object(
+        Bucket=bucket_name, Key=f"baseline/095/075/2019/07/28/{checksum_file.name}"
+    )["Body"].read()
+    assert body == (
+        b"ddd\tga_ls8c_ard_3-1-0_095075_2019-07-28_final.odc-metadata.yaml\n"
+        b"ccc\tga_ls8c_nbart_3-1-0_095075_2019-07-28_final_band01.tif\n"
+    )
+
+
+@moto.mock_s3
+@pytest.mark.parametrize(
+    "validate_known_layouts, expected_validations",
+    [
+        (True, ["27", "28"]),
+        # Second granule of the product has the same layout, so isn't validated
+        (False, ["27"]),
+    ],
+)
+def test_upload_metadata_validates_stac_items(
+    tmp_path, monkeypatch, validate_known_layouts, expected_validations
+):
+    """
+    Every STAC item is created once and validated, unless its layout is already
+    known and known layouts are skipped. STAC files are indented and SNS
+    messages are compact.
+    """
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-southeast-2")
+    CLIENTS.clear()
+    bucket_name = "fake-bucket"
+    client = boto3.client("s3", region_name="ap-southeast-2")
+    client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+    renders = []
+    validations = []
+
+    def fake_dc_to_stac(*args):
+        renders.append(args[-1])
+        return dc_to_stac(*args)
+
+    monkeypatch.setattr(c3_to_s3_rolling, "dc_to_stac", fake_dc_to_stac)
+    monkeypatch.setattr(
+        c3_to_s3_rolling,
+        "validate_item",
+        lambda item_doc: validations.append(item_doc["links"][0]["href"]),
+    )
+    monkeypatch.setattr(
+        c3_to_s3_rolling, "STAC_TEMPLATES", StacTemplateCache(validate_known_layouts)
+    )
+    published = []
+    monkeypatch.setattr(
+        c3_to_s3_rolling,
+        "publish_sns",
+        lambda topic, message, attributes: published.append(message),
+    )
+
+    fixture = Path(__file__).parent / "data" / METADATA_FIXTURE
+    for day in ["27", "28"]:
+        granule_dir = tmp_path / day
+        granule_dir.mkdir()
+        metadata_file = granule_dir / METADATA_FIXTURE
+        metadata_file.write_bytes(fixture.read_bytes())
+        (granule_dir / "ga_ls8c_ard_3-1-0_095075_2019-07-28_final.sha1").write_text(
+            f"aaa\t{METADATA_FIXTURE}\n"
+        )
+        assert (
+            upload_metadata(
+                str(metadata_file),
+                bucket_name,
+                "s3://fake-bucket",
+                "https://explorer",
+                "fake-topic",
+                f"baseline/{day}",
+            )
+            == []
+        )
+
+    assert renders == [False, False]
+    assert [href.split("/")[-2] for href in validations] == expected_validations
+    assert [len(message.splitlines()) for message in published] == [1, 1]
+
+    stac_file = client.get_object(
+        Bucket=bucket_name,
+        Key="baseline/28/ga_ls8c_ard_3-1-0_095075_2019-07-28_final.stac-item.json",
+    )["Body"].read()
+    assert json.loads(stac_file) == json.loads(published[1])
+    assert stac_file.startswith(b'{\n    "')
+
+
+def test_stac_template_cache_rejects_bad_values_of_known_layouts(monkeypatch):
+    """
+    An item is validated even when its product already had a valid item of
+    the same layout, so a bad value is still rejected.
+    """
+
+    def fake_validate_item(item_doc):
+        # The gsd rule of the STAC common metadata schema, which is fetched
+        jsonschema.validate(
+            item_doc["properties"],
+            {"properties": {"gsd": {"type": "number", "exclusiveMinimum": 0}}},
+        )
+
+    monkeypatch.setattr(c3_to_s3_rolling, "validate_item", fake_validate_item)
+    fixture = Path(__file__).parent / "data" / METADATA_FIXTURE
+    output_path = Path(
+        METADATA_FIXTURE.replace(".odc-metadata.yaml", ".stac-item.json")
+    )
+    cache = StacTemplateCache()
+
+    cache.to_stac(
+        serialise.from_path(fixture), fixture, output_path, "s3://b/", "https://e"
+    )
+    dataset = serialise.from_path(fixture)
+    with pytest.warns(PropertyOverrideWarning):
+        dataset.properties.normalise_and_set("eo:gsd", -30, allow_override=True)
+    with pytest.raises(jsonschema.ValidationError):
+        cache.to_stac(dataset, fixture, output_path, "s3://b/", "https://e")
+
+
+def test_libyaml_metadata_matches_eodatasets():
+    """
+    The libyaml loader gives the same document as the eodatasets3 one, and the
+    benchmark times every path.
+    """
+    fixture = Path(__file__).parent / "data" / METADATA_FIXTURE
+    assert load_metadata(fixture) == serialise.load_yaml(fixture)
+
+    timings = benchmark_metadata_io([fixture], repeat=1)
+    assert sorted(timings[METADATA_FIXTURE]) == [
+        "dump libyaml",
+        "dump python",
+        "load eodatasets3",
+        "load libyaml",
+        "load python",
+    ]
+
+
+@moto.mock_s3
+def test_sync_granules_collects_errors_from_all_workers(tmp_path):
+    """
+    Every granule handled by the worker pool reports its errors into the final exception,
+    and into the error report that the shards of an array job are merged from.
+    """
+    nci_dir = tmp_path / "nci"
+    granules = [
+        nci_dir / f"ga_ls8c_ard_3/095/075/2019/07/{day:02}/missing.odc-metadata.yaml"
+        for day in range(1, 9)
+    ]
+    csv_file = tmp_path / "granules.csv"
+    csv_file.write_text("".join(f"{granule}\n" for granule in granules))
+
+    with pytest.raises(S3SyncException) as exc_info:
+        sync_granules(
+            str(csv_file),
+            str(nci_dir),
+            "baseline",
+            "fake-bucket",
+            "",
+            "",
+            "arn:aws:sns:ap-southeast-2:123456789012:fake-topic",
+            workers=4,
+            error_report_path=str(tmp_path / "errors.json"),
+        )
+
+    errors = str(exc_info.value).splitlines()
+    assert len(errors) == len(granules)
+    assert all("missing metadata file in NCI" in error for error in errors)
+    report = json.loads((tmp_path / "errors.json").read_text())
+    assert report["granules"] == len(granules)
+    assert sorted(report["errors"]) == sorted(errors)
+
+
+def test_sync_granules_workers_keep_the_errors_and_logs_of_each_granule(
+    tmp_path, monkeypatch
+):
+    """
+    With several workers, granules overlap and finish out of order, but the errors
+    of each granule stay together and in order, and every log line is tagged with
+    the granule that emitted it, not another one run by the same thread.
+    """
+    nci_dir = tmp_path / "nci"
+    days = range(1, 13)
+    metadata_files = [
+        str(nci_dir / f"ga_ls8c_ard_3/095/075/2019/07/{day:02}/ga.odc-metadata.yaml")
+        for day in days
+    ]
+    csv_file = tmp_path / "granules.csv"
+    csv_file.write_text(
+        "".join(f"{metadata_file}\n" for metadata_file in metadata_files)
+    )
+
+    running = []
+    overlap = []
+    lock = threading.Lock()
+
+    def run_steps(steps):
+        # The steps aren't started, their arguments name the granule
+        metadata_file = steps.gi_frame.f_locals["metadata_file"]
+        steps.close()
+        day = int(Path(metadata_file).parent.name)
+        with lock:
+            running.append(day)
+            overlap.append(len(running))
+        # Later granules finish first
+        time.sleep(0.01 * (len(days) - day))
+        c3_to_s3_rolling.LOG.info(f"Synced {metadata_file}")
+        with lock:
+            running.remove(day)
+        if day % 3 == 0:
+            return [f"{metadata_file} first error", f"{metadata_file} second error"]
+        return []
+
+    monkeypatch.setattr(c3_to_s3_rolling, "run_steps", run_steps)
+    monkeypatch.setattr(c3_to_s3_rolling, "is_granule_complete", lambda *args: False)
+
+    records = []
+
+    class RecordingHandler(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+
+    handler = RecordingHandler()
+    handler.addFilter(c3_to_s3_rolling.GranuleLogFilter())
+    c3_to_s3_rolling.LOG.addHandler(handler)
+    level = c3_to_s3_rolling.LOG.level
+    c3_to_s3_rolling.LOG.setLevel(logging.INFO)
+    try:
+        with pytest.raises(S3SyncException) as exc_info:
+            sync_granules(
+                str(csv_file),
+                str(nci_dir),
+                "baseline",
+                "fake-bucket",
+                "",
+                "",
+                "arn:aws:sns:ap-southeast-2:123456789012:fake-topic",
+                workers=4,
+                transfer_backend="cli",
+                existence_index=False,
+                sns_batch=False,
+            )
+    finally:
+        c3_to_s3_rolling.LOG.setLevel(level)
+        c3_to_s3_rolling.LOG.removeHandler(handler)
+
+    assert max(overlap) > 1
+    errors = str(exc_info.value).splitlines()
+    failed = [metadata_files[day - 1] for day in days if day % 3 == 0]
+    assert sorted(errors[::2]) == [
+        f"{metadata_file} first error" for metadata_file in failed
+    ]
+    # Both errors of a granule are next to each other, in the order it returned them
+    assert [error.replace("first", "second") for error in errors[::2]] == errors[1::2]
+
+    synced = [record for record in records if record.getMessage().startswith("Synced")]
+    assert len(synced) == len(metadata_files)
+    assert {record.threadName for record in synced} != {"MainThread"}
+    for record in synced:
+        metadata_file = Path(record.getMessage().split()[-1])
+        assert record.granule == str(metadata_file.relative_to(nci_dir).parent)
+
+
 @pytest.fixture
 def local_stac():
     return Path("tests/data/ga_ls8c_ard_3-1-0_095075_2019-07-28_final.stac-item.json")
@@ -0,0 +1,118 @@
+import importlib.util
+import io
+from pathlib import Path
+
+import pytest
+
+SCRIPT = Path(__file__).parent.parent / "scripts" / "compare-lists.py"
+
+
+@pytest.fixture
+def compare_lists():
+    # Imported by the script, and not needed by the upload scripts
+    pytest.importorskip("humanize")
+    pytest.importorskip("psutil")
+    # The name of the script isn't a module name, so it's loaded from its path
+    spec = importlib.util.spec_from_file_location("compare_lists", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_lines(path, lines, trailing_newline=True):
+    text = "\n".join(lines)
+    if lines and trailing_newline:
+        text += "\n"
+    path.write_text(text)
+    return path
+
+
+def expected_diff(lines1, lines2):
+    set1, set2 = set(lines1), set(lines2)
+    return {
+        "left": sorted(set1 - set2),
+        "right": sorted(set2 - set1),
+        "common": sorted(set1 & set2),
+    }
+
+
+def run_streaming_diff(compare_lists, file1, file2, memory_cap, tmp_dir):
+    outputs = {side: io.StringIO() for side in ("left", "right", "common")}
+    counts = compare_lists.streaming_diff(file1, file2, outputs, memory_cap, tmp_dir)
+    lines = {side: output.getvalue().splitlines() for side, output in outputs.items()}
+    assert counts == {side: len(side_lines) for side, side_lines in lines.items()}
+    return lines
+
+
+@pytest.mark.parametrize(
+    "lines1, lines2, trailing_newline",
+    [
+        (["b", "a", "b", "c", "a", "e"], ["c", "d", "d", "e", "c"], True),
+        ([], ["a", "b"], True),
+        (["a", "b"], [], True),
+        ([], [], True),
+        (["c", "a", "b"], ["b", "d"], False),
+    ],
+    ids=["duplicates", "empty left", "empty right", "both empty", "no newline"],
+)
+@pytest.mark.parametrize("memory_cap", [1, 1024 * 1024], ids=["runs", "one run"])
+def test_streaming_diff_matches_set_difference(
+    compare_lists, tmp_path, lines1, lines2, trailing_newline, memory_cap
+):
+    file1 = write_lines(tmp_path / "file1.txt", lines1, trailing_newline)
+    file2 = write_lines(tmp_path / "file2.txt", lines2, trailing_newline)
+    run_dir = tmp_path / "runs"
+    run_dir.mkdir()
+
+    assert run_streaming_diff(
+        compare_lists, file1, file2, memory_cap, run_dir
+    ) == expected_diff(lines1, lines2)
+    # The run files are removed
+    assert list(run_dir.iterdir()) == []
+
+
+def test_streaming_diff_merges_runs_in_several_levels(
+    compare_lists, tmp_path, monkeypatch
+):
+    """
+    With more runs than MAX_FAN_IN, runs are merged into longer ones first,
+    more than once, without losing or repeating lines.
+    """
+    monkeypatch.setattr(compare_lists, "MAX_FAN_IN", 3)
+    lines1 = [f"granule-{number % 40:03d}" for number in range(0, 120, 7)]
+    lines2 = [f"granule-{number % 40:03d}" for number in range(0, 90, 5)]
+    file1 = write_lines(tmp_path / "file1.txt", lines1)
+    file2 = write_lines(tmp_path / "file2.txt", lines2)
+
+    # Every line is a run of its own
+    runs = compare_lists.sorted_runs(file1, 1, tmp_path)
+    assert len(runs) == len(lines1) > 3**2
+
+    assert run_streaming_diff(
+        compare_lists, file1, file2, 1, tmp_path
+    ) == expected_diff(lines1, lines2)
+
+
+def test_hashed_difference_checks_colliding_lines(
+    compare_lists, tmp_path, monkeypatch, capsys
+):
+    """
+    Lines of set1 whose hash is in FILE2 only because of a collision are still
+    in the difference.
+    """
+    # Lines of the same length collide
+    monkeypatch.setattr(compare_lists, "hash", len, raising=False)
+    lines1 = ["aa", "bb", "c", "ddd", "eeee", "fffff"]
+    lines2 = ["xx", "c", "ddd", "yyyyy", "c"]
+    file2 = write_lines(tmp_path / "file2.txt", lines2)
+
+    difference, hashes_count = compare_lists.hashed_difference(set(lines1), file2)
+
+    assert difference == sorted(set(lines1) - set(lines2))
+    assert hashes_count == 4
+    assert "3 hash collisions" in capsys.readouterr().err
+
+
+def test_hashed_difference_of_an_empty_file(compare_lists, tmp_path):
+    file2 = write_lines(tmp_path / "file2.txt", [])
+    assert compare_lists.hashed_difference({"b", "a"}, file2) == (["a", "b"], 0)
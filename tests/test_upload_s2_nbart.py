@@ -0,0 +1,395 @@
+import importlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+GRANULE_ID = "2021-01-01/S2A_OPER_MSI_ARD_TL_EPAE_20210101T012345_A028000_T55HFA_N02.09"
+STAC_FIXTURE = Path(
+    "tests/data/ga_ls8c_ard_3-1-0_095075_2019-07-28_final.stac-item.json"
+)
+
+
+@pytest.fixture
+def upload_s2_nbart(monkeypatch):
+    # The script imports c3_to_s3_rolling from its own directory
+    monkeypatch.syspath_prepend(str(Path(__file__).parent.parent / "scripts"))
+    return importlib.import_module("upload_s2_nbart")
+
+
+@pytest.fixture
+def uploads(upload_s2_nbart, monkeypatch):
+    """
+    Record the uploads of upload_granule instead of sending them
+    """
+    calls = []
+    stac = STAC_FIXTURE.read_text()
+
+    def create_metadata_documents(granule_id):
+        calls.append(("create", threading.current_thread().name))
+        granule_s3_path = upload_s2_nbart.get_granule_s3_path(granule_id)
+        return {
+            "eo3_key": f"{granule_s3_path}/eo3.yaml",
+            "eo3": "",
+            "stac_key": f"{granule_s3_path}/stac.json",
+            "stac": stac,
+            "message": stac,
+            "message_attributes": {},
+        }
+
+    monkeypatch.setattr(
+        upload_s2_nbart, "sync_granule", lambda *args, **kwargs: calls.append(("sync",))
+    )
+    monkeypatch.setattr(
+        upload_s2_nbart, "create_metadata_documents", create_metadata_documents
+    )
+    monkeypatch.setattr(
+        upload_s2_nbart,
+        "upload_s3_resource",
+        lambda s3_bucket, key, *args, **kwargs: calls.append(("put", key)),
+    )
+    monkeypatch.setattr(
+        upload_s2_nbart, "publish_sns", lambda *args: calls.append(("sns",))
+    )
+    return calls
+
+
+def test_upload_granule_skips_uploaded_granules(upload_s2_nbart, uploads, monkeypatch):
+    monkeypatch.setattr(upload_s2_nbart, "granule_exists", lambda *args: True)
+    journal = upload_s2_nbart.SyncJournal()
+
+    upload_s2_nbart.upload_granule(GRANULE_ID, "topic", journal=journal)
+
+    assert uploads == []
+    assert journal.completed_stages(GRANULE_ID) == set()
+
+
+def test_upload_granule_resumes_after_the_completed_stages(
+    upload_s2_nbart, uploads, monkeypatch
+):
+    """
+    A granule partly uploaded by a previous run is finished, even though it now
+    looks uploaded, without repeating the stages the journal recorded.
+    """
+    monkeypatch.setattr(upload_s2_nbart, "granule_exists", lambda *args: True)
+    SyncJournal = upload_s2_nbart.SyncJournal
+    journal = SyncJournal()
+    journal.mark_done(GRANULE_ID, SyncJournal.SYNCED)
+    journal.mark_done(GRANULE_ID, SyncJournal.METADATA)
+
+    upload_s2_nbart.upload_granule(GRANULE_ID, "topic", journal=journal)
+
+    stac_key = f"{upload_s2_nbart.get_granule_s3_path(GRANULE_ID)}/stac.json"
+    assert uploads == [
+        ("create", threading.current_thread().name),
+        ("sns",),
+        ("put", stac_key),
+    ]
+    assert journal.completed_stages(GRANULE_ID) == upload_s2_nbart.S2_STAGES
+
+
+def test_upload_granule_retries_a_failed_sns_message(
+    upload_s2_nbart, uploads, monkeypatch
+):
+    monkeypatch.setattr(upload_s2_nbart, "granule_exists", lambda *args: False)
+    SyncJournal = upload_s2_nbart.SyncJournal
+    journal = SyncJournal()
+
+    def fail_publish(*args):
+        raise RuntimeError("SNS is down")
+
+    with monkeypatch.context() as failing:
+        failing.setattr(upload_s2_nbart, "publish_sns", fail_publish)
+        upload_s2_nbart.upload_granule(GRANULE_ID, "topic", journal=journal)
+
+    # The STAC item is uploaded last even so, but the granule isn't complete
+    granule_s3_path = upload_s2_nbart.get_granule_s3_path(GRANULE_ID)
+    stac_key = f"{granule_s3_path}/stac.json"
+    thread_name = threading.current_thread().name
+    assert uploads == [
+        ("sync",),
+        ("create", thread_name),
+        ("put", f"{granule_s3_path}/eo3.yaml"),
+        ("put", stac_key),
+    ]
+    assert journal.completed_stages(GRANULE_ID) == upload_s2_nbart.S2_STAGES - {
+        SyncJournal.SNS_ADDED
+    }
+
+    # The next run only sends the message, and uploads the STAC item again
+    uploads.clear()
+    upload_s2_nbart.upload_granule(GRANULE_ID, "topic", journal=journal)
+    assert uploads == [("create", thread_name), ("sns",), ("put", stac_key)]
+    assert journal.completed_stages(GRANULE_ID) == upload_s2_nbart.S2_STAGES
+
+
+def test_upload_granule_creates_metadata_in_the_pool(
+    upload_s2_nbart, uploads, monkeypatch
+):
+    """
+    Only the metadata is created by the pool, a process pool in the script,
+    the uploads stay on the thread of the granule.
+    """
+    monkeypatch.setattr(upload_s2_nbart, "granule_exists", lambda *args: False)
+    journal = upload_s2_nbart.SyncJournal()
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="metadata") as pool:
+        upload_s2_nbart.upload_granule(
+            GRANULE_ID, "topic", journal=journal, metadata_pool=pool
+        )
+
+    assert [call[0] for call in uploads] == ["sync", "create", "put", "sns", "put"]
+    assert uploads[1] == ("create", "metadata_0")
+    assert journal.completed_stages(GRANULE_ID) == upload_s2_nbart.S2_STAGES
+
+
+@pytest.fixture
+def stubbed_aws(upload_s2_nbart, monkeypatch):
+    """
+    Give the script a registry of its own, with clients that never connect
+    """
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-southeast-2")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    # The module the script imports, rather than scripts.c3_to_s3_rolling
+    c3_to_s3_rolling = importlib.import_module("c3_to_s3_rolling")
+    registry = c3_to_s3_rolling.ClientRegistry()
+    monkeypatch.setattr(c3_to_s3_rolling, "CLIENTS", registry)
+    monkeypatch.setattr(upload_s2_nbart, "CLIENTS", registry)
+    return c3_to_s3_rolling
+
+
+def test_worker_threads_reuse_the_clients_they_start_with(
+    upload_s2_nbart, stubbed_aws, monkeypatch
+):
+    """
+    Every executor thread creates its session and clients once, when it starts,
+    and its uploads pass the ACL on to PutObject.
+    """
+    sessions = []
+
+    class RecordingSession(boto3.session.Session):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            sessions.append(threading.current_thread().name)
+
+    monkeypatch.setattr(boto3.session, "Session", RecordingSession)
+
+    def upload(number):
+        # Created by start_worker, before the thread's first task
+        assert threading.current_thread().name in sessions
+        s3 = stubbed_aws.CLIENTS.resource(
+            "s3", max_attempts=upload_s2_nbart.SINGLE_ATTEMPT
+        )
+        key = f"baseline/{number}/stac.json"
+        with Stubber(s3.meta.client) as stubber:
+            stubber.add_response(
+                "put_object",
+                {},
+                {
+                    "Bucket": "fake-bucket",
+                    "Key": key,
+                    "Body": "{}",
+                    "ContentType": "application/json",
+                    "ACL": "bucket-owner-full-control",
+                },
+            )
+            upload_s2_nbart.upload_s3_resource(
+                "fake-bucket",
+                key,
+                "{}",
+                content_type="application/json",
+                acl="bucket-owner-full-control",
+            )
+            stubber.assert_no_pending_responses()
+        return threading.current_thread().name
+
+    with ThreadPoolExecutor(
+        max_workers=2,
+        thread_name_prefix="granule",
+        initializer=upload_s2_nbart.start_worker,
+    ) as executor:
+        threads = set(executor.map(upload, range(6)))
+
+    # One session for each thread, created by start_worker
+    assert len(sessions) == len(set(sessions)) <= 2
+    assert threads <= set(sessions)
+
+
+def test_upload_granule_grants_the_bucket_owner_full_control(
+    upload_s2_nbart, stubbed_aws, tmp_path, monkeypatch
+):
+    """
+    The data of a granule is uploaded with the ACL the bucket owner needs, as
+    it belongs to another account.
+    """
+    granule_dir = tmp_path / GRANULE_ID
+    (granule_dir / "NBART").mkdir(parents=True)
+    (granule_dir / "NBART" / "NBART_B02.TIF").write_bytes(b"band")
+    monkeypatch.setattr(upload_s2_nbart, "NCI_DIR", str(tmp_path))
+    monkeypatch.setattr(upload_s2_nbart, "granule_exists", lambda *args: False)
+    # Stop after the data is synced
+    monkeypatch.setattr(
+        upload_s2_nbart,
+        "upload_metadata",
+        lambda *args, **kwargs: pytest.fail("Unexpected metadata upload"),
+    )
+
+    client = boto3.client("s3")
+    put_objects = []
+    # Recorded as sent, as the parameters s3transfer adds vary with its version
+    client.meta.events.register(
+        "provide-client-params.s3.PutObject",
+        lambda params, **kwargs: put_objects.append(params),
+    )
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "list_objects_v2",
+            {"KeyCount": 0},
+            {
+                "Bucket": upload_s2_nbart.S3_BUCKET,
+                "Prefix": f"{upload_s2_nbart.get_granule_s3_path(GRANULE_ID)}/",
+            },
+        )
+        stubber.add_response("put_object", {})
+        transfer = stubbed_aws.NativeTransfer(client=client)
+        with pytest.raises(pytest.fail.Exception):
+            upload_s2_nbart.upload_granule(GRANULE_ID, "topic", transfer=transfer)
+        transfer.close()
+        stubber.assert_no_pending_responses()
+
+    granule_s3_path = upload_s2_nbart.get_granule_s3_path(GRANULE_ID)
+    assert [(params["Key"], params["ACL"]) for params in put_objects] == [
+        (f"{granule_s3_path}/NBART/NBART_B02.TIF", "bucket-owner-full-control")
+    ]
+
+
+def test_granule_inventory_lists_each_folder_once(upload_s2_nbart, tmp_path):
+    (tmp_path / "ARD-METADATA.yaml").write_text("id: abc\n")
+    files = {
+        "NBART": ["NBART_B02.TIF", "NBART_B8A.TIF", "NBART_QUICKLOOK.TIF"],
+        "SUPPLEMENTARY": ["SUP_SATELLITE_VIEW.TIF", "SUP_NOTES.txt"],
+        "QA": ["FMASK.TIF"],
+    }
+    for folder, names in files.items():
+        (tmp_path / folder).mkdir()
+        for name in names:
+            (tmp_path / folder / name).write_bytes(b"")
+    (tmp_path / "NBART" / "nested").mkdir()
+
+    inventory = upload_s2_nbart.GranuleInventory(tmp_path)
+
+    assert inventory.metadata == {"id": "abc"}
+    assert inventory.files == {folder: sorted(names) for folder, names in files.items()}
+
+    class Assembler:
+        noted = []
+
+        def note_measurement(self, name, path, **kwargs):
+            self.noted.append((name, path))
+
+    upload_s2_nbart.add_to_eo3(
+        Assembler(),
+        inventory,
+        "NBART",
+        lambda x: upload_s2_nbart.code_to_band[x.split("_")[-1]],
+        False,
+    )
+    assert Assembler.noted == [
+        ("nbart_blue", "NBART/NBART_B02.TIF"),
+        ("nbart_nir_2", "NBART/NBART_B8A.TIF"),
+    ]
+
+
+def test_footprints_are_cached_until_the_band_changes(upload_s2_nbart, tmp_path):
+    rasterio = pytest.importorskip("rasterio")
+    numpy = pytest.importorskip("numpy")
+    from affine import Affine
+
+    band_path = tmp_path / "NBART_B04.TIF"
+    image = numpy.zeros((64, 64), dtype="int16")
+    image[16:48, 8:40] = 1000
+
+    def write_band(data):
+        with rasterio.open(
+            band_path,
+            "w",
+            driver="GTiff",
+            width=64,
+            height=64,
+            count=1,
+            dtype="int16",
+            nodata=0,
+            crs="EPSG:32755",
+            transform=Affine(10, 0, 600000, 0, -10, 6000000),
+        ) as dataset:
+            dataset.write(data, 1)
+
+    write_band(image)
+    footprint = upload_s2_nbart.overview_footprint([band_path], 4)
+    left, bottom, right, top = footprint.bounds
+    # Within the buffer of a decimated pixel of the valid pixels
+    assert 600080 - 40 <= left <= 600080
+    assert 600400 <= right <= 600400 + 40
+    assert 5999520 - 40 <= bottom <= 5999520
+    assert 5999840 <= top <= 5999840 + 40
+
+    cache = upload_s2_nbart.FootprintCache(tmp_path / "footprints.sqlite")
+    fingerprint = upload_s2_nbart.footprint_fingerprint([band_path])
+    cache.put(GRANULE_ID, fingerprint, footprint)
+    assert cache.get(GRANULE_ID, fingerprint).equals(footprint)
+
+    # A reprocessed band has another fingerprint, and so no cached footprint
+    image[:, :] = 1000
+    write_band(image)
+    os.utime(band_path, ns=(0, 0))
+    assert (
+        cache.get(GRANULE_ID, upload_s2_nbart.footprint_fingerprint([band_path]))
+        is None
+    )
+    cache.close()
+
+
+def test_upload_stats_report_stages_and_slowest_granules(
+    upload_s2_nbart, uploads, monkeypatch, tmp_path
+):
+    stats = upload_s2_nbart.UploadStats(slowest=1)
+    stats.total = 3
+    monkeypatch.setattr(upload_s2_nbart, "STATS", stats)
+    monkeypatch.setattr(upload_s2_nbart, "granule_exists", lambda *args: False)
+
+    with stats.granule(GRANULE_ID):
+        upload_s2_nbart.upload_granule(
+            GRANULE_ID, "topic", journal=upload_s2_nbart.SyncJournal()
+        )
+    with stats.granule("stuck"), stats.granule("newer"):
+        with stats.stage("stuck", "sync"):
+            report_path = tmp_path / "stats.json"
+            stats.report(report_path)
+
+    snapshot = json.loads(report_path.read_text())
+    assert snapshot["granules"] == {
+        "uploaded": 1,
+        "skipped": 0,
+        "failed": 0,
+        "in_flight": 2,
+        "total": 3,
+    }
+    assert snapshot["eta_seconds"] is not None
+    assert {stage: times["count"] for stage, times in snapshot["stages"].items()} == {
+        "sync": 1,
+        "eo3": 1,
+        "stac": 1,
+        "sns": 1,
+    }
+    assert snapshot["stages"]["sync"]["p50"] <= snapshot["stages"]["sync"]["p95"]
+    # The granule in flight the longest, and the stage it's in
+    assert [
+        (granule["granule"], granule["stage"])
+        for granule in snapshot["slowest_in_flight"]
+    ] == [("stuck", "sync")]